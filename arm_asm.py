@@ -1,8 +1,12 @@
 """ARM Assembler"""
+import io
 import re
 import sys
+from collections import namedtuple
 from enum import Enum
 
+from elf import elf_layout, elf_writer, pack_data, pack_fixup, resolve_data, EM_ARM
+
 
 class REGISTERS(Enum):
     r0 = 0
@@ -89,6 +93,36 @@ class OPCODE(Enum):
     SVC = "svc"  # System Call
 
 
+class DATAPROC(Enum):
+    """Data-processing opcodes, bits 24 to 21 of the instruction."""
+
+    AND = 0b0000  # Rd := Rn AND Op2
+    EOR = 0b0001  # Rd := Rn XOR Op2
+    SUB = 0b0010  # Rd := Rn - Op2
+    RSB = 0b0011  # Rd := Op2 - Rn
+    ADD = 0b0100  # Rd := Rn + Op2
+    ADC = 0b0101  # Rd := Rn + Op2 + C
+    SBC = 0b0110  # Rd := Rn - Op2 + C - 1
+    RSC = 0b0111  # Rd := Op2 - Rn + C - 1
+    TST = 0b1000  # Set flags on Rn AND Op2
+    TEQ = 0b1001  # Set flags on Rn XOR Op2
+    CMP = 0b1010  # Set flags on Rn - Op2
+    CMN = 0b1011  # Set flags on Rn + Op2
+    ORR = 0b1100  # Rd := Rn OR Op2
+    MOV = 0b1101  # Rd := Op2
+    BIC = 0b1110  # Rd := Rn AND NOT Op2
+    MVN = 0b1111  # Rd := NOT Op2
+
+
+class SHIFT(Enum):
+    """Barrel shifter types, bits 6 to 5 of a register operand."""
+
+    LSL = 0b00  # Logical shift left
+    LSR = 0b01  # Logical shift right
+    ASR = 0b10  # Arithmetic shift right
+    ROR = 0b11  # Rotate right, RRX if the amount is zero
+
+
 class Program(Enum):
     DIRECTIVE = 1
     LABEL = 2
@@ -96,6 +130,23 @@ class Program(Enum):
     COMMENT = 4
 
 
+# A single tokenized line, pc is the instruction index or None.
+Token = namedtuple("Token", ["kind", "words", "pc"])
+
+# Classifies a line by its first word in a single match.
+LINE = re.compile(
+    r"[\t ,()]*(?:(?P<label>\.?\w+:)|(?P<directive>\.)|(?P<comment>@|//)"
+    r"|(?P<instruction>[^\t ,()]))"
+)
+WORDS = re.compile(r"\t+|,| |\(|\)|(\[)|(\]+)|(\{)|(\}+)")
+KINDS = {
+    "label": Program.LABEL,
+    "directive": Program.DIRECTIVE,
+    "comment": Program.COMMENT,
+    "instruction": Program.INSTRUCTION,
+}
+
+
 def sext(val: int, bits: int = 32):
     """Performs sign extension by number of bits given."""
     if val < 0:
@@ -140,11 +191,10 @@ def check_pc(insb: list[str]) -> bool:
 def prepare_labels(tokens: list[tuple]):
     """."""
     res = []
-    labels = list(filter(lambda c: c[0] == Program.LABEL, tokens))
-    label_names = [lab[1][0].replace(":", "") for lab in labels]
+    labels = [(i, c) for i, c in enumerate(tokens) if c[0] == Program.LABEL]
+    label_names = [lab[1][0].replace(":", "") for _, lab in labels]
 
-    for li, label in enumerate(labels):
-        idx = tokens.index(label)
+    for li, (idx, label) in enumerate(labels):
         for i in range(idx + 1, len(tokens)):
             if i == idx + 1:
                 res.append([label_names[li], label[2], label_names[li]])
@@ -175,30 +225,79 @@ def get_off_start(labels, label, count) -> int:
     return off, u
 
 
+def tokenize(fp):
+    """Reads the assembly code line by line & yields its tokenized symbols.
+
+    :param fp: File object holding the assembly code.
+    :return: Generator of tokens holding the type of the line and its symbols.
+    """
+    pc = 0
+    for line in fp:
+        line = line.rstrip("\r\n")
+        m = LINE.match(line)
+        if m is None:
+            continue
+        kind = KINDS[m.lastgroup]
+        sl = [w for w in WORDS.split(line) if w]
+        if kind == Program.INSTRUCTION:
+            yield Token(kind, sl, pc)
+            pc += 1
+        else:
+            yield Token(kind, sl, pc if kind == Program.LABEL else None)
+
+
 def parser(opdc: str):
     """Reads the assmebly code and returns list of tokenized symbols.
 
     :param opdc: The assembly code to be parsed in string format.
     :return: A list of tuples containing the type of the program and its symbols.
     """
-    ts, pc = [], 0
-    for line in opdc.split("\n"):
-        sl = list(filter(None, re.split(r"\t+|,| |\(|\)|(\[)|(\]+)|(\{)|(\}+)", line)))
-        if sl:
-            if re.match("\.(\w+):", sl[0]):
-                ts.append((Program.LABEL, sl, pc))
-            elif re.match("\.+", sl[0]):
-                ts.append((Program.DIRECTIVE, sl))
-            elif re.match("\w+(?: \w+)*:", sl[0]):
-                ts.append((Program.LABEL, sl, pc))
-            elif re.match("\@+", sl[0]):
-                ts.append((Program.COMMENT, sl))
-            elif re.match("\//+", sl[0]):
-                ts.append((Program.COMMENT, sl))
-            else:
-                ts.append((Program.INSTRUCTION, sl, pc))
-                pc += 1
-    return ts
+    return list(tokenize(io.StringIO(opdc)))
+
+
+def sections(tokens, ntext: int = None, base: int = 0x10000) -> tuple:
+    """Lays out the .data & .bss sections and collects the symbols.
+
+    :param tokens: List of a tuple holding the type of the program and its symbols.
+    :param ntext: Size of .text in bytes, the tokens are encoded to get it if
+        a data word refers to a label & it is not given.
+    :param base: Load address of .text.
+    :returns: The .data bytes, the .bss size, the symbols as a mapping of name
+        to (section, offset) & the names with global binding.
+    """
+    data, bss, symbols, globl = bytearray(), 0, dict(), set()
+    sec, fixups = ".text", []
+    for t in tokens:
+        if t[0] == Program.LABEL:
+            off = {".text": t[2] * 4, ".data": len(data), ".bss": bss}[sec]
+            symbols[t[1][0].replace(":", "")] = (sec, off)
+        elif t[0] == Program.DIRECTIVE:
+            d = t[1]
+            if d[0] in (".text", ".data", ".bss", ".section"):
+                name = d[1] if d[0] == ".section" else d[0]
+                sec = (
+                    ".bss"
+                    if name.startswith(".bss")
+                    else ".text" if name.startswith(".text") else ".data"
+                )
+            elif d[0] in (".global", ".globl"):
+                globl.add(d[1])
+            elif sec == ".data":
+                data += pack_fixup(d, len(data), fixups)
+            elif sec == ".bss":
+                bss += len(pack_data(d, bss))
+    if fixups and ntext is None:
+        ntext = 4 * len(asm32([t._replace(words=list(t.words)) for t in tokens]))
+    addrs = elf_layout(ntext or 0, len(data), base)
+    return resolve_data(data, fixups, symbols, addrs), bss, symbols, globl
+
+
+def dump_to_elf(ins: list[int], tokens, fn: str, base: int = 0x10000) -> None:
+    """Writes the output to an ELF32 executable."""
+    data, bss, symbols, globl = sections(tokens, 4 * len(ins), base)
+    text = b"".join(i.to_bytes(4, "little") for i in ins)
+    entry = base + symbols["main"][1] if "main" in symbols else base
+    elf_writer(fn, text, data, bss, symbols, globl, EM_ARM, base, entry)
 
 
 def asm32(tokens) -> list[int]:
@@ -209,6 +308,8 @@ def asm32(tokens) -> list[int]:
     :raises: RuntimeError if the instruction is not supported.
     """
     regs, conds = frozenset(REGISTERS.as_strs()), frozenset(CONDITION.as_strs())
+    # Labels may be referenced ahead of their definition.
+    tokens = tokens if isinstance(tokens, list) else list(tokens)
     labels = prepare_labels(tokens)
 
     ins = []
@@ -534,15 +635,25 @@ def asm32(tokens) -> list[int]:
     return ins
 
 
-if __name__ == "__main__":
+def main(argv: list[str] = None):
+    """Assembles a file, argv holds it & optionally the ELF file to write."""
+    argv = sys.argv[1:] if argv is None else argv
     try:
-        x = sys.argv[1]
-    except ValueError:
+        x = argv[0]
+    except IndexError:
         raise ValueError("No input file provided.")
 
     print(f"Read : {x}\n")
     with open(x, "r") as f:
-        ts = parser(f.read())
+        ts = list(tokenize(f))
         ins = asm32(ts)
 
         [print(f"{idx + 1} %08x " % i) for (idx, i) in enumerate(ins)]
+
+    if len(argv) > 1:
+        dump_to_elf(ins, ts, argv[1])
+        print(f"Write : {argv[1]}")
+
+
+if __name__ == "__main__":
+    main()
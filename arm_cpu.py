@@ -0,0 +1,526 @@
+"""32-Bit ARM Processor"""
+import struct
+import sys
+
+from arm_asm import CONDITION, SHIFT, REGISTERS
+
+MASK = 0xFFFFFFFF
+# Return address handed to the program in lr, branching there stops the cpu.
+HALT = 0xFFFFFFF0
+AL = CONDITION.AL.value
+
+
+def reset(size: int = 0x10000, base: int = 0):
+    """Initializes memory, registers & the decode cache.
+
+    :param size: Size of the memory in bytes.
+    :param base: Address of the first byte of memory.
+    """
+    global R, F, lazy, memory, BASE, decoded
+    memory = bytearray(size)
+    BASE = base
+    # r0 - r15, r15 holds the address of the current instruction + 8 while
+    # an instruction executes, like the pipelined hardware does.
+    R = [0] * 16
+    R[REGISTERS.sp.value] = base + size
+    R[REGISTERS.lr.value] = HALT
+    R[REGISTERS.pc.value] = base
+    # Condition flags N, Z, C & V, only valid while lazy is None.
+    F = [0, 0, 0, 0]
+    # Last flag-setting operation, the flags are derived from it on demand.
+    lazy = None
+    # Predecoded instructions by address, each a (handler, cond, args) tuple.
+    decoded = {HALT: (_halt, AL, ())}
+
+
+def registers_to_str() -> str:
+    """Returns formatted str of all registers."""
+    s = ""
+    for i, c in enumerate(R):
+        if i % 4 == 0 and i != 0:
+            s += "\n"
+        s += "\t%4s : %08x " % (REGISTERS(i).name, c)
+    return s + "\n\tnzcv : %d%d%d%d" % tuple(nzcv())
+
+
+def sext(val: int, bits: int = 32) -> int:
+    """Performs sign extension by number of bits given."""
+    return ((val & ((1 << bits) - 1)) ^ (1 << (bits - 1))) - (1 << (bits - 1))
+
+
+#
+# Memory
+#
+def fetch32(addr: int) -> int:
+    addr -= BASE
+    if addr < 0 or addr + 4 > len(memory):
+        raise Exception("read out of memory: 0x%x" % (addr + BASE))
+    return struct.unpack_from("<I", memory, addr)[0]
+
+
+def rmem(addr: int, n: int) -> int:
+    """Reads n bytes from memory as unsigned little-endian integer."""
+    addr -= BASE
+    if addr < 0 or addr + n > len(memory):
+        raise Exception("read out of memory: 0x%x" % (addr + BASE))
+    return int.from_bytes(memory[addr : addr + n], "little")
+
+
+def wmem(addr: int, val: int, n: int = 4):
+    """Writes n bytes of val to memory & drops stale decoded instructions."""
+    decoded.pop(addr & ~3, None)
+    addr -= BASE
+    if addr < 0 or addr + n > len(memory):
+        raise Exception("write out of memory: 0x%x" % (addr + BASE))
+    memory[addr : addr + n] = (val & ((1 << (n * 8)) - 1)).to_bytes(n, "little")
+
+
+def load_hex(fn: str, addr: int = None):
+    """Loads a hex image, one 32 bit word per line, to memory.
+
+    Words which are no hex numbers, like the '*' placeholders of the test
+    images, are loaded as zero.
+    """
+    addr = BASE if addr is None else addr
+    with open(fn, "r") as f:
+        for line in f:
+            w = line.strip()
+            if not w:
+                continue
+            try:
+                wmem(addr, int(w, 16))
+            except ValueError:
+                wmem(addr, 0)
+            addr += 4
+
+
+def load_elf(fn: str) -> int:
+    """Loads the PT_LOAD segments of an ELF file & returns its entry point.
+
+    Memory is reset to start at the lowest segment unless it already does.
+    """
+    global memory
+    from elftools.elf.elffile import ELFFile
+    from elf import elf_reader
+
+    with open(fn, "rb") as f:
+        elf = ELFFile(f)
+        entry = elf.header.e_entry
+        addrs = [s.header.p_paddr for s in elf.iter_segments(type="PT_LOAD")]
+    if addrs and min(addrs) != BASE:
+        reset(len(memory), min(addrs))
+    memory = bytearray(elf_reader(memory, fn, base=BASE))
+    decoded.clear()
+    decoded[HALT] = (_halt, AL, ())
+    return entry
+
+
+def load(fn: str) -> int:
+    """Loads an ELF or hex image, sets pc to & returns the address to start at.
+
+    ELF files are told by their magic bytes & placed at their load address,
+    hex images at the start of memory.
+    """
+    with open(fn, "rb") as f:
+        is_elf = f.read(4) == b"\x7fELF"
+    if is_elf:
+        R[15] = load_elf(fn)
+    else:
+        load_hex(fn)
+        R[15] = BASE
+    return R[15]
+
+
+#
+# Conditions & Flags
+#
+CHECK = {
+    CONDITION.EQ.value: lambda n, z, c, v: z,
+    CONDITION.NE.value: lambda n, z, c, v: not z,
+    CONDITION.CS.value: lambda n, z, c, v: c,
+    CONDITION.CC.value: lambda n, z, c, v: not c,
+    CONDITION.MI.value: lambda n, z, c, v: n,
+    CONDITION.PL.value: lambda n, z, c, v: not n,
+    CONDITION.VS.value: lambda n, z, c, v: v,
+    CONDITION.VC.value: lambda n, z, c, v: not v,
+    CONDITION.HI.value: lambda n, z, c, v: c and not z,
+    CONDITION.LS.value: lambda n, z, c, v: not c or z,
+    CONDITION.GE.value: lambda n, z, c, v: n == v,
+    CONDITION.LT.value: lambda n, z, c, v: n != v,
+    CONDITION.GT.value: lambda n, z, c, v: not z and n == v,
+    CONDITION.LE.value: lambda n, z, c, v: z or n != v,
+    CONDITION.AL.value: lambda n, z, c, v: True,
+}
+
+
+def nzcv() -> list[int]:
+    """Derives N, Z, C & V from the last flag-setting operation.
+
+    Arithmetic ops are recorded as the (x, y, carry in, result) of the
+    addition they boil down to, logical ops as (result, shifter carry, prev)
+    where a carry of None keeps C and prev is the arithmetic op C & V stem
+    from, if it is not yet folded into F.
+    """
+    global lazy
+    if lazy is not None:
+        if len(lazy) == 4:
+            x, y, cin, res = lazy
+            F[2], F[3] = (x + y + cin) >> 32, ((x ^ res) & (y ^ res)) >> 31
+        else:
+            res, sc, prev = lazy
+            if prev is not None:
+                x, y, cin, pres = prev
+                F[2], F[3] = (x + y + cin) >> 32, ((x ^ pres) & (y ^ pres)) >> 31
+            if sc is not None:
+                F[2] = sc
+        F[0], F[1] = res >> 31, int(res == 0)
+        lazy = None
+    return F
+
+
+def passed(cond: int) -> bool:
+    """Checks the condition of an instruction against the flags."""
+    # EQ & NE only need Z, which comes straight from the last result.
+    if cond <= 1 and lazy is not None:
+        return ((lazy[3] if len(lazy) == 4 else lazy[0]) == 0) != cond
+    return CHECK[cond](*nzcv())
+
+
+def cpsr() -> int:
+    """Returns the CPSR as read by MRS, the cpu always runs in user mode."""
+    n, z, c, v = nzcv()
+    return (n << 31) | (z << 30) | (c << 29) | (v << 28) | 0x10
+
+
+def set_logic(res: int, sc: int = None):
+    """Records a logical flag-setting op, V & maybe C are left as they are."""
+    global lazy
+    prev = lazy
+    if prev is not None and len(prev) == 3:
+        sc = prev[1] if sc is None else sc
+        prev = prev[2]
+    lazy = (res, sc, prev)
+
+
+def addc(a: int, b: int, c: int, s: int = 0) -> int:
+    """Adds with carry, recording the op for the flags if s is set."""
+    global lazy
+    res = (a + b + c) & MASK
+    if s:
+        lazy = (a, b, c, res)
+    return res
+
+
+#
+# Barrel Shifter
+#
+def shift(val: int, typ: int, amt: int) -> tuple:
+    """Shifts val & returns the result together with the shifter carry out.
+
+    :param typ: One of SHIFT, 4 stands for RRX.
+    :param amt: Shift amount, immediate amounts are already normalized so
+        that LSR & ASR by 32 are given as 32.
+    :returns: The result & the carry out, None if the carry is unchanged.
+    """
+    if typ == 4:
+        return (nzcv()[2] << 31) | (val >> 1), val & 1
+    if amt == 0:
+        return val, None
+    if typ == 0:
+        if amt < 32:
+            return (val << amt) & MASK, (val >> (32 - amt)) & 1
+        return 0, val & 1 if amt == 32 else 0
+    if typ == 1:
+        if amt < 32:
+            return val >> amt, (val >> (amt - 1)) & 1
+        return 0, val >> 31 if amt == 32 else 0
+    if typ == 2:
+        if amt < 32:
+            return (sext(val) >> amt) & MASK, (val >> (amt - 1)) & 1
+        return (MASK if val >> 31 else 0), val >> 31
+    amt &= 31
+    if amt == 0:
+        return val, val >> 31
+    return ((val >> amt) | (val << (32 - amt))) & MASK, (val >> (amt - 1)) & 1
+
+
+#
+# Execution
+#
+def _alu(op: int, s: int, rn: int, rd: int, b: int, sc: int):
+    """Executes a data-processing op on Rn & the shifted operand b.
+
+    The flags are not computed here, flag-setting ops only record their
+    operands & nzcv derives the flags once they are read.
+    """
+    a = R[rn]
+    if op == 4 or op == 11:
+        res = addc(a, b, 0, s)
+    elif op == 2 or op == 10:
+        res = addc(a, b ^ MASK, 1, s)
+    elif op == 13:
+        res = b
+    elif op == 0 or op == 8:
+        res = a & b
+    elif op == 12:
+        res = a | b
+    elif op == 1 or op == 9:
+        res = a ^ b
+    elif op == 3:
+        res = addc(b, a ^ MASK, 1, s)
+    elif op == 14:
+        res = a & (b ^ MASK)
+    elif op == 15:
+        res = b ^ MASK
+    elif op == 5:
+        res = addc(a, b, nzcv()[2], s)
+    elif op == 6:
+        res = addc(a, b ^ MASK, nzcv()[2], s)
+    else:
+        res = addc(b, a ^ MASK, nzcv()[2], s)
+    if s and op not in ARITH:
+        set_logic(res, sc)
+    # TST, TEQ, CMP & CMN only set the flags.
+    if op & 0b1100 != 0b1000:
+        R[rd] = res
+        if rd == 15:
+            R[15] = res & ~3
+            return True
+
+
+# Data-processing ops which set C & V from an addition.
+ARITH = frozenset((2, 3, 4, 5, 6, 7, 10, 11))
+
+
+def _dp_imm(op, s, rn, rd, imm, rot):
+    return _alu(op, s, rn, rd, imm, imm >> 31 if rot else None)
+
+
+def _dp_reg(op, s, rn, rd, rm, typ, amt):
+    b, sc = shift(R[rm], typ, amt)
+    return _alu(op, s, rn, rd, b, sc)
+
+
+def _dp_rsr(op, s, rn, rd, rm, typ, rs):
+    # A register specified shift reads pc as the instruction address + 12.
+    val = R[rm] + 4 if rm == 15 else R[rm]
+    b, sc = shift(val, typ, R[rs] & 0xFF)
+    return _alu(op, s, rn, rd, b, sc)
+
+
+def _mul(s, acc, rd, rn, rs, rm):
+    res = (R[rm] * R[rs] + (R[rn] if acc else 0)) & MASK
+    R[rd] = res
+    if s:
+        set_logic(res)
+
+
+def _mull(s, sign, acc, hi, lo, rs, rm):
+    a, b = (sext(R[rm]), sext(R[rs])) if sign else (R[rm], R[rs])
+    res = (a * b + (R[hi] << 32 | R[lo] if acc else 0)) & 0xFFFFFFFFFFFFFFFF
+    R[lo], R[hi] = res & MASK, res >> 32
+    if s:
+        # N & Z of the 64 bit result: the high word, with a bit if the low one is set.
+        set_logic(R[hi] | (R[lo] != 0))
+
+
+def _transfer(l, size, sign, p, u, w, rn, rd, off):
+    """Single data transfer of size bytes between Rd & memory."""
+    base = R[rn]
+    addr = (base + off if u else base - off) & MASK
+    ea = addr if p else base
+    if not p or w:
+        R[rn] = addr
+    if l:
+        val = rmem(ea, size)
+        if sign:
+            val = sext(val, size * 8) & MASK
+        R[rd] = val
+        if rd == 15:
+            R[15] = val & ~3
+            return True
+    else:
+        # Storing pc writes the instruction address + 12.
+        wmem(ea, R[rd] + 4 if rd == 15 else R[rd], size)
+
+
+def _ldst_imm(l, size, sign, p, u, w, rn, rd, imm):
+    return _transfer(l, size, sign, p, u, w, rn, rd, imm)
+
+
+def _ldst_reg(l, size, sign, p, u, w, rn, rd, rm, typ, amt):
+    off = shift(R[rm], typ, amt)[0]
+    return _transfer(l, size, sign, p, u, w, rn, rd, off)
+
+
+def _block(l, p, u, w, rn, regs):
+    """LDM & STM, PUSH is STMDB sp! & POP is LDMIA sp!."""
+    base = R[rn]
+    n = len(regs) * 4
+    addr = base + (4 if p else 0) if u else base - n + (0 if p else 4)
+    if w:
+        R[rn] = (base + n if u else base - n) & MASK
+    if l:
+        for r in regs:
+            R[r] = rmem(addr, 4)
+            addr += 4
+        if 15 in regs:
+            R[15] &= ~3
+            return True
+    else:
+        for r in regs:
+            wmem(addr, R[r] + 4 if r == 15 else R[r])
+            addr += 4
+
+
+def _branch(link, off):
+    pc = R[15] - 8
+    if link:
+        # Relocatable images leave calls to external symbols as a branch to
+        # itself, those calls return right away.
+        if off == -8:
+            return
+        R[14] = pc + 4
+    R[15] = (R[15] + off) & MASK
+    return True
+
+
+def _bx(rm):
+    R[15] = R[rm] & ~1
+    return True
+
+
+def _mrs(rd):
+    R[rd] = cpsr()
+
+
+def _msr(val, rm):
+    global lazy
+    if rm is not None:
+        val = R[rm]
+    lazy = None
+    F[0], F[1], F[2], F[3] = (
+        val >> 31,
+        (val >> 30) & 1,
+        (val >> 29) & 1,
+        (val >> 28) & 1,
+    )
+
+
+def _swi(imm):
+    # Linux EABI exit(r0) syscall, any other call is ignored.
+    if R[7] == 1:
+        return False
+
+
+def _halt():
+    return False
+
+
+#
+# Decode
+#
+def decode(ins: int) -> tuple:
+    """Decodes an instruction into a (handler, cond, args) tuple."""
+    cond = ins >> 28
+    if cond == 0xF:
+        raise RuntimeError("Unconditional instruction %08x not supported." % ins)
+    rn, rd = (ins >> 16) & 0xF, (ins >> 12) & 0xF
+    p, u, w, l = (ins >> 24) & 1, (ins >> 23) & 1, (ins >> 21) & 1, (ins >> 20) & 1
+    kind = (ins >> 25) & 0b111
+
+    if kind == 0b000:
+        if ins & 0x0FFFFFF0 == 0x012FFF10:
+            return _bx, cond, (ins & 0xF,)
+        if ins & 0x0FC000F0 == 0x00000090:
+            return _mul, cond, (l, w, rn, rd, (ins >> 8) & 0xF, ins & 0xF)
+        if ins & 0x0F8000F0 == 0x00800090:
+            # UMULL, UMLAL, SMULL & SMLAL, RdHi & RdLo sit where Rn & Rd do.
+            sign = (ins >> 22) & 1
+            return _mull, cond, (l, sign, w, rn, rd, (ins >> 8) & 0xF, ins & 0xF)
+        if ins & 0x0FBF0FFF == 0x010F0000:
+            return _mrs, cond, (rd,)
+        if ins & 0x0FB0FFF0 == 0x0120F000:
+            return _msr, cond, (0, ins & 0xF)
+        if ins & 0x90 == 0x90 and ins & 0x60:
+            # Halfword & signed byte transfers.
+            size = 2 if ins & 0x20 else 1
+            sign = (ins >> 6) & 1
+            if (ins >> 22) & 1:
+                imm = ((ins >> 4) & 0xF0) | (ins & 0xF)
+                return _ldst_imm, cond, (l, size, sign, p, u, w, rn, rd, imm)
+            return _ldst_reg, cond, (l, size, sign, p, u, w, rn, rd, ins & 0xF, 0, 0)
+        op, s, rm, typ = (ins >> 21) & 0xF, l, ins & 0xF, (ins >> 5) & 0b11
+        if (ins >> 4) & 1:
+            return _dp_rsr, cond, (op, s, rn, rd, rm, typ, (ins >> 8) & 0xF)
+        return _dp_reg, cond, (op, s, rn, rd, rm) + imm_shift(typ, (ins >> 7) & 0x1F)
+    if kind == 0b001:
+        rot = ((ins >> 8) & 0xF) * 2
+        imm = ins & 0xFF
+        imm = ((imm >> rot) | (imm << (32 - rot))) & MASK if rot else imm
+        if ins & 0x0FB0F000 == 0x0320F000:
+            return _msr, cond, (imm, None)
+        return _dp_imm, cond, ((ins >> 21) & 0xF, l, rn, rd, imm, rot)
+    if kind == 0b010:
+        size = 1 if (ins >> 22) & 1 else 4
+        return _ldst_imm, cond, (l, size, 0, p, u, w, rn, rd, ins & 0xFFF)
+    if kind == 0b011 and not (ins >> 4) & 1:
+        size = 1 if (ins >> 22) & 1 else 4
+        sh = imm_shift((ins >> 5) & 0b11, (ins >> 7) & 0x1F)
+        return _ldst_reg, cond, (l, size, 0, p, u, w, rn, rd, ins & 0xF) + sh
+    if kind == 0b100:
+        regs = tuple(r for r in range(16) if (ins >> r) & 1)
+        return _block, cond, (l, p, u, w, rn, regs)
+    if kind == 0b101:
+        return _branch, cond, (p, sext(ins & 0xFFFFFF, 24) << 2)
+    if kind == 0b111 and p:
+        return _swi, cond, (ins & 0xFFFFFF,)
+    raise RuntimeError("Undefined instruction %08x." % ins)
+
+
+def imm_shift(typ: int, amt: int) -> tuple:
+    """Normalizes an immediate shift, LSR & ASR #0 mean #32, ROR #0 is RRX."""
+    if amt == 0:
+        if typ == SHIFT.ROR.value:
+            return 4, 1
+        if typ != SHIFT.LSL.value:
+            return typ, 32
+    return typ, amt
+
+
+def step() -> bool:
+    """Executes a single instruction, returns False once the cpu halted."""
+    pc = R[15]
+    d = decoded.get(pc)
+    if d is None:
+        d = decoded[pc] = decode(fetch32(pc))
+    h, cond, args = d
+    if cond != AL and not passed(cond):
+        R[15] = pc + 4
+        return True
+    R[15] = pc + 8
+    r = h(*args)
+    if r is None:
+        R[15] = pc + 4
+    elif r is False:
+        R[15] = pc
+    return r is not False
+
+
+def run(limit: int = None) -> int:
+    """Runs until the cpu halts or limit instructions ran, returns the count."""
+    inscnt = 0
+    while step():
+        inscnt += 1
+        if limit is not None and inscnt >= limit:
+            break
+    return inscnt
+
+
+if __name__ == "__main__":
+    for x in sys.argv[1:]:
+        print(f"Execute : {x}")
+        reset()
+        load(x)
+        print("  ran %d instructions" % run())
+        print(registers_to_str() + "\n")
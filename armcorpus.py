@@ -0,0 +1,213 @@
+"""ARM Assembler Golden Corpus
+
+Checks arm_asm against expected images of a corpus of assembly files. The
+expected image of a source is, in this order:
+
+- a checked-in hex image, test/<name>.hex with or without the arm32_ prefix,
+- a golden image cached under test/golden by a hash of the source,
+- built by the cross assembler, arm-linux-gnueabi-as, if it is installed, &
+  written to the cache, so later runs need no toolchain.
+
+Images hold one hex word per line, a '*' matches any word, like the
+relocated words of an object file. Files are checked in parallel & every
+mismatching word is reported with both words disassembled.
+
+    $ python armcorpus.py testfs/*.s --build -j 8
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+GOLDEN = ROOT / "test" / "golden"
+AS = "arm-linux-gnueabi-as"
+OBJCOPY = "arm-linux-gnueabi-objcopy"
+OBJDUMP = "arm-linux-gnueabi-objdump"
+# Fewer files are checked in this process, starting workers costs more.
+PARALLEL = 16
+
+
+def discover(pattern: str = "testfs/*.s") -> list[str]:
+    """Returns the ARM sources matching a glob pattern relative to the root."""
+    return sorted(
+        str(p.relative_to(ROOT)) for p in ROOT.glob(pattern) if p.name.startswith("arm")
+    )
+
+
+def source_key(src: bytes) -> str:
+    """Hash of a source & of the command building its golden image."""
+    return hashlib.sha256(AS.encode() + b"\0" + src).hexdigest()
+
+
+def read_image(fn: str) -> list:
+    """Reads a hex image, '*' & other placeholders become None."""
+    words = []
+    with open(fn) as f:
+        for w in f.read().split():
+            try:
+                words.append(int(w, 16))
+            except ValueError:
+                words.append(None)
+    return words
+
+
+def write_image(fn: str, words: list):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, "w") as f:
+        f.write("".join("*\n" if w is None else "%08x\n" % w for w in words))
+
+
+#
+# Golden images
+#
+def toolchain() -> bool:
+    return all(shutil.which(t) for t in (AS, OBJCOPY, OBJDUMP))
+
+
+def build(src: str) -> list:
+    """Assembles a source with the cross assembler, returns its .text words.
+
+    Words with a relocation depend on the link & become wildcards.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        obj, bin = os.path.join(d, "x.o"), os.path.join(d, "x.bin")
+        subprocess.run([AS, "-o", obj, src], check=True, capture_output=True)
+        subprocess.run(
+            [OBJCOPY, "-O", "binary", "-j", ".text", obj, bin],
+            check=True,
+            capture_output=True,
+        )
+        relocs = subprocess.run(
+            [OBJDUMP, "-r", "-j", ".text", obj],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        data = Path(bin).read_bytes()
+    words = [int.from_bytes(data[i : i + 4], "little") for i in range(0, len(data), 4)]
+    for m in re.finditer(r"^([0-9a-f]{8}) ", relocs, re.MULTILINE):
+        if int(m[1], 16) >> 2 < len(words):
+            words[int(m[1], 16) >> 2] = None
+    return words
+
+
+def expected(src: str, make: bool = False) -> tuple:
+    """Returns the expected image of a source & where it came from.
+
+    :param make: Builds missing golden images with the cross assembler.
+    :returns: The words, None if there is no image, & its file.
+    """
+    stem = Path(src).stem
+    for name in (stem, stem.removeprefix("arm32_")):
+        fn = ROOT / "test" / f"{name}.hex"
+        if fn.exists():
+            return read_image(fn), str(fn)
+    fn = GOLDEN / (source_key(Path(src).read_bytes()) + ".hex")
+    if not fn.exists() and make and toolchain():
+        write_image(str(fn), build(src))
+    if fn.exists():
+        return read_image(fn), str(fn)
+    return None, None
+
+
+#
+# Checking
+#
+def diff(want: list, got: list) -> list[tuple]:
+    """Returns the (index, expected, actual) of each mismatching word.
+
+    Missing words are None, expected wildcards match anything. Zero words
+    past the end of got are the padding of the section & match too.
+    """
+    n = len(want)
+    while n > len(got) and want[n - 1] in (0, None):
+        n -= 1
+    out = []
+    for i in range(max(n, len(got))):
+        w = want[i] if i < n else None
+        g = got[i] if i < len(got) else None
+        if (w is None and i < n) or w == g:
+            continue
+        out.append((i, w, g))
+    return out
+
+
+def describe(i: int, want: int, got: int) -> str:
+    """Formats a mismatch with both words disassembled."""
+    from disasm import arm
+
+    def word(w):
+        return "--------  (missing)" if w is None else "%08x  %s" % (w, arm(w, 4 * i))
+
+    return f"0x{4 * i:04x}: expected {word(want)}\n        actual   {word(got)}"
+
+
+def check(args) -> dict:
+    """Assembles a source & compares it to its expected image.
+
+    :returns: "file", "golden" & the "mismatches", or an "error".
+    """
+    src, make = args
+    import arm_asm
+
+    res = {"file": src}
+    want, res["golden"] = expected(src, make)
+    if want is None:
+        return res
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), open(src) as f:
+            got = arm_asm.asm32(arm_asm.parser(f.read()))
+    except Exception as e:
+        res["error"] = f"{type(e).__name__}: {e}"
+        return res
+    res["words"] = len(want)
+    res["mismatches"] = diff(want, got)
+    return res
+
+
+def check_all(files: list[str], make: bool = False, jobs: int = None) -> list[dict]:
+    """Checks the files, in worker processes once there are enough of them."""
+    args = [(fn, make) for fn in files]
+    if len(files) < PARALLEL or jobs == 1:
+        return [check(a) for a in args]
+    with ProcessPoolExecutor(jobs) as ex:
+        return list(ex.map(check, args, chunksize=max(1, len(args) // 64)))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("files", nargs="*", help="ARM sources, testfs/arm*.s by default")
+    p.add_argument("--build", action="store_true", help="build missing goldens")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    a = p.parse_args()
+
+    results = check_all(a.files or discover(), a.build, a.jobs)
+    failed = 0
+    for r in results:
+        if r["golden"] is None:
+            print(f"  skipped  {r['file']}: no expected image")
+        elif "error" in r:
+            failed += 1
+            print(f"  error    {r['file']}: {r['error']}")
+        elif r["mismatches"]:
+            failed += 1
+            print(f"  failed   {r['file']}: {len(r['mismatches'])} words differ")
+            for m in r["mismatches"]:
+                print("    " + describe(*m))
+        else:
+            print(f"  passed   {r['file']}: {r['words']} words")
+    print(f"{len(results)} files, {failed} failed.")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Incremental Assembler Driver
+
+Assembles many files in parallel & caches the tokenized and encoded output of
+each file keyed by a hash of its source and of the assembler version, so only
+files whose inputs changed are encoded again.
+
+    $ python asmbuild.py -o build testfs/arm32_*.s testfs/riscv_minimal.s
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+# Modules the output of each assembler depends on.
+SOURCES = {
+    "arm": ["arm_asm.py", "elf.py"],
+    "riscv": ["riscv_asm.py", "riscv.py", "elf.py"],
+}
+
+
+def detect_isa(fn: str) -> str:
+    """Guesses the instruction set of an assembly file by its name."""
+    return "arm" if Path(fn).name.startswith("arm") else "riscv"
+
+
+def asm_version(isa: str) -> str:
+    """Returns a hash over the assembler sources, changes invalidate the cache."""
+    h = hashlib.sha256()
+    for fn in SOURCES[isa]:
+        h.update((ROOT / fn).read_bytes())
+    return h.hexdigest()
+
+
+def cache_key(src: bytes, isa: str, version: str) -> str:
+    """Content hash of a source file for a given assembler version."""
+    return hashlib.sha256(isa.encode() + version.encode() + src).hexdigest()
+
+
+def assemble(isa: str, src: str) -> dict:
+    """Tokenizes & encodes a single source, returning the result per section."""
+    # The assemblers print their progress, keep the workers quiet.
+    with contextlib.redirect_stdout(io.StringIO()):
+        if isa == "arm":
+            import arm_asm
+
+            tokens = arm_asm.parser(src)
+            # asm32 consumes the words of its tokens, keep the cached ones intact.
+            text = arm_asm.asm32([t._replace(words=list(t.words)) for t in tokens])
+            data, bss, symbols, globl = arm_asm.sections(tokens, 4 * len(text))
+        else:
+            import riscv_asm
+
+            tokens = riscv_asm.parse(src)
+            text, data, bss, symbols, globl = riscv_asm.sections(tokens)
+    return {
+        "tokens": tokens,
+        "text": text,
+        "data": data,
+        "bss": bss,
+        "symbols": symbols,
+        "globl": globl,
+    }
+
+
+def _job(args):
+    isa, src, path = args
+    try:
+        res = assemble(isa, src)
+    except Exception as e:
+        # Failures are reported but never cached.
+        return {"error": f"{type(e).__name__}: {e}"}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A temp file of its own, other builds may write the same entry at once.
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(res, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return res
+
+
+def write_outputs(fn: str, isa: str, res: dict, out: str, elf: bool) -> list[str]:
+    """Writes the hex image (& ELF) of an assembled file to the output folder."""
+    from arm_asm import dump_to_hex
+    from elf import elf_writer, EM_ARM, EM_RISCV
+
+    name = os.path.join(out, Path(fn).stem)
+    dump_to_hex(res["text"], name + ".hex")
+    written = [name + ".hex"]
+    if elf:
+        base = 0x10000 if isa == "arm" else 0x80000000
+        text = b"".join(i.to_bytes(4, "little") for i in res["text"])
+        machine = EM_ARM if isa == "arm" else EM_RISCV
+        entry = base + res["symbols"]["main"][1] if "main" in res["symbols"] else base
+        elf_writer(
+            name + ".elf",
+            text,
+            res["data"],
+            res["bss"],
+            res["symbols"],
+            res["globl"],
+            machine,
+            base,
+            entry,
+        )
+        written.append(name + ".elf")
+    return written
+
+
+def build(
+    files: list[str],
+    out: str = None,
+    elf: bool = False,
+    jobs: int = None,
+    cache: str = ".asmcache",
+    isa: str = None,
+) -> dict:
+    """Assembles the files, re-encoding only those which are not cached.
+
+    :param files: Assembly sources.
+    :param out: Folder for the hex images (& ELF files), None writes nothing.
+    :param elf: Writes an ELF executable next to each hex image.
+    :param jobs: Number of worker processes, defaults to the cpu count.
+    :param cache: Folder holding the cached results.
+    :param isa: Forces 'arm' or 'riscv' instead of guessing by file name.
+    :returns: Mapping of file name to its assembled result.
+    """
+    versions = {k: asm_version(k) for k in SOURCES}
+    # Files with the same source & isa share a cache entry, encode it once.
+    results, todo, pending = dict(), dict(), dict()
+    for fn in files:
+        fisa = isa or detect_isa(fn)
+        src = Path(fn).read_bytes()
+        path = os.path.join(cache, cache_key(src, fisa, versions[fisa]) + ".pkl")
+        try:
+            with open(path, "rb") as f:
+                results[fn] = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            todo[path], pending[fn] = (fisa, src.decode(), path), path
+
+    if len(todo) > 1 and jobs != 1:
+        with ProcessPoolExecutor(jobs) as ex:
+            done = dict(zip(todo, ex.map(_job, todo.values())))
+    else:
+        done = {path: _job(args) for path, args in todo.items()}
+    for fn, path in pending.items():
+        results[fn] = done[path]
+
+    failed = [fn for fn in files if "error" in results[fn]]
+    for fn in failed:
+        print(f"  {fn} : {results[fn]['error']}")
+
+    if out is not None:
+        os.makedirs(out, exist_ok=True)
+        for fn in files:
+            if fn not in failed:
+                write_outputs(fn, isa or detect_isa(fn), results[fn], out, elf)
+
+    print(
+        f"Assembled {len(pending) - len(failed)} of {len(files)} files, "
+        f"{len(files) - len(pending)} cached, {len(failed)} failed."
+    )
+    return results
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("files", nargs="+", help="assembly sources")
+    p.add_argument("-o", "--out", default="build", help="output folder")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    p.add_argument("--elf", action="store_true", help="also write ELF files")
+    p.add_argument("--isa", choices=SOURCES, default=None)
+    p.add_argument("--cache", default=".asmcache", help="cache folder")
+    a = p.parse_args()
+    res = build(a.files, a.out, a.elf, a.jobs, a.cache, a.isa)
+    sys.exit(1 if any("error" in r for r in res.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
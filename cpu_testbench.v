@@ -6,6 +6,10 @@ module cpu_testbench #(parameter PERIOD = 10);
 	reg clk;
     reg reset_n;
     wire trap;
+    // Clock cycles run & the limit, +cycles=N. +trace prints every cycle.
+    integer cycle = 0;
+    integer cycles;
+    reg trace;
 
     processor p (
         .clk(clk),
@@ -31,26 +35,33 @@ module cpu_testbench #(parameter PERIOD = 10);
 
     always @(posedge clk) begin
         reset_n <= 1;
-        $display("pc:%d -- ins:%h -- alu_c:%b alu_res:%b wb_data:%b -- wb:%b mem_r:%b mem_w:%b",
-            p.pc,
-            p.w_fs_ins,
-            p.w_de_alu_c,
-            p.w_eu_alu_res,
-            p.w_wb_wb_data,
-            p.w_wb_wb_en,
-            p.w_eu_mem_r_en,
-            p.w_eu_mem_w_en
-        );
+        cycle <= cycle + 1;
+        if (trace)
+            $display("pc:%d -- ins:%h -- alu_c:%b alu_res:%b wb_data:%b -- wb:%b mem_r:%b mem_w:%b",
+                p.pc,
+                p.w_fs_ins,
+                p.w_de_alu_c,
+                p.w_eu_alu_res,
+                p.w_wb_wb_data,
+                p.w_wb_wb_en,
+                p.w_eu_mem_r_en,
+                p.w_eu_mem_w_en
+            );
     end
 
     always @(posedge trap) begin
         $display("TRAP. finished.");
+        $display("cycles %0d", cycle);
         $finish;
     end
 
     initial begin
-        #500
+        trace = $test$plusargs("trace");
+        if (!$value$plusargs("cycles=%d", cycles))
+            cycles = 50;
+        repeat (cycles) @(posedge clk);
         $display("\nfinished.");
+        $display("cycles %0d", cycle);
         $finish;
     end
 endmodule
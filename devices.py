@@ -0,0 +1,230 @@
+"""Memory Mapped Devices
+
+A bus maps address ranges outside of RAM to device objects. Each device
+handles reads & writes relative to its base address, the processor only
+dispatches to the bus when an access misses RAM.
+
+The default layout follows the qemu virt machine:
+
+    0x00100000  test finisher
+    0x02000000  CLINT, mtime & mtimecmp
+    0x10000000  UART, 16550 compatible
+"""
+import sys
+import time
+
+
+class Halt(Exception):
+    """Raised by a device to stop the processor, code 0 means success."""
+
+    def __init__(self, code: int):
+        super().__init__("exit code %d" % code)
+        self.code = code
+
+
+class Device:
+    """Base of all devices, reads of unknown registers return 0."""
+
+    size = 0x1000
+
+    def read(self, off: int, n: int) -> int:
+        return 0
+
+    def write(self, off: int, val: int, n: int):
+        pass
+
+    def flush(self):
+        pass
+
+    def receiving(self) -> bool:
+        """Returns whether input may still arrive, for loops polling it."""
+        return False
+
+
+class UART(Device):
+    """Transmit & receive registers of a 16550 UART.
+
+    Transmitted bytes are collected & written to the host stream in batches,
+    once limit bytes are pending or the bus is flushed. Received bytes are
+    read from the host stream in chunks whenever the guest polls an empty
+    receive buffer, until it ends.
+
+    :param out: Binary stream for transmitted bytes, default stdout.
+    :param inp: Binary stream for received bytes, default none.
+    :param limit: Number of pending bytes which triggers a write.
+    """
+
+    size = 0x100
+    # Register offsets.
+    RBR = THR = 0
+    LSR = 5
+    # Line status bits, data ready & transmitter empty.
+    DR, THRE = 0x01, 0x60
+
+    def __init__(self, out=None, inp=None, limit: int = 4096):
+        self.out = sys.stdout.buffer if out is None else out
+        self.inp = inp
+        self.limit = limit
+        self.tx = bytearray()
+        self.rx = bytearray()
+
+    def _fill(self):
+        if not self.rx and self.inp is not None:
+            read = getattr(self.inp, "read1", self.inp.read)
+            data = read(4096)
+            # None only means nothing is there yet, b"" that the stream ended.
+            if data == b"":
+                self.inp = None
+            self.rx += data or b""
+
+    def read(self, off: int, n: int) -> int:
+        if off == self.RBR:
+            self._fill()
+            if self.rx:
+                c = self.rx[0]
+                del self.rx[0]
+                return c
+            return 0
+        if off == self.LSR:
+            self._fill()
+            return self.THRE | (self.DR if self.rx else 0)
+        return 0
+
+    def write(self, off: int, val: int, n: int):
+        if off == self.THR:
+            self.tx.append(val & 0xFF)
+            if len(self.tx) >= self.limit:
+                self.flush()
+
+    def flush(self):
+        if self.tx:
+            self.out.write(bytes(self.tx))
+            self.out.flush()
+            self.tx.clear()
+
+    def receiving(self) -> bool:
+        return self.inp is not None
+
+
+class CLINT(Device):
+    """Core local interruptor with the machine timer.
+
+    mtime counts at freq ticks per second of the given clock, by default the
+    host's monotonic clock. A processor counting its own time passes a
+    function returning the current tick instead.
+
+    :param clock: Function returning the current tick.
+    :param freq: Ticks per second of the default clock.
+    """
+
+    size = 0x10000
+    MSIP, MTIMECMP, MTIME = 0x0, 0x4000, 0xBFF8
+
+    def __init__(self, clock=None, freq: int = 10_000_000):
+        # The host clock runs on while the processor idles, others only
+        # with the instructions it runs.
+        self.realtime = clock is None
+        if clock is None:
+            t0 = time.perf_counter_ns()
+            clock = lambda: (time.perf_counter_ns() - t0) * freq // 1_000_000_000
+        self.clock, self.freq = clock, freq
+        # Offset of mtime to the clock, moved by guest writes to mtime.
+        self.offset = 0
+        self.msip = 0
+        self.mtimecmp = (1 << 64) - 1
+
+    @property
+    def mtime(self) -> int:
+        return (self.clock() + self.offset) & ((1 << 64) - 1)
+
+    def pending(self) -> bool:
+        """Returns whether the timer interrupt is pending."""
+        return self.mtime >= self.mtimecmp
+
+    def deadline(self) -> int:
+        """Returns the ticks until the timer fires, None if pending or unset."""
+        if self.mtimecmp == (1 << 64) - 1 or self.pending():
+            return None
+        return self.mtimecmp - self.mtime
+
+    def read(self, off: int, n: int) -> int:
+        for reg, val in (
+            (self.MTIME, self.mtime),
+            (self.MTIMECMP, self.mtimecmp),
+            (self.MSIP, self.msip),
+        ):
+            if reg <= off < reg + 8:
+                return (val >> (8 * (off - reg))) & ((1 << (8 * n)) - 1)
+        return 0
+
+    def write(self, off: int, val: int, n: int):
+        def merge(old, reg):
+            s, m = 8 * (off - reg), (1 << (8 * n)) - 1
+            return (old & ~(m << s)) | ((val & m) << s)
+
+        if self.MTIME <= off < self.MTIME + 8:
+            self.offset += merge(self.mtime, self.MTIME) - self.mtime
+        elif self.MTIMECMP <= off < self.MTIMECMP + 8:
+            self.mtimecmp = merge(self.mtimecmp, self.MTIMECMP)
+        elif self.MSIP <= off < self.MSIP + 4:
+            self.msip = val & 1
+
+
+class Finisher(Device):
+    """SiFive test finisher, stops the processor on writes.
+
+    0x5555 passes, 0x3333 fails with the exit code in the upper half.
+    """
+
+    PASS, FAIL = 0x5555, 0x3333
+
+    def write(self, off: int, val: int, n: int):
+        if val & 0xFFFF == self.PASS:
+            raise Halt(0)
+        if val & 0xFFFF == self.FAIL:
+            raise Halt(val >> 16 or 1)
+
+
+class Bus:
+    """Maps address ranges to devices."""
+
+    def __init__(self):
+        self.devices = []
+
+    def attach(self, base: int, dev: Device, size: int = None):
+        """Maps dev to size (default dev.size) bytes from base."""
+        self.devices.append((base, base + (dev.size if size is None else size), dev))
+        self.devices.sort(key=lambda d: d[0])
+        return dev
+
+    def find(self, addr: int) -> tuple:
+        for base, end, dev in self.devices:
+            if base <= addr < end:
+                return dev, addr - base
+        raise Exception("access out of memory: 0x%x" % addr)
+
+    def read(self, addr: int, n: int) -> int:
+        dev, off = self.find(addr)
+        return dev.read(off, n)
+
+    def write(self, addr: int, val: int, n: int):
+        dev, off = self.find(addr)
+        dev.write(off, val & ((1 << (8 * n)) - 1), n)
+
+    def flush(self):
+        """Writes out the pending output of all devices."""
+        for _, _, dev in self.devices:
+            dev.flush()
+
+    def get(self, kind: type) -> Device:
+        """Returns the first attached device of the given type."""
+        return next((d for _, _, d in self.devices if isinstance(d, kind)), None)
+
+
+def virt(out=None, inp=None, clock=None) -> Bus:
+    """Returns a bus with the devices of the qemu virt machine."""
+    bus = Bus()
+    bus.attach(0x00100000, Finisher())
+    bus.attach(0x02000000, CLINT(clock))
+    bus.attach(0x10000000, UART(out, inp))
+    return bus
@@ -0,0 +1,332 @@
+"""RV32I & ARM32 Disassembler
+
+Turns machine code back into assembly. The mnemonics come from the tables the
+assemblers encode with, riscv.ISA for RISC-V & the enums of arm_asm for ARM,
+& the fields from the decoders of the cpus, so encoding, decoding &
+disassembly can not drift apart.
+
+Whole images are decoded at once, RISC-V ones with the vectorized decoder of
+riscv_cpu, for trace output & listing files:
+
+    $ python disasm.py program.elf
+    $ python disasm.py test/fib.hex --isa arm
+"""
+import argparse
+import struct
+
+import arm_cpu
+import riscv_cpu
+from arm_asm import CONDITION, DATAPROC, OPCODE as ARM, REGISTERS, SHIFT
+from elf import EM_ARM
+from riscv import ABI, CSR, ISA, OPCODE, PSEUDO
+
+#
+# RISC-V
+#
+# Mnemonic of each encoding, keyed like ISA by (opcode, func3, func7).
+NAMES = {tuple(enc): m for m, enc in ISA.items() if m not in PSEUDO}
+CSRS = {n: m for m, n in CSR.items()}
+LUI, AUIPC, JAL, JALR = OPCODE["LUI"], OPCODE["AUIPC"], OPCODE["JAL"], OPCODE["JALR"]
+ALU, OP, SYSTEM, FENCE = OPCODE["ALU"], OPCODE["OP"], OPCODE["SYSTEM"], OPCODE["FENCE"]
+AMO = OPCODE["AMO"]
+UNIMP = 0xC0001073
+
+
+def mnemonic(op: int, func3: int, func7: int, imm: int) -> str:
+    """Looks the mnemonic of the decoded fields up, None if illegal."""
+    if op == SYSTEM and func3 == 0:
+        key = (op, func3, imm & 0xFFF)
+    elif op == OP or (op == ALU and func3 & 0b11 == 0b01):
+        key = (op, func3, func7)
+    elif op == AMO:
+        key = (op, func3, func7 & ~0b11)
+    elif op in (LUI, AUIPC, JAL):
+        key = (op,)
+    else:
+        key = (op, func3)
+    return NAMES.get(key)
+
+
+def riscv(word: int, pc: int = None, pseudo: bool = False, d: tuple = None) -> str:
+    """Disassembles a RISC-V instruction.
+
+    :param word: The instruction.
+    :param pc: Its address, branch & jump targets are offsets without it.
+    :param pseudo: Whether to use pseudo-instructions like li, mv & ret.
+    :param d: The instruction as decoded by riscv_cpu, if already at hand.
+    """
+    _, rd, rs1, rs2, func3, func7, imm = d or riscv_cpu.decode(word)
+    op, r = word & 0x7F, ABI
+    m = mnemonic(op, func3, func7, imm)
+    if m is None or (op == JALR and func3):
+        return ".word 0x%08x" % word
+    target = None
+    if op in (OPCODE["BRANCH"], JAL):
+        target = imm if pc is None else "0x%x" % ((pc + imm) & 0xFFFFFFFF)
+    if pseudo:
+        alias = _alias(word, m, rd, rs1, rs2, imm, target)
+        if alias:
+            return alias
+    if op == OP:
+        return f"{m} {r[rd]},{r[rs1]},{r[rs2]}"
+    if op == ALU:
+        return f"{m} {r[rd]},{r[rs1]},{imm & 31 if func3 & 0b11 == 0b01 else imm}"
+    if op in (OPCODE["LOAD"], JALR):
+        return f"{m} {r[rd]},{imm}({r[rs1]})"
+    if op == OPCODE["STORE"]:
+        return f"{m} {r[rs2]},{imm}({r[rs1]})"
+    if op == OPCODE["BRANCH"]:
+        if pseudo and rs2 == 0 and func3 < 2:
+            return f"{m}z {r[rs1]},{target}"
+        return f"{m} {r[rs1]},{r[rs2]},{target}"
+    if op == JAL:
+        return f"{m} {r[rd]},{target}"
+    if op in (LUI, AUIPC):
+        return f"{m} {r[rd]},0x{(imm >> 12) & 0xFFFFF:x}"
+    if op == AMO:
+        m += "." + "aq" * (func7 >> 1 & 1) + "rl" * (func7 & 1) if func7 & 0b11 else ""
+        if m.startswith("lr.w"):
+            return f"{m} {r[rd]},({r[rs1]})"
+        return f"{m} {r[rd]},{r[rs2]},({r[rs1]})"
+    if op == FENCE:
+        pred, succ = (imm >> 4) & 0xF, imm & 0xF
+        if func3 or pred == succ in (0, 0xF):
+            return m
+        return f"{m} {_fence_set(pred)},{_fence_set(succ)}"
+    if func3 == 0:
+        return m
+    csr = CSRS.get(imm & 0xFFF, "0x%x" % (imm & 0xFFF))
+    return f"{m} {r[rd]},{csr},{rs1 if func3 & 0b100 else r[rs1]}"
+
+
+def _fence_set(bits: int) -> str:
+    return "".join(c for i, c in enumerate("iorw") if bits >> (3 - i) & 1)
+
+
+def _alias(word, m, rd, rs1, rs2, imm, target) -> str:
+    """Returns the pseudo-instruction of an instruction, None if there is none."""
+    r = ABI
+    if word == UNIMP:
+        return "unimp"
+    if m == "addi":
+        if rd == rs1 == imm == 0:
+            return "nop"
+        if rs1 == 0:
+            return f"li {r[rd]},{imm}"
+        if imm == 0:
+            return f"mv {r[rd]},{r[rs1]}"
+    if m == "jalr" and rd == 0 and imm == 0:
+        return "ret" if rs1 == 1 else f"jr {r[rs1]}"
+    if m == "jal" and rd == 0:
+        return f"j {target}"
+    if m == "csrrs" and rs1 == 0:
+        return f"csrr {r[rd]},{CSRS.get(imm & 0xFFF, '0x%x' % (imm & 0xFFF))}"
+    if m == "csrrw" and rd == 0:
+        return f"csrw {CSRS.get(imm & 0xFFF, '0x%x' % (imm & 0xFFF))},{r[rs1]}"
+    return None
+
+
+def riscv_image(data, base: int = 0x80000000, pseudo: bool = False) -> list[str]:
+    """Disassembles all words of a RISC-V image at once.
+
+    :param data: The image, like riscv_cpu.memory.
+    :param base: Address of its first byte.
+    """
+    n = len(data) >> 2
+    words = struct.unpack_from("<%dI" % n, data)
+    decoded = riscv_cpu.decode_all(data, 0, n)
+    return [
+        riscv(w, base + 4 * i, pseudo, d)
+        for i, (w, d) in enumerate(zip(words, decoded))
+    ]
+
+
+#
+# ARM
+#
+COND = {c.value: c.name.lower() for c in CONDITION}
+COND[CONDITION.AL.value] = ""
+REG = [REGISTERS(i).name for i in range(16)]
+SHIFTS = [s.name.lower() for s in SHIFT] + ["rrx"]
+# Addressing modes of LDM & STM by (p, u).
+MODES = {(0, 1): "", (1, 1): "ib", (0, 0): "da", (1, 0): "db"}
+
+
+def _shifted(rm: int, typ: int, amt: int) -> str:
+    """Formats a register operand shifted by an immediate as decoded."""
+    if typ == 4:
+        return f"{REG[rm]}, rrx"
+    if amt == 0:
+        return REG[rm]
+    return f"{REG[rm]}, {SHIFTS[typ]} #{amt}"
+
+
+def _dataproc(c, op, s, rn, rd, op2) -> str:
+    name = DATAPROC(op).name.lower()
+    if op & 0b1100 == 0b1000:
+        # TST, TEQ, CMP & CMN always set the flags.
+        return f"{name}{c}\t{REG[rn]}, {op2}"
+    s = "s" if s else ""
+    if op in (DATAPROC.MOV.value, DATAPROC.MVN.value):
+        return f"{name}{s}{c}\t{REG[rd]}, {op2}"
+    return f"{name}{s}{c}\t{REG[rd]}, {REG[rn]}, {op2}"
+
+
+def _transfer(c, l, size, sign, p, u, w, rn, rd, off) -> str:
+    name = (ARM.LDR if l else ARM.STR).value
+    name += ("s" if sign else "") + {1: "b", 2: "h", 4: ""}[size]
+    if not u:
+        off = "#-" + off[1:] if off[0] == "#" else "-" + off
+    if not p:
+        addr = f"[{REG[rn]}], {off}"
+    elif off == "#0":
+        addr = f"[{REG[rn]}]"
+    else:
+        addr = f"[{REG[rn]}, {off}]" + ("!" if w else "")
+    return f"{name}{c}\t{REG[rd]}, {addr}"
+
+
+def arm(word: int, pc: int = 0) -> str:
+    """Disassembles an ARM instruction in the unified syntax of gcc.
+
+    :param word: The instruction.
+    :param pc: Its address, for the targets of branches & literal loads.
+    """
+    try:
+        h, cond, args = arm_cpu.decode(word)
+    except RuntimeError:
+        return ".word 0x%08x" % word
+    c = COND[cond]
+    if h is arm_cpu._dp_imm:
+        op, s, rn, rd, imm, rot = args
+        return _dataproc(c, op, s, rn, rd, f"#{imm}")
+    if h is arm_cpu._dp_reg or h is arm_cpu._dp_rsr:
+        op, s, rn, rd, rm, typ, amt = args
+        rsr = h is arm_cpu._dp_rsr
+        if op == DATAPROC.MOV.value and (rsr or typ == 4 or amt):
+            # A shifted mov is written as the shift.
+            s = "s" if s else ""
+            if typ == 4:
+                return f"rrx{s}{c}\t{REG[rd]}, {REG[rm]}"
+            amt = REG[amt] if rsr else f"#{amt}"
+            return f"{SHIFTS[typ]}{s}{c}\t{REG[rd]}, {REG[rm]}, {amt}"
+        op2 = f"{REG[rm]}, {SHIFTS[typ]} {REG[amt]}" if rsr else _shifted(rm, typ, amt)
+        return _dataproc(c, op, s, rn, rd, op2)
+    if h is arm_cpu._mul:
+        s, acc, rd, rn, rs, rm = args
+        s = "s" if s else ""
+        if acc:
+            return f"mla{s}{c}\t{REG[rd]}, {REG[rm]}, {REG[rs]}, {REG[rn]}"
+        return f"{ARM.MUL.value}{s}{c}\t{REG[rd]}, {REG[rm]}, {REG[rs]}"
+    if h is arm_cpu._mull:
+        s, sign, acc, hi, lo, rs, rm = args
+        name = ("s" if sign else "u") + ("mlal" if acc else "mull") + ("s" if s else "")
+        return f"{name}{c}\t{REG[lo]}, {REG[hi]}, {REG[rm]}, {REG[rs]}"
+    if h is arm_cpu._ldst_imm:
+        l, size, sign, p, u, w, rn, rd, imm = args
+        text = _transfer(c, l, size, sign, p, u, w, rn, rd, f"#{imm}")
+        if rn == 15 and p and not w:
+            # Literal loads, pc reads as the address + 8.
+            text += "\t@ 0x%x" % ((pc + 8 + (imm if u else -imm)) & 0xFFFFFFFF)
+        return text
+    if h is arm_cpu._ldst_reg:
+        l, size, sign, p, u, w, rn, rd, rm, typ, amt = args
+        off = _shifted(rm, typ, amt)
+        return _transfer(c, l, size, sign, p, u, w, rn, rd, off)
+    if h is arm_cpu._block:
+        l, p, u, w, rn, regs = args
+        regs = "{" + ", ".join(REG[r] for r in regs) + "}"
+        if rn == 13 and w and (p, u) == ((0, 1) if l else (1, 0)):
+            return f"{(ARM.POP if l else ARM.PUSH).value}{c}\t{regs}"
+        name = (ARM.LDM if l else ARM.STM).value + MODES[(p, u)]
+        return f"{name}{c}\t{REG[rn]}{'!' if w else ''}, {regs}"
+    if h is arm_cpu._branch:
+        link, off = args
+        name = (ARM.BL if link else ARM.B).value
+        return f"{name}{c}\t0x{(pc + 8 + off) & 0xFFFFFFFF:x}"
+    if h is arm_cpu._bx:
+        return f"{ARM.BX.value}{c}\t{REG[args[0]]}"
+    if h is arm_cpu._mrs:
+        return f"mrs{c}\t{REG[args[0]]}, {REGISTERS.cpsr.name}"
+    if h is arm_cpu._msr:
+        val, rm = args
+        src = f"#{val}" if rm is None else REG[rm]
+        return f"msr{c}\t{REGISTERS.cpsr.name}_f, {src}"
+    return f"{ARM.SVC.value}{c}\t0x{args[0]:08x}"
+
+
+def arm_image(data, base: int = 0) -> list[str]:
+    """Disassembles all words of an ARM image.
+
+    :param data: The image, like arm_cpu.memory.
+    :param base: Address of its first byte.
+    """
+    words = struct.unpack_from("<%dI" % (len(data) >> 2), data)
+    return [arm(w, base + 4 * i) for i, w in enumerate(words)]
+
+
+#
+# Listing
+#
+def disasm(data, base: int, isa: str = "riscv", pseudo: bool = False) -> list[str]:
+    """Disassembles an image of either ISA."""
+    if isa == "arm":
+        return arm_image(data, base)
+    return riscv_image(data, base, pseudo)
+
+
+def listing(data, base: int, isa: str = "riscv", pseudo: bool = False) -> str:
+    """Returns the address, word & assembly of each instruction of an image."""
+    words = struct.unpack_from("<%dI" % (len(data) >> 2), data)
+    return "\n".join(
+        "%8x:\t%08x\t%s" % (base + 4 * i, w, text)
+        for i, (w, text) in enumerate(zip(words, disasm(data, base, isa, pseudo)))
+    )
+
+
+def read_image(fn: str) -> tuple:
+    """Reads the .text of an ELF file or a hex file, one word per line.
+
+    :returns: The bytes, their address, None for hex files, & the ISA of an
+        ELF file, None for hex files.
+    """
+    with open(fn, "rb") as f:
+        if f.read(4) == b"\x7fELF":
+            from elftools.elf.elffile import ELFFile
+
+            f.seek(0)
+            elf = ELFFile(f)
+            text = elf.get_section_by_name(".text")
+            isa = "arm" if elf.header.e_machine in ("EM_ARM", EM_ARM) else "riscv"
+            return text.data(), text["sh_addr"], isa
+    words = []
+    with open(fn, "r") as f:
+        for line in f:
+            w = line.strip()
+            if w:
+                # Placeholders of the test images, like '*', read as zero.
+                words.append(int(w, 16) if w.isalnum() else 0)
+    return struct.pack("<%dI" % len(words), *words), None, None
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("files", nargs="+", help="ELF or hex files")
+    p.add_argument("--isa", choices=["riscv", "arm"], help="ISA of hex files")
+    p.add_argument("--base", type=lambda x: int(x, 0), help="address of hex files")
+    p.add_argument(
+        "--no-aliases", action="store_true", help="no RISC-V pseudo-instructions"
+    )
+    a = p.parse_args()
+
+    for x in a.files:
+        data, base, isa = read_image(x)
+        isa = isa or a.isa or "riscv"
+        if base is None:
+            base = a.base if a.base is not None else 0x80000000 * (isa == "riscv")
+        print(f"{x}:\n")
+        print(listing(data, base, isa, not a.no_aliases) + "\n")
+
+
+if __name__ == "__main__":
+    main()
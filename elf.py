@@ -1,17 +1,22 @@
-"""ELF Reader"""
+"""ELF Reader & Writer"""
 import binascii
-from elftools.elf.elffile import ELFFile
+import struct
 
+# e_machine values of the supported instruction sets.
+EM_ARM = 40
+EM_RISCV = 243
 
-def write_to_mem(memory, data, addr):
+
+def write_to_mem(memory, data, addr, base: int = 0x80000000):
     """Reads opscode from elf segment & bumps it to memory.
 
     :param memory:
     :param data:
     :param addr:
+    :param base: Physical address mapped to the start of memory.
     """
     if addr != 0:
-        addr -= 0x80000000
+        addr -= base
     assert addr < len(memory)
     memory = memory[:addr] + data + memory[addr + len(data) :]
 
@@ -28,14 +33,233 @@ def dump_to_file(x, mem, dirs: str = "test-riscv/%s"):
         )
 
 
-def elf_reader(memory, file: str, to_file: bool = False):
+def elf_reader(memory, file: str, to_file: bool = False, base: int = 0x80000000):
     """Reads in an elf file format and returns opscode."""
+    # pyelftools is only imported once an ELF file is read.
+    from elftools.elf.elffile import ELFFile
+
     if not file.endswith(".dump"):
         with open(file, "rb") as f:
             elf = ELFFile(f)
             for s in elf.iter_segments(type="PT_LOAD"):
-                memory = write_to_mem(memory, s.data(), s.header.p_paddr)
+                memory = write_to_mem(memory, s.data(), s.header.p_paddr, base)
 
             if to_file:
                 dump_to_file(file, memory)
     return memory
+
+
+def elf_symbol(file: str, name: str) -> int:
+    """Returns the address of a symbol in an elf file, None if undefined."""
+    from elftools.elf.elffile import ELFFile
+
+    with open(file, "rb") as f:
+        symtab = ELFFile(f).get_section_by_name(".symtab")
+        syms = symtab.get_symbol_by_name(name) if symtab else None
+        return syms[0]["st_value"] if syms else None
+
+
+def elf_code(file: str) -> list[tuple]:
+    """Returns the (address, size) of each executable PT_LOAD segment."""
+    from elftools.elf.elffile import ELFFile
+
+    with open(file, "rb") as f:
+        return [
+            (s.header.p_paddr, s.header.p_filesz)
+            for s in ELFFile(f).iter_segments(type="PT_LOAD")
+            if s.header.p_flags & 1
+        ]
+
+
+def align(val: int, n: int) -> int:
+    """Rounds val up to the next multiple of n."""
+    return (val + n - 1) & -n
+
+
+def pack_data(words: list[str], off: int = 0, symbols: dict = None) -> bytes:
+    """Returns the bytes emitted by a data directive like .word or .string.
+
+    :param words: Tokenized directive, e.g. ['.word', '1', '2'].
+    :param off: Current offset in the section, used by .align.
+    :param symbols: Known label addresses a .word may refer to.
+    :raises: ValueError if a .word refers to a label which is not known.
+    """
+    d, args = words[0], words[1:]
+    if d in (".word", ".long", ".4byte"):
+        out = b""
+        for a in args:
+            try:
+                val = int(a, 0)
+            except ValueError:
+                # There are no relocations, see pack_fixup for labels.
+                if a not in (symbols or {}):
+                    raise ValueError(f"{d} {a}: unresolved symbol") from None
+                val = symbols[a]
+            out += struct.pack("<I", val & 0xFFFFFFFF)
+        return out
+    if d in (".half", ".short", ".2byte"):
+        return b"".join(struct.pack("<H", int(a, 0) & 0xFFFF) for a in args)
+    if d == ".byte":
+        return bytes(int(a, 0) & 0xFF for a in args)
+    if d in (".string", ".asciz", ".ascii"):
+        s = " ".join(args).strip('"').encode("latin-1").decode("unicode_escape")
+        return s.encode("latin-1") + (b"" if d == ".ascii" else b"\x00")
+    if d in (".zero", ".space", ".skip"):
+        return b"\x00" * int(args[0], 0)
+    if d in (".align", ".p2align"):
+        return b"\x00" * (align(off, 1 << int(args[0], 0)) - off)
+    if d == ".balign":
+        return b"\x00" * (align(off, int(args[0], 0)) - off)
+    return b""
+
+
+def pack_fixup(words: list[str], off: int, fixups: list) -> bytes:
+    """Like pack_data, but a directive referring to labels is packed as zeros.
+
+    The directive & its offset are appended to fixups, resolve_data patches
+    them once the addresses of the labels are known.
+    """
+    try:
+        return pack_data(words, off)
+    except ValueError:
+        fixups.append((off, words))
+        return pack_data(words[:1] + ["0"] * (len(words) - 1), off)
+
+
+def resolve_data(data: bytes, fixups: list, symbols: dict, addrs: dict) -> bytes:
+    """Patches the directives recorded by pack_fixup with the label addresses.
+
+    :param symbols: Labels as a mapping of name to (section, offset).
+    :param addrs: Start address of each section, see elf_layout.
+    :raises: ValueError if a label is not defined.
+    """
+    data, known = bytearray(data), {n: addrs[s] + o for n, (s, o) in symbols.items()}
+    for off, words in fixups:
+        val = pack_data(words, off, known)
+        data[off : off + len(val)] = val
+    return bytes(data)
+
+
+def elf_layout(ntext: int, ndata: int = 0, base: int = 0x80000000) -> dict:
+    """Returns the start addresses of .text, .data & .bss as written by elf_writer.
+
+    :param ntext: Size of .text in bytes.
+    :param ndata: Size of .data in bytes.
+    :param base: Load address of .text.
+    """
+    page = 0x1000
+    addrs = {".text": base}
+    addrs[".data"] = align(base + ntext, page) + (page + align(ntext, 16)) % page
+    addrs[".bss"] = align(addrs[".data"] + ndata, 4)
+    return addrs
+
+
+def elf_writer(
+    file: str,
+    text: bytes,
+    data: bytes = b"",
+    bss: int = 0,
+    symbols: dict = None,
+    globl: set = frozenset(),
+    machine: int = EM_RISCV,
+    base: int = 0x80000000,
+    entry: int = None,
+):
+    """Writes an ELF32 little-endian executable.
+
+    The .text section is loaded at base, .data & .bss follow on the next page.
+    Symbols are given as a mapping of name to (section, offset) where section
+    is one of '.text', '.data' or '.bss'.
+
+    :param file: Path of the output file.
+    :param text: Machine code of the .text section.
+    :param data: Initialized contents of the .data section.
+    :param bss: Size of the zero initialized .bss section.
+    :param symbols: Labels to be written to the symbol table.
+    :param globl: Names of the symbols with global binding.
+    :param machine: ELF e_machine, EM_RISCV or EM_ARM.
+    :param base: Virtual & physical load address of .text.
+    :param entry: Entry point, defaults to base.
+    :returns: The start addresses of .text, .data & .bss.
+    """
+    page, ehsize, phentsize, shentsize = 0x1000, 52, 32, 40
+    data_off = page + align(len(text), 16)
+    addrs = elf_layout(len(text), len(data), base)
+
+    # String tables & symbol table, local symbols have to come first.
+    shstrtab = b"\x00.text\x00.data\x00.bss\x00.symtab\x00.strtab\x00.shstrtab\x00"
+    shname = {
+        n: shstrtab.index(n.encode() + b"\x00")
+        for n in (".text", ".data", ".bss", ".symtab", ".strtab", ".shstrtab")
+    }
+    shndx = {".text": 1, ".data": 2, ".bss": 3}
+    syms = sorted((symbols or {}).items(), key=lambda s: (s[0] in globl, s[1][1]))
+    strtab, symtab, nlocal = b"\x00", struct.pack("<IIIBBH", 0, 0, 0, 0, 0, 0), 1
+    for name, (sec, off) in syms:
+        bind = 1 if name in globl else 0
+        typ = 0 if not bind else 2 if sec == ".text" else 1
+        nlocal += 1 - bind
+        symtab += struct.pack(
+            "<IIIBBH",
+            len(strtab),
+            addrs[sec] + off,
+            0,
+            (bind << 4) | typ,
+            0,
+            shndx[sec],
+        )
+        strtab += name.encode() + b"\x00"
+
+    symtab_off = align(data_off + len(data), 4)
+    strtab_off = symtab_off + len(symtab)
+    shstrtab_off = strtab_off + len(strtab)
+    shoff = align(shstrtab_off + len(shstrtab), 4)
+
+    phdrs = [(1, page, base, base, len(text), len(text), 5, page)]
+    if data or bss:
+        size = addrs[".bss"] + bss - addrs[".data"]
+        phdrs.append(
+            (1, data_off, addrs[".data"], addrs[".data"], len(data), size, 6, page)
+        )
+
+    ident = b"\x7fELF" + bytes([1, 1, 1, 0]) + b"\x00" * 8
+    header = ident + struct.pack(
+        "<HHIIIIIHHHHHH",
+        2,  # ET_EXEC
+        machine,
+        1,
+        base if entry is None else entry,
+        ehsize,
+        shoff,
+        0x5000000 if machine == EM_ARM else 0,
+        ehsize,
+        phentsize,
+        len(phdrs),
+        shentsize,
+        7,
+        6,
+    )
+
+    shdrs = [
+        (0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        (shname[".text"], 1, 6, base, page, len(text), 0, 0, 4, 0),
+        (shname[".data"], 1, 3, addrs[".data"], data_off, len(data), 0, 0, 4, 0),
+        (shname[".bss"], 8, 3, addrs[".bss"], symtab_off, bss, 0, 0, 4, 0),
+        (shname[".symtab"], 2, 0, 0, symtab_off, len(symtab), 5, nlocal, 4, 16),
+        (shname[".strtab"], 3, 0, 0, strtab_off, len(strtab), 0, 0, 1, 0),
+        (shname[".shstrtab"], 3, 0, 0, shstrtab_off, len(shstrtab), 0, 0, 1, 0),
+    ]
+
+    out = bytearray(header)
+    for p in phdrs:
+        out += struct.pack("<IIIIIIII", *p)
+    out += b"\x00" * (page - len(out)) + text
+    out += b"\x00" * (data_off - len(out)) + data
+    out += b"\x00" * (symtab_off - len(out)) + symtab + strtab + shstrtab
+    out += b"\x00" * (shoff - len(out))
+    for s in shdrs:
+        out += struct.pack("<IIIIIIIIII", *s)
+
+    with open(file, "wb") as f:
+        f.write(out)
+    return addrs
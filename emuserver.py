@@ -0,0 +1,277 @@
+"""Warm Emulator Service
+
+Runs riscv_cpu jobs in a pool of worker processes behind an asyncio server on
+a Unix socket, so many tiny runs don't each pay for interpreter startup,
+imports & ELF parsing. Each worker keeps the images it loaded, predecoded,
+& restores them for the next job on the same image.
+
+Jobs & results are JSON lines. A connection may send any number of jobs, the
+result of each is written back as soon as it finished, tagged with its id:
+
+    {"id": 1, "image": "program.elf", "limit": 100000, "outputs": ["uart"]}
+    {"id": 1, "status": "halted", "instret": 5120, "cached": true, ...}
+
+    $ python emuserver.py serve -j 8
+    $ python emuserver.py run program.elf test.elf --outputs registers uart
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import riscv_cpu
+from devices import virt
+
+SOCKET = os.path.join(tempfile.gettempdir(), "morphgen-emu.sock")
+# Results a job may ask for besides status, instret & seconds.
+OUTPUTS = ("registers", "uart", "log", "fusions")
+# Images each worker keeps, the least recently used are dropped.
+CACHE_SIZE = 64
+LIMIT = 10_000_000
+
+# A loaded & predecoded image, restored instead of loading it again.
+Image = namedtuple(
+    "Image", ["memory", "entry", "tohost", "decoded", "unfused", "fused_by"]
+)
+images = OrderedDict()
+
+
+#
+# Workers
+#
+def warm():
+    """Imports what the first job would, run once per worker."""
+    from elftools.elf.elffile import ELFFile  # noqa: F401
+
+
+def image_key(job: dict) -> tuple:
+    """Returns the cache key of the image of a job.
+
+    Files are keyed by path, modification time & size, inline binaries by a
+    hash of their bytes.
+    """
+    if "binary" in job:
+        return ("binary", hashlib.sha256(job["binary"].encode()).hexdigest())
+    st = os.stat(job["image"])
+    return (os.path.realpath(job["image"]), st.st_mtime_ns, st.st_size)
+
+
+def load(job: dict) -> bool:
+    """Loads the image of a job into riscv_cpu, returns whether it was cached.
+
+    :param job: "image", the path of an ELF file, or "binary", a base64 flat
+        binary run from 0x80000000.
+    """
+    key = image_key(job)
+    img = images.pop(key, None)
+    if img is None:
+        if "binary" in job:
+            data = base64.b64decode(job["binary"])
+            riscv_cpu.reset()
+            riscv_cpu.memory[: len(data)] = data
+            riscv_cpu.predecode(0x80000000, len(data))
+            riscv_cpu.registers[riscv_cpu.PC] = 0x80000000
+        else:
+            riscv_cpu.load_elf(job["image"])
+        img = Image(
+            bytes(riscv_cpu.memory),
+            riscv_cpu.registers[riscv_cpu.PC],
+            riscv_cpu.tohost,
+            dict(riscv_cpu.decoded),
+            dict(riscv_cpu.unfused),
+            dict(riscv_cpu.fused_by),
+        )
+        cached = False
+    else:
+        riscv_cpu.reset()
+        riscv_cpu.memory = bytearray(img.memory)
+        riscv_cpu.tohost = img.tohost
+        riscv_cpu.decoded = dict(img.decoded)
+        riscv_cpu.unfused = dict(img.unfused)
+        riscv_cpu.fused_by = dict(img.fused_by)
+        riscv_cpu.registers[riscv_cpu.PC] = img.entry
+        cached = True
+    images[key] = img
+    while len(images) > CACHE_SIZE:
+        images.popitem(last=False)
+    return cached
+
+
+def execute(job: dict) -> dict:
+    """Runs a single job, returns its result.
+
+    :param job: The image, "limit" instructions, "stdin" text for the UART &
+        the "outputs" of OUTPUTS to return.
+    """
+    res = {"id": job.get("id")}
+    start = time.perf_counter()
+    uart, log = io.BytesIO(), io.StringIO()
+    try:
+        res["cached"] = load(job)
+        inp = io.BytesIO(job.get("stdin", "").encode())
+        riscv_cpu.bus = virt(uart, inp, clock=lambda: riscv_cpu.instret)
+        limit = job.get("limit", LIMIT)
+        with contextlib.redirect_stdout(log):
+            n = riscv_cpu.run(limit)
+        res["status"] = "halted" if n < limit else "limit"
+    except Exception as e:
+        res.update(status="error", error=f"{type(e).__name__}: {e}")
+    riscv_cpu.bus.flush()
+    res["instret"] = riscv_cpu.instret
+    res["seconds"] = time.perf_counter() - start
+    outputs = job.get("outputs", ["uart"])
+    if "registers" in outputs:
+        res["registers"] = riscv_cpu.registers.registers[:]
+    if "uart" in outputs:
+        res["uart"] = uart.getvalue().decode("latin-1")
+    if "log" in outputs:
+        res["log"] = log.getvalue()
+    if "fusions" in outputs:
+        res["fusions"] = riscv_cpu.fusions
+    return res
+
+
+#
+# Server
+#
+class Server:
+    """Hands the jobs of all connections to a pool of warm workers.
+
+    :param workers: Number of worker processes, defaults to the cpu count.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or os.cpu_count()
+        self.pool = self._pool()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(self.workers, initializer=warm)
+        # Start all workers now, not on the first jobs.
+        for _ in range(self.workers):
+            pool.submit(warm)
+        return pool
+
+    async def run(self, job: dict) -> dict:
+        pool = self.pool
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, execute, job)
+        except BrokenProcessPool:
+            # A worker died, the jobs running on it are lost. All of them fail
+            # with the pool, only the first one replaces it.
+            if self.pool is pool:
+                self.pool = self._pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+            return {"id": job.get("id"), "status": "error", "error": "worker died"}
+
+    async def reply(self, job: dict, writer: asyncio.StreamWriter):
+        res = await self.run(job)
+        writer.write(json.dumps(res).encode() + b"\n")
+        await writer.drain()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves a connection until the client stops sending jobs."""
+        tasks = set()
+        while line := await reader.readline():
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                job = {"error": str(e)}
+            if "error" in job or not ("image" in job or "binary" in job):
+                res = {"id": job.get("id"), "status": "error"}
+                res["error"] = job.get("error", "no image")
+                writer.write(json.dumps(res).encode() + b"\n")
+                continue
+            t = asyncio.create_task(self.reply(job, writer))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        writer.close()
+
+    async def start(self, path: str = SOCKET) -> asyncio.AbstractServer:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        return await asyncio.start_unix_server(self.handle, path, limit=1 << 24)
+
+    async def serve(self, path: str = SOCKET):
+        srv = await self.start(path)
+        print(f"Serving {self.workers} workers on {path}")
+        async with srv:
+            await srv.serve_forever()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+
+#
+# Client
+#
+def submit(jobs: list[dict], path: str = SOCKET) -> list[dict]:
+    """Sends jobs over one connection & returns the results in job order.
+
+    Jobs without id are numbered.
+    """
+    jobs = [dict(j, id=j.get("id", i)) for i, j in enumerate(jobs)]
+    with socket.socket(socket.AF_UNIX) as s:
+        s.connect(path)
+        s.sendall(b"".join(json.dumps(j).encode() + b"\n" for j in jobs))
+        s.shutdown(socket.SHUT_WR)
+        with s.makefile("rb") as f:
+            results = {}
+            for line in f:
+                res = json.loads(line)
+                results[res["id"]] = res
+    return [results.get(j["id"]) for j in jobs]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--socket", default=SOCKET, help="path of the Unix socket")
+    cmd = p.add_subparsers(dest="cmd", required=True)
+    s = cmd.add_parser("serve", help="start the service")
+    s.add_argument("-j", "--workers", type=int, default=None)
+    r = cmd.add_parser("run", help="run images on the service")
+    r.add_argument("images", nargs="+", help="ELF files")
+    r.add_argument("--limit", type=int, default=LIMIT, help="instructions")
+    r.add_argument("--outputs", nargs="*", choices=OUTPUTS, default=["uart"])
+    a = p.parse_args()
+
+    if a.cmd == "serve":
+        server = Server(a.workers)
+        try:
+            asyncio.run(server.serve(a.socket))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return
+    start = time.perf_counter()
+    jobs = [{"image": fn, "limit": a.limit, "outputs": a.outputs} for fn in a.images]
+    results = submit(jobs, a.socket)
+    for fn, res in zip(a.images, results):
+        print(f"  {res['status']:7} {res.get('instret', '-'):>10} instructions  {fn}")
+        if "error" in res:
+            print(f"    {res['error']}")
+        for k in a.outputs:
+            print(f"    {k}: {res[k]}")
+    failed = sum(res["status"] == "error" for res in results)
+    print(
+        f"{len(results) - failed} of {len(results)} jobs ran "
+        f"in {time.perf_counter() - start:.2f}s."
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+"""Differential RV32I Fuzzer
+
+Generates random RV32I programs, runs them in riscv_cpu & in a reference
+(qemu-riscv32 when it is available, otherwise the independent Python model
+below) and compares the final registers & data memory. Failing programs are
+shrunk to a minimal one. Every instruction is round-tripped through the
+disassembler & the ones riscv_asm supports through the assembler as well.
+
+    $ python fuzz.py --seeds 1000 --length 500
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+from elf import elf_layout, elf_writer
+from riscv import ABI, OPCODE
+
+BASE = 0x80000000
+# Register holding the address of the data window, never written.
+DP = 27
+# Size of the data window & of the register dump in front of it.
+WINDOW, DUMP = 512, 128
+UNIMP = 0xC0001073
+NOP = 0x00000013
+
+
+#
+# Encoder
+#
+def enc_r(op, rd, f3, rs1, rs2, f7=0) -> int:
+    return (f7 << 25) | (rs2 << 20) | (rs1 << 15) | (f3 << 12) | (rd << 7) | op
+
+
+def enc_i(op, rd, f3, rs1, imm) -> int:
+    return ((imm & 0xFFF) << 20) | (rs1 << 15) | (f3 << 12) | (rd << 7) | op
+
+
+def enc_s(op, f3, rs1, rs2, imm) -> int:
+    return (
+        (((imm >> 5) & 0x7F) << 25)
+        | (rs2 << 20)
+        | (rs1 << 15)
+        | (f3 << 12)
+        | ((imm & 0x1F) << 7)
+        | op
+    )
+
+
+def enc_b(op, f3, rs1, rs2, imm) -> int:
+    return (
+        (((imm >> 12) & 1) << 31)
+        | (((imm >> 5) & 0x3F) << 25)
+        | (rs2 << 20)
+        | (rs1 << 15)
+        | (f3 << 12)
+        | (((imm >> 1) & 0xF) << 8)
+        | (((imm >> 11) & 1) << 7)
+        | op
+    )
+
+
+def enc_u(op, rd, imm) -> int:
+    return (imm & 0xFFFFF000) | (rd << 7) | op
+
+
+def enc_j(op, rd, imm) -> int:
+    return (
+        (((imm >> 20) & 1) << 31)
+        | (((imm >> 1) & 0x3FF) << 21)
+        | (((imm >> 11) & 1) << 20)
+        | (((imm >> 12) & 0xFF) << 12)
+        | (rd << 7)
+        | op
+    )
+
+
+def enc_li(rd: int, val: int) -> list[int]:
+    """lui & addi loading a 32 bit constant."""
+    lo = ((val & 0xFFF) ^ 0x800) - 0x800
+    return [
+        enc_u(OPCODE["LUI"], rd, (val - lo) & 0xFFFFFFFF),
+        enc_i(OPCODE["ALU"], rd, 0b000, rd, lo),
+    ]
+
+
+ALU = ["addi", "slli", "slti", "sltiu", "xori", "srli", "ori", "andi", "srai"]
+OP = {"add": 0, "sub": 0, "sll": 1, "slt": 2, "sltu": 3, "xor": 4, "srl": 5}
+OP.update({"sra": 5, "or": 6, "and": 7})
+LOADS = {"lb": (0b000, 1), "lh": (0b001, 2), "lw": (0b010, 4), "lbu": (0b100, 1)}
+LOADS["lhu"] = (0b101, 2)
+STORES = {"sb": (0b000, 1), "sh": (0b001, 2), "sw": (0b010, 4)}
+BRANCHES = {"beq": 0, "bne": 1, "blt": 4, "bge": 5, "bltu": 6, "bgeu": 7}
+# Mnemonics riscv_asm encodes from text.
+ASM = {"addi", "add", "sub", "lb", "lh", "lw", "sb", "sh", "sw"}
+
+
+def gen_ins(rnd: random.Random) -> tuple:
+    """Returns a random instruction as (words, asm).
+
+    Branches & jumps return a function of their byte offset instead of the
+    words, the offset is only known once the whole body is generated.
+    """
+    rd = rnd.choice([r for r in range(32) if r != DP])
+    rs1, rs2 = rnd.randrange(32), rnd.randrange(32)
+    r, kind = ABI, rnd.random()
+    if kind < 0.3:
+        m = rnd.choice(ALU)
+        f3 = ALU.index(m) if m != "srai" else 0b101
+        if m in ("slli", "srli", "srai"):
+            imm = rnd.randrange(32) | (0x400 if m == "srai" else 0)
+            asm = f"{m} {r[rd]},{r[rs1]},{imm & 31}"
+        else:
+            imm = rnd.randrange(-2048, 2048)
+            asm = f"{m} {r[rd]},{r[rs1]},{imm}"
+        return [enc_i(OPCODE["ALU"], rd, f3, rs1, imm)], asm
+    if kind < 0.55:
+        m = rnd.choice(list(OP))
+        f7 = 0b0100000 if m in ("sub", "sra") else 0
+        ins = enc_r(OPCODE["OP"], rd, OP[m], rs1, rs2, f7)
+        return [ins], f"{m} {r[rd]},{r[rs1]},{r[rs2]}"
+    if kind < 0.65:
+        m = rnd.choice(list(LOADS))
+        f3, w = LOADS[m]
+        off = rnd.randrange(0, WINDOW, w)
+        ins = enc_i(OPCODE["LOAD"], rd, f3, DP, off)
+        return [ins], f"{m} {r[rd]},{off}({r[DP]})"
+    if kind < 0.75:
+        m = rnd.choice(list(STORES))
+        f3, w = STORES[m]
+        off = rnd.randrange(0, WINDOW, w)
+        ins = enc_s(OPCODE["STORE"], f3, DP, rs2, off)
+        return [ins], f"{m} {r[rs2]},{off}({r[DP]})"
+    if kind < 0.8:
+        op = rnd.choice(["LUI", "AUIPC"])
+        imm = rnd.getrandbits(20) << 12
+        return [enc_u(OPCODE[op], rd, imm)], f"{op.lower()} {r[rd]},0x{imm >> 12:x}"
+    if kind < 0.9:
+        m = rnd.choice(list(BRANCHES))
+        return (
+            lambda off: (
+                [enc_b(OPCODE["BRANCH"], BRANCHES[m], rs1, rs2, off)],
+                f"{m} {r[rs1]},{r[rs2]},{off}",
+            ),
+            None,
+        )
+    if kind < 0.95:
+        return lambda off: ([enc_j(OPCODE["JAL"], rd, off)], f"jal {r[rd]},{off}"), None
+    if kind < 0.98:
+        # auipc & jalr jumping over the next word of the pair.
+        t = rnd.choice([x for x in range(1, 32) if x != DP])
+        return [
+            enc_u(OPCODE["AUIPC"], t, 0),
+            enc_i(OPCODE["JALR"], rd, 0b000, t, 8),
+        ], f"auipc {r[t]},0x0; jalr {r[rd]},8({r[t]})"
+    return [enc_i(OPCODE["FENCE"], 0, 0, 0, 0)], "fence"
+
+
+def generate(seed: int, n: int) -> tuple:
+    """Generates a random program as the initial x0 - x31 & a body of n entries.
+
+    Each entry of the body is a (words, asm) pair. Branches & jumps only go
+    forward, so every program terminates, & only ever land on the first word
+    of an entry, never between auipc & its jalr.
+    """
+    rnd = random.Random(seed)
+    init = [0] + [
+        (
+            rnd.getrandbits(32)
+            if rnd.random() < 0.8
+            else rnd.choice([0, 1, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF])
+        )
+        for _ in range(31)
+    ]
+    body = [gen_ins(rnd) for _ in range(n)]
+    pos = list(accumulate((1 if a is None else len(w) for w, a in body), initial=0))
+    for i, (w, asm) in enumerate(body):
+        if asm is None:
+            # Entry n is the epilogue.
+            t = rnd.randrange(i + 1, min(n, i + 16) + 1)
+            body[i] = w(4 * (pos[t] - pos[i]))
+    return init, body
+
+
+def layout(init: list[int], body: list[tuple], epilogue: list[int]) -> tuple:
+    """Builds the text of a program & returns it with its data address.
+
+    The prologue loads the initial registers & the data address into x27.
+    """
+    words = [w for ws, _ in body for w in ws]
+    prologue = []
+    for x in range(1, 32):
+        if x != DP:
+            prologue += enc_li(x, init[x])
+    # The data address depends on the text size, which includes the dump.
+    ntext = 4 * (len(prologue) + 2 + len(words) + len(dump_epilogue()))
+    data = elf_layout(ntext, DUMP + WINDOW)[".data"] + DUMP
+    text = prologue + enc_li(DP, data) + words + epilogue
+    return text, data
+
+
+def dump_epilogue() -> list[int]:
+    """Writes x1 - x31 & the data window to stdout & exits, under Linux."""
+    words = [enc_s(OPCODE["STORE"], 0b010, DP, x, 4 * x - DUMP) for x in range(1, 32)]
+    words += [
+        enc_i(OPCODE["ALU"], 10, 0b000, 0, 1),  # a0 = stdout
+        enc_i(OPCODE["ALU"], 11, 0b000, DP, -DUMP),  # a1 = dump
+        enc_i(OPCODE["ALU"], 12, 0b000, 0, DUMP + WINDOW),  # a2 = size
+        enc_i(OPCODE["ALU"], 17, 0b000, 0, 64),  # a7 = write
+        enc_i(OPCODE["SYSTEM"], 0, 0, 0, 0),
+        enc_i(OPCODE["ALU"], 10, 0b000, 0, 0),
+        enc_i(OPCODE["ALU"], 17, 0b000, 0, 93),  # a7 = exit
+        enc_i(OPCODE["SYSTEM"], 0, 0, 0, 0),
+    ]
+    return words
+
+
+#
+# Reference Model
+#
+class RefModel:
+    """An independent RV32I model, written down from the spec."""
+
+    def __init__(self, mem: bytearray, pc: int):
+        self.x = [0] * 32
+        self.mem = mem
+        self.pc = pc
+
+    def rd(self, addr: int, n: int, signed: bool = False) -> int:
+        a = addr - BASE
+        v = int.from_bytes(self.mem[a : a + n], "little", signed=signed)
+        return v & 0xFFFFFFFF
+
+    def wr(self, addr: int, n: int, v: int):
+        a = addr - BASE
+        self.mem[a : a + n] = (v & ((1 << (8 * n)) - 1)).to_bytes(n, "little")
+
+    def run(self, end: int, limit: int) -> int:
+        x, cnt = self.x, 0
+        while self.pc != end and cnt < limit:
+            ins = self.rd(self.pc, 4)
+            op, rd, f3 = ins & 0x7F, (ins >> 7) & 0x1F, (ins >> 12) & 7
+            a, b = x[(ins >> 15) & 0x1F], x[(ins >> 20) & 0x1F]
+            sa, sb = a - ((a >> 31) << 32), b - ((b >> 31) << 32)
+            i_imm = (ins >> 20) - ((ins >> 31) << 12)
+            npc, res = self.pc + 4, None
+            if op == 0x37:
+                res = ins & 0xFFFFF000
+            elif op == 0x17:
+                res = self.pc + (ins & 0xFFFFF000)
+            elif op == 0x6F:
+                j = (
+                    ((ins >> 31) << 20)
+                    | (((ins >> 12) & 0xFF) << 12)
+                    | (((ins >> 20) & 1) << 11)
+                    | (((ins >> 21) & 0x3FF) << 1)
+                )
+                res, npc = self.pc + 4, self.pc + j - ((j >> 20) << 21)
+            elif op == 0x67:
+                res, npc = self.pc + 4, (a + i_imm) & ~1
+            elif op == 0x63:
+                bi = (
+                    ((ins >> 31) << 12)
+                    | (((ins >> 7) & 1) << 11)
+                    | (((ins >> 25) & 0x3F) << 5)
+                    | (((ins >> 8) & 0xF) << 1)
+                )
+                taken = [
+                    a == b,
+                    a != b,
+                    False,
+                    False,
+                    sa < sb,
+                    sa >= sb,
+                    a < b,
+                    a >= b,
+                ][f3]
+                if taken:
+                    npc = self.pc + bi - ((bi >> 12) << 13)
+            elif op == 0x03:
+                n, signed = [
+                    (1, True),
+                    (2, True),
+                    (4, False),
+                    None,
+                    (1, False),
+                    (2, False),
+                ][f3]
+                res = self.rd((a + i_imm) & 0xFFFFFFFF, n, signed)
+            elif op == 0x23:
+                s_imm = ((ins >> 25) << 5) | ((ins >> 7) & 0x1F)
+                s_imm -= (s_imm >> 11) << 12
+                self.wr((a + s_imm) & 0xFFFFFFFF, 1 << f3, b)
+            elif op in (0x13, 0x33):
+                if op == 0x13:
+                    b, sb = i_imm & 0xFFFFFFFF, i_imm
+                alt = (ins >> 30) & 1
+                sh = b & 31
+                res = [
+                    a - b if alt and op == 0x33 else a + b,
+                    a << sh,
+                    int(sa < sb),
+                    int(a < b),
+                    a ^ b,
+                    sa >> sh if alt else a >> sh,
+                    a | b,
+                    a & b,
+                ][f3]
+            elif op == 0x0F:
+                pass
+            else:
+                raise ValueError("reference: illegal instruction %08x" % ins)
+            if res is not None and rd:
+                x[rd] = res & 0xFFFFFFFF
+            self.pc = npc & 0xFFFFFFFF
+            cnt += 1
+        return cnt
+
+
+#
+# Runners, each returns (registers x1 - x31, data window, instruction count)
+#
+def run_cpu(text: list[int], data: int, limit: int) -> tuple:
+    import riscv_cpu
+
+    riscv_cpu.reset()
+    riscv_cpu.memory[: 4 * len(text)] = b"".join(struct.pack("<I", w) for w in text)
+    riscv_cpu.registers[riscv_cpu.PC] = BASE
+    riscv_cpu.predecode(BASE, 4 * len(text))
+    # The halting unimp prints its success.
+    with contextlib.redirect_stdout(io.StringIO()):
+        cnt = riscv_cpu.run(limit)
+    off = data - BASE
+    return (
+        riscv_cpu.registers.registers[1:32],
+        bytes(riscv_cpu.memory[off : off + WINDOW]),
+        cnt,
+    )
+
+
+def run_ref(text: list[int], data: int, limit: int) -> tuple:
+    mem = bytearray(0x10000)
+    mem[: 4 * len(text)] = b"".join(struct.pack("<I", w) for w in text)
+    m = RefModel(mem, BASE)
+    cnt = m.run(BASE + 4 * (len(text) - 1), limit)
+    off = data - BASE
+    return m.x[1:], bytes(mem[off : off + WINDOW]), cnt
+
+
+def qemu() -> str:
+    """Returns the qemu-riscv32 binary, built from modules/qemu if present."""
+    built = os.path.join(os.path.dirname(__file__), "modules/qemu/build/qemu-riscv32")
+    return built if os.path.exists(built) else shutil.which("qemu-riscv32")
+
+
+def run_qemu(text: list[int], data: int, limit: int) -> tuple:
+    text = text[:-1] + dump_epilogue()
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, "fuzz.elf")
+        code = b"".join(struct.pack("<I", w) for w in text)
+        elf_writer(fn, code, bytes(DUMP + WINDOW))
+        out = subprocess.run([qemu(), fn], capture_output=True, timeout=60).stdout
+    regs = list(struct.unpack("<32I", out[:DUMP]))[1:]
+    return regs, out[DUMP : DUMP + WINDOW], None
+
+
+def check_asm(body: list[tuple]) -> list[str]:
+    """Round-trips every instruction through disasm & riscv_asm.
+
+    Each entry has to disassemble to its assembly, which riscv_asm has to
+    encode back to the words, for all mnemonics it supports.
+    """
+    from disasm import riscv
+    from riscv_asm import encode, tokenize
+
+    bad = []
+    for words, asm in body:
+        text = "; ".join(riscv(w) for w in words)
+        if text != asm:
+            bad.append(f"{asm}: disasm {text}")
+        m = asm.split(" ")[0]
+        # riscv_asm has no name for x0.
+        if m not in ASM or "x0" in asm.replace(",", " ").split():
+            continue
+        tok = next(tokenize([asm.replace(" ", "\t", 1)]))
+        if encode([], tok) != words:
+            bad.append(f"{asm}: riscv_asm {encode([], tok)} != {words}")
+    return bad
+
+
+def diverges(init, body, ref, limit) -> tuple:
+    """Runs a program in riscv_cpu & the reference.
+
+    :returns: The difference, empty if there is none, & the instruction count
+        of the reference, or of riscv_cpu if the reference doesn't count.
+    """
+    text, data = layout(init, body, [UNIMP])
+    try:
+        got = run_cpu(text, data, limit)
+    except Exception as e:
+        got = (f"{type(e).__name__}: {e}", None, None)
+    want = ref(text, data, limit)
+    cnt = want[2] if want[2] is not None else got[2] or 0
+    if got[0] != want[0]:
+        if isinstance(got[0], str):
+            return got[0], cnt
+        return (
+            ", ".join(
+                "%s %08x != %08x" % (ABI[i + 1], g, w)
+                for i, (g, w) in enumerate(zip(got[0], want[0]))
+                if g != w
+            ),
+            cnt,
+        )
+    if got[1] != want[1]:
+        i = next(i for i in range(WINDOW) if got[1][i] != want[1][i])
+        return "memory +0x%x %02x != %02x" % (i, got[1][i], want[1][i]), cnt
+    return "", cnt
+
+
+def shrink(init, body, ref, limit) -> list[tuple]:
+    """Replaces entries with nops as long as the program still diverges.
+
+    Each entry is replaced by as many nops as it has words, which keeps every
+    branch offset intact. The remaining entries form the minimal failing program.
+    """
+    chunk = max(1, len(body) // 2)
+    while chunk >= 1:
+        i = 0
+        while i < len(body):
+            nops = [([NOP] * len(w), "nop") for w, _ in body[i : i + chunk]]
+            trial = body[:i] + nops + body[i + chunk :]
+            if trial != body and diverges(init, trial, ref, limit)[0]:
+                body = trial
+            i += chunk
+        chunk //= 2
+    return body
+
+
+def fuzz(args) -> tuple:
+    """Fuzzes one seed, returns (seed, instructions, divergence, program)."""
+    seed, n, backend, limit = args
+    ref = run_qemu if backend == "qemu" else run_ref
+    init, body = generate(seed, n)
+    bad = check_asm(body)
+    if bad:
+        return seed, 0, bad[0], None
+    diff, cnt = diverges(init, body, ref, limit)
+    if not diff:
+        return seed, cnt, "", None
+    body = shrink(init, body, ref, limit)
+    return seed, cnt, diff, [asm for _, asm in body if asm != "nop"]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--seeds", type=int, default=100, help="number of programs")
+    p.add_argument("--start", type=int, default=0, help="first seed")
+    p.add_argument("--length", type=int, default=200, help="instructions per program")
+    p.add_argument("--limit", type=int, default=100000, help="instructions to run")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    p.add_argument("--ref", choices=["auto", "qemu", "python"], default="auto")
+    a = p.parse_args()
+
+    backend = a.ref if a.ref != "auto" else "qemu" if qemu() else "python"
+    print(f"Fuzzing {a.seeds} programs against the {backend} reference.")
+    jobs = [(s, a.length, backend, a.limit) for s in range(a.start, a.start + a.seeds)]
+    t, total, failed = time.perf_counter(), 0, 0
+    with ProcessPoolExecutor(a.jobs) as ex:
+        for seed, cnt, diff, prog in ex.map(fuzz, jobs, chunksize=8):
+            total += cnt
+            if diff:
+                failed += 1
+                print(f"  seed {seed}: {diff}")
+                for asm in prog or []:
+                    print(f"\t{asm}")
+    dt = time.perf_counter() - t
+    print(
+        f"{total} instructions in {dt:.2f}s, {failed} of {a.seeds} programs diverged."
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""GDB Remote Serial Protocol Stub
+
+Serves riscv_cpu to gdb over a local TCP socket, with register & memory
+access, single-step, continue, software breakpoints & watchpoints.
+
+Breakpoints cost nothing while running. Their addresses get a decoded
+entry which stops the run, so continue runs at full speed until it fetches
+one of them. Watchpoints wrap the load & store handlers only while any are
+set.
+
+    $ python gdbstub.py program.elf --port 1234
+    $ riscv32-unknown-elf-gdb program.elf -ex "target remote :1234"
+"""
+import argparse
+import select
+import socket
+
+import riscv_cpu
+from riscv import ABI, OPCODE
+
+# Signals of the stop replies.
+SIGINT, SIGILL, SIGTRAP = 2, 4, 5
+# Z packet types of the watchpoints, write, read & access.
+WRITE, READ, ACCESS = 2, 3, 4
+
+TARGET_XML = (
+    '<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd">'
+    "<target><architecture>riscv:rv32</architecture>"
+    '<feature name="org.gnu.gdb.riscv.cpu">'
+    + "".join(
+        f'<reg name="{n}" bitsize="32" type="int"/>' for n in ["zero"] + ABI[1:32]
+    )
+    + '<reg name="pc" bitsize="32" type="code_ptr"/></feature></target>'
+)
+
+
+def checksum(data: bytes) -> bytes:
+    return b"%02x" % (sum(data) & 0xFF)
+
+
+class GDBStub:
+    """A gdb connection to riscv_cpu.
+
+    :param chunk: Instructions run between checks for an interrupt by gdb.
+    """
+
+    def __init__(self, chunk: int = 100000):
+        self.chunk = chunk
+        self.breakpoints = set()
+        # (type, address, length) of each watchpoint.
+        self.watchpoints = []
+        self.handlers = {}
+        self.reason = None
+        self.sock = None
+        self.buf = b""
+
+    #
+    # Breakpoints & watchpoints
+    #
+    def _break(self, rd, rs1, rs2, func3, func7, imm):
+        # The breakpoint instruction did not run.
+        riscv_cpu.instret -= 1
+        self.reason = "break"
+        return False
+
+    def _watched(self, handler, kinds):
+        def watch(rd, rs1, rs2, func3, func7, imm):
+            addr = (riscv_cpu.registers[rs1] + imm) & 0xFFFFFFFF
+            end = addr + (1 << (func3 & 0b11))
+            r = handler(rd, rs1, rs2, func3, func7, imm)
+            for kind, a, n in self.watchpoints:
+                if kind in kinds and a < end and addr < a + n:
+                    self.reason = (kind, a)
+                    return False
+            return r
+
+        return watch
+
+    def arm(self, breakpoints: bool = True):
+        """Puts the breakpoint & watchpoint handlers in place."""
+        # Fused sequences would run over breakpoints & around watchpoints.
+        riscv_cpu.unfuse()
+        for pc in self.breakpoints if breakpoints else ():
+            riscv_cpu.decoded[pc] = (self._break, 0, 0, 0, 0, 0, 0)
+        if not self.watchpoints or self.handlers:
+            return
+        for op, kinds in (("LOAD", (READ, ACCESS)), ("STORE", (WRITE, ACCESS))):
+            h = riscv_cpu.HANDLERS[OPCODE[op]]
+            self.handlers[h] = riscv_cpu.HANDLERS[OPCODE[op]] = self._watched(h, kinds)
+        self._swap(self.handlers)
+
+    def disarm(self):
+        """Restores the decoded instructions & handlers."""
+        for pc in self.breakpoints:
+            riscv_cpu.decoded.pop(pc, None)
+        if self.handlers:
+            orig = {w: h for h, w in self.handlers.items()}
+            for op in ("LOAD", "STORE"):
+                w = riscv_cpu.HANDLERS[OPCODE[op]]
+                riscv_cpu.HANDLERS[OPCODE[op]] = orig.get(w, w)
+            self._swap(orig)
+            self.handlers = {}
+
+    def _swap(self, handlers: dict):
+        decoded = riscv_cpu.decoded
+        for pc, d in decoded.items():
+            if d[0] in handlers:
+                decoded[pc] = (handlers[d[0]],) + d[1:]
+
+    #
+    # Execution
+    #
+    def resume(self, step: bool = False) -> str:
+        """Continues or steps & returns the stop reply."""
+        self.reason = None
+        try:
+            if step or riscv_cpu.registers[riscv_cpu.PC] in self.breakpoints:
+                # A single step, also over the breakpoint the cpu stopped at.
+                self.arm(breakpoints=False)
+                r = riscv_cpu.step()
+                if r is riscv_cpu.BLOCK and riscv_cpu.irq:
+                    riscv_cpu.interrupt()
+                self.disarm()
+                if r is False or step or self.reason:
+                    return self.stop(r is not False)
+            self.arm()
+            while True:
+                n = riscv_cpu.run(self.chunk)
+                if n < self.chunk or self.reason:
+                    return self.stop(False)
+                if self.interrupted():
+                    return "S%02x" % SIGINT
+        except Exception as e:
+            print(f"  {e}")
+            return "S%02x" % SIGILL
+        finally:
+            self.disarm()
+            riscv_cpu.bus.flush()
+
+    def stop(self, stepped: bool) -> str:
+        if self.reason == "break" or (stepped and self.reason is None):
+            return "S%02x" % SIGTRAP
+        if self.reason:
+            kind, addr = self.reason
+            name = {WRITE: "watch", READ: "rwatch", ACCESS: "awatch"}[kind]
+            return "T%02x%s:%x;" % (SIGTRAP, name, addr)
+        # The program halted on its own.
+        return "W00"
+
+    def interrupted(self) -> bool:
+        """Returns whether gdb sent a break, keeping other input."""
+        if not select.select([self.sock], [], [], 0)[0]:
+            return False
+        data = self.sock.recv(4096)
+        self.buf += data.replace(b"\x03", b"")
+        return b"\x03" in data or not data
+
+    #
+    # Packets
+    #
+    def send(self, data: str):
+        d = data.encode()
+        self.sock.sendall(b"$" + d + b"#" + checksum(d))
+
+    def packet(self) -> str:
+        """Returns the next packet, None once gdb disconnected."""
+        while True:
+            start = self.buf.find(b"$")
+            end = self.buf.find(b"#", start)
+            if start >= 0 and end >= 0 and len(self.buf) >= end + 3:
+                data = self.buf[start + 1 : end]
+                ok = self.buf[end + 1 : end + 3] == checksum(data)
+                self.buf = self.buf[end + 3 :]
+                self.sock.sendall(b"+" if ok else b"-")
+                if ok:
+                    return data.decode("latin-1")
+                continue
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                return None
+            self.buf += chunk.replace(b"\x03", b"")
+
+    def handle(self, p: str) -> str:
+        """Returns the reply to a packet, None to close the connection."""
+        regs = riscv_cpu.registers
+        cmd, arg = p[:1], p[1:]
+        if cmd == "?":
+            return "S%02x" % SIGTRAP
+        if cmd == "g":
+            return "".join(
+                (regs[i] & 0xFFFFFFFF).to_bytes(4, "little").hex() for i in range(33)
+            )
+        if cmd == "G":
+            for i in range(33):
+                regs[i] = int.from_bytes(
+                    bytes.fromhex(arg[8 * i : 8 * i + 8]), "little"
+                )
+            return "OK"
+        if cmd == "p":
+            n = int(arg, 16)
+            return regs[n].to_bytes(4, "little").hex() if n <= 32 else "E01"
+        if cmd == "P":
+            n, v = arg.split("=")
+            if int(n, 16) > 32:
+                return "E01"
+            regs[int(n, 16)] = int.from_bytes(bytes.fromhex(v), "little")
+            return "OK"
+        if cmd == "m":
+            addr, n = (int(x, 16) for x in arg.split(","))
+            try:
+                return bytes(riscv_cpu.rmem(addr + i, 1) for i in range(n)).hex()
+            except Exception:
+                return "E01"
+        if cmd == "M":
+            loc, data = arg.split(":")
+            addr = int(loc.split(",")[0], 16)
+            try:
+                for i, b in enumerate(bytes.fromhex(data)):
+                    riscv_cpu.wmem(addr + i, b, 1)
+            except Exception:
+                return "E01"
+            return "OK"
+        if cmd in ("c", "s"):
+            if arg:
+                regs[riscv_cpu.PC] = int(arg, 16)
+            return self.resume(cmd == "s")
+        if cmd in "Zz":
+            kind, addr, n = (int(x, 16) for x in arg.split(","))
+            if kind in (0, 1):
+                (self.breakpoints.add if cmd == "Z" else self.breakpoints.discard)(addr)
+            elif cmd == "Z":
+                self.watchpoints.append((kind, addr, n))
+            elif (kind, addr, n) in self.watchpoints:
+                self.watchpoints.remove((kind, addr, n))
+            return "OK"
+        if p.startswith("qSupported"):
+            return "PacketSize=4000;qXfer:features:read+"
+        if p.startswith("qXfer:features:read:target.xml:"):
+            off, n = (int(x, 16) for x in p.split(":")[-1].split(","))
+            part = TARGET_XML[off : off + n]
+            return ("m" if off + n < len(TARGET_XML) else "l") + part
+        if p == "qAttached":
+            return "1"
+        if p == "qfThreadInfo":
+            return "m1"
+        if p == "qsThreadInfo":
+            return "l"
+        if p == "qC":
+            return "QC1"
+        if cmd == "H" or p == "T1":
+            return "OK"
+        if cmd == "D":
+            self.send("OK")
+            return None
+        if cmd == "k":
+            return None
+        # Unsupported packets get an empty reply.
+        return ""
+
+    def serve(self, port: int = 1234, host: str = "127.0.0.1"):
+        """Waits for gdb & serves it until it detaches."""
+        with socket.create_server((host, port)) as srv:
+            print(f"Waiting for gdb on {host}:{port}")
+            self.sock, _ = srv.accept()
+        with self.sock:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while (p := self.packet()) is not None:
+                reply = self.handle(p)
+                if reply is None:
+                    break
+                self.send(reply)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("file", help="ELF file to debug")
+    p.add_argument("--port", type=int, default=1234)
+    a = p.parse_args()
+
+    riscv_cpu.load_elf(a.file)
+    GDBStub().serve(a.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Host Profiler
+
+Measures where the emulator itself spends host time, as opposed to the
+guest. Two modes:
+
+- stages: runs riscv_cpu with an instrumented copy of its run loop, timing
+  fetch, decode, dispatch & each execute handler with perf_counter_ns. The
+  memory paths fetch32, rmem & wmem are wrapped, so their time shows under
+  the handler calling them. The cost of reading the clock is calibrated &
+  taken off every interval, what remains is still inflated a little, compare
+  the shares rather than the absolute times.
+- calls: records the Python call stacks of a plain run with sys.setprofile,
+  every function the emulator calls, at a much higher overhead.
+
+Both write folded stacks with the nanoseconds of each, the input of
+flamegraph.pl & speedscope. Alternatively --cprofile saves cProfile stats.
+
+    $ python hostprof.py program.elf --limit 1000000 -o stages.folded
+    $ python hostprof.py program.elf --mode calls -o calls.folded
+    $ flamegraph.pl stages.folded > stages.svg
+"""
+import argparse
+import contextlib
+import cProfile
+import io
+import pstats
+import sys
+from collections import defaultdict
+from time import perf_counter_ns
+
+import riscv_cpu
+
+# Functions of riscv_cpu wrapped while instrumented.
+MEMORY = ("fetch32", "rmem", "wmem")
+
+
+class Profile:
+    """Host nanoseconds & calls by stack, e.g. ("execute", "_load", "rmem").
+
+    The time of a stack includes that of the stacks below it.
+    """
+
+    def __init__(self):
+        self.ns = defaultdict(int)
+        self.calls = defaultdict(int)
+
+    def add(self, stack: tuple, ns: int):
+        self.ns[stack] += ns
+        self.calls[stack] += 1
+
+    def self_ns(self) -> dict:
+        """Returns the time of each stack less that of the stacks it called."""
+        own = dict(self.ns)
+        for stack, ns in self.ns.items():
+            if len(stack) > 1 and stack[:-1] in own:
+                own[stack[:-1]] -= ns
+        return {k: max(v, 0) for k, v in own.items()}
+
+    def folded(self, root: str = "riscv_cpu") -> str:
+        """Returns the folded stacks, one "a;b;c nanoseconds" line each."""
+        return "".join(
+            ";".join((root,) + stack) + f" {ns}\n"
+            for stack, ns in sorted(self.self_ns().items())
+            if ns
+        )
+
+    def report(self, top: int = 30) -> str:
+        own = self.self_ns()
+        total = sum(own.values()) or 1
+        lines = [
+            "  %-36s %10s %10s %10s %8s %6s"
+            % ("", "calls", "ms", "self ms", "ns/call", "%")
+        ]
+        for stack, ns in sorted(own.items(), key=lambda x: -x[1])[:top]:
+            calls = self.calls[stack]
+            lines.append(
+                "  %-36s %10d %10.1f %10.1f %8d %5.1f%%"
+                % (
+                    ";".join(stack)[-36:],
+                    calls,
+                    self.ns[stack] / 1e6,
+                    ns / 1e6,
+                    self.ns[stack] // max(calls, 1),
+                    100 * ns / total,
+                )
+            )
+        return "\n".join(lines)
+
+
+def calibrate(n: int = 10000) -> int:
+    """Returns the nanoseconds a timed interval adds, the least of n."""
+    best = None
+    for _ in range(n):
+        t = perf_counter_ns()
+        dt = perf_counter_ns() - t
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+#
+# Stages
+#
+profile = Profile()
+# Stack the wrapped functions are called under, set by the run loop.
+current = ()
+CAL = 0
+orig = {}
+
+
+def timed(name: str, f):
+    """Wraps f to add its time to profile under the current stack."""
+
+    def wrapper(*args):
+        global current
+        outer = current
+        current = stack = outer + (name,)
+        t = perf_counter_ns()
+        try:
+            return f(*args)
+        finally:
+            profile.add(stack, max(perf_counter_ns() - t - CAL, 0))
+            current = outer
+
+    return wrapper
+
+
+def instrument(prof: Profile = None):
+    """Wraps the memory paths of riscv_cpu, recording into prof."""
+    global profile, CAL
+    profile = prof or Profile()
+    CAL = calibrate()
+    if not orig:
+        for name in MEMORY:
+            orig[name] = getattr(riscv_cpu, name)
+            setattr(riscv_cpu, name, timed(name, orig[name]))
+
+
+def restore() -> Profile:
+    """Puts the memory paths back & returns the profile recorded."""
+    for name, f in orig.items():
+        setattr(riscv_cpu, name, f)
+    orig.clear()
+    return profile
+
+
+def run(limit: int = None) -> int:
+    """Runs like riscv_cpu.run while instrumented, timing each stage.
+
+    :returns: Number of instructions executed.
+    """
+    global current
+    cpu, add = riscv_cpu, profile.add
+    regs, start = cpu.registers.registers, cpu.instret
+    stop = float("inf") if limit is None else start + limit
+    check, tail = start + cpu.SPIN_CHECK, stop - cpu.SPILL - 1
+    ns, cal, names = perf_counter_ns, CAL, {}
+    while cpu.instret < stop:
+        t0 = ns()
+        pc = regs[cpu.PC]
+        d = cpu.decoded.get(pc)
+        t1 = t3 = ns()
+        if d is None:
+            current = ("fetch",)
+            ins = cpu.fetch32(pc)
+            t2 = ns()
+            d = cpu.decoded[pc] = cpu.decode(ins)
+            t3 = ns()
+            add(("decode",), max(t3 - t2 - cal, 0))
+            profile.ns[("fetch",)] += t2 - t1
+        if cpu.instret >= tail and d[0] in cpu.FUSED and cpu.instret + d[3] > stop:
+            d = cpu.unfused[pc]
+        h, rd, rs1, rs2, func3, func7, imm = d
+        cpu.instret += 1
+        stack = current = names.get(h) or names.setdefault(h, ("execute", h.__name__))
+        t4 = ns()
+        r = h(rd, rs1, rs2, func3, func7, imm)
+        t5 = ns()
+        current = ("dispatch",)
+        if r is not True and r is not False:
+            if cpu.irq:
+                cpu.interrupt()
+            if cpu.instret >= check:
+                if not cpu.idle(stop):
+                    r = False
+                check = cpu.instret + cpu.SPIN_CHECK
+        t6 = ns()
+        # The bookkeeping comes after the last timestamp, outside of all intervals.
+        add(("fetch",), max(t1 - t0 - cal, 0))
+        add(stack, max(t5 - t4 - cal, 0))
+        add(("dispatch",), max(t4 - t3 + t6 - t5 - 2 * cal, 0))
+        if r is False:
+            break
+    current = ()
+    return cpu.instret - start
+
+
+#
+# Call stacks
+#
+class Calls:
+    """A sys.setprofile hook adding the time between events to the stack."""
+
+    def __init__(self, prof: Profile):
+        self.prof, self.stack, self.last = prof, [], perf_counter_ns()
+
+    def __call__(self, frame, event: str, arg):
+        now = perf_counter_ns()
+        if self.stack:
+            self.prof.ns[tuple(self.stack)] += now - self.last
+        if event == "call":
+            self.stack.append(frame.f_code.co_qualname)
+            self.prof.calls[tuple(self.stack)] += 1
+        elif event == "c_call":
+            self.stack.append(getattr(arg, "__qualname__", repr(arg)))
+            self.prof.calls[tuple(self.stack)] += 1
+        elif self.stack:
+            self.stack.pop()
+        self.last = perf_counter_ns()
+
+
+def calls(limit: int = None) -> tuple:
+    """Runs riscv_cpu.run with the call stacks recorded.
+
+    :returns: The number of instructions & the Profile, which holds the time
+        of each stack itself, so its folded stacks are exact.
+    """
+    prof = Profile()
+    hook = Calls(prof)
+    sys.setprofile(hook)
+    try:
+        n = riscv_cpu.run(limit)
+    finally:
+        sys.setprofile(None)
+    # Add the time of the stacks below to each, as in the stages profile.
+    for stack, ns in list(prof.ns.items()):
+        for i in range(1, len(stack)):
+            prof.ns[stack[:i]] += ns
+    return n, prof
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("file", help="ELF file")
+    p.add_argument("--limit", type=int, default=None, help="instructions")
+    p.add_argument("--mode", choices=["stages", "calls"], default="stages")
+    p.add_argument("--cprofile", help="save cProfile stats of a plain run instead")
+    p.add_argument("-o", "--out", help="folded stacks file")
+    a = p.parse_args()
+
+    riscv_cpu.load_elf(a.file)
+    log = io.StringIO()
+    t = perf_counter_ns()
+    with contextlib.redirect_stdout(log):
+        if a.cprofile:
+            prof = cProfile.Profile()
+            n = prof.runcall(riscv_cpu.run, a.limit)
+        elif a.mode == "calls":
+            n, prof = calls(a.limit)
+        else:
+            instrument()
+            try:
+                n = run(a.limit)
+            finally:
+                prof = restore()
+    dt = (perf_counter_ns() - t) / 1e9
+    riscv_cpu.bus.flush()
+    print(f"{n} instructions in {dt:.2f}s, {n / dt:.0f} per second")
+    if a.cprofile:
+        prof.dump_stats(a.cprofile)
+        pstats.Stats(prof).sort_stats("tottime").print_stats(20)
+        return
+    print(prof.report())
+    if a.out:
+        root = "riscv_cpu" if a.mode == "stages" else "python"
+        with open(a.out, "w") as f:
+            f.write(prof.folded(root))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,502 @@
+"""ISA Encoding Coverage
+
+Records which encodings the emulators execute & the assemblers emit, as
+bitmaps over a key per encoding class:
+
+- RISC-V: opcode, funct3 & funct7 where they are part of the encoding &
+  an operand class, whether rd, rs1 & rs2 are x0 & whether the immediate is
+  negative.
+- ARM: instruction class & its opcode, condition, S flag & addressing mode.
+
+The bitmaps of parallel workers merge with a bitwise or, & the report lists
+the mnemonics & operand classes never exercised.
+
+Recording costs nothing once an instruction ran. While enabled, decode &
+predecode hand out entries whose handler marks the instruction & puts the
+plain entry back in its place before running it, so every address is marked
+once. Traces miss the load & store addresses of those first executions.
+
+    $ python isacov.py -o tests.npz run "modules/riscv-tests/isa/rv32ui-p-*"
+    $ python isacov.py -o fuzz.npz fuzz --seeds 1000
+    $ python isacov.py -o asm.npz asm testfs/*.s
+    $ python isacov.py report tests.npz fuzz.npz asm.npz
+"""
+import argparse
+import contextlib
+import glob
+import io
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import arm_asm
+import arm_cpu
+import riscv_asm
+import riscv_cpu
+from arm_asm import CONDITION, DATAPROC
+from riscv import ISA, OPCODE, PSEUDO
+
+# Key bits of each bitmap.
+BITS = {"riscv_cpu": 18, "riscv_asm": 18, "arm_cpu": 16, "arm_asm": 16}
+
+
+#
+# RISC-V keys, (opcode >> 2, funct3, funct7, operand class)
+#
+LUI, AUIPC, JAL = OPCODE["LUI"], OPCODE["AUIPC"], OPCODE["JAL"]
+STORE, BRANCH, OP, ALU = OPCODE["STORE"], OPCODE["BRANCH"], OPCODE["OP"], OPCODE["ALU"]
+SYSTEM, FENCE, AMO = OPCODE["SYSTEM"], OPCODE["FENCE"], OPCODE["AMO"]
+LR = ISA["lr.w"][2] >> 2
+
+
+def rv_classes(op: int, f3: int, f7: int) -> tuple:
+    """Names of the three operand class bits of an encoding, None if unused."""
+    if op in (LUI, AUIPC, JAL):
+        return "rd=x0", None, "imm<0"
+    if op in (STORE, BRANCH):
+        return "rs2=x0", "rs1=x0", "imm<0"
+    if op == OP:
+        return "rd=x0", "rs1=x0", "rs2=x0"
+    if op == AMO:
+        return "rd=x0", "rs1=x0", None if f7 >> 2 == LR else "rs2=x0"
+    if op == ALU and f3 in (1, 5):
+        return "rd=x0", "rs1=x0", None
+    if op == SYSTEM:
+        return (None,) * 3 if f3 == 0 else ("rd=x0", "rs1=x0", None)
+    if op == FENCE:
+        return (None,) * 3
+    return "rd=x0", "rs1=x0", "imm<0"
+
+
+def rv_fields(op: int, f3: int, f7: int) -> tuple:
+    """Zeroes funct3 & funct7 where they are not part of the encoding.
+
+    :param f7: funct7, for SYSTEM instructions with funct3 0 the low 7 bits
+        of funct12.
+    """
+    if op in (LUI, AUIPC, JAL):
+        return 0, 0
+    if op == AMO:
+        # The aq & rl bits don't change the operation.
+        return f3, f7 & 0x7C
+    if op == OP or op == SYSTEM and f3 == 0 or op == ALU and f3 in (1, 5):
+        return f3, f7
+    return f3, 0
+
+
+def rv_key(word: int) -> int:
+    """Returns the coverage key of a RISC-V instruction, None if compressed."""
+    op = word & 0x7F
+    if op & 0b11 != 0b11:
+        return None
+    rd, rs1, rs2 = (word >> 7) & 0x1F, (word >> 15) & 0x1F, (word >> 20) & 0x1F
+    f7 = (word >> 20) & 0x7F if op == SYSTEM else word >> 25
+    f3, f7 = rv_fields(op, (word >> 12) & 0b111, f7)
+    first = rs2 if op in (STORE, BRANCH) else rd
+    third = rs2 == 0 if op in (OP, AMO) else word >> 31
+    cls = 0
+    for i, (name, v) in enumerate(
+        zip(rv_classes(op, f3, f7), (first == 0, rs1 == 0, third))
+    ):
+        if name and v:
+            cls |= 1 << i
+    return (op >> 2) << 13 | f3 << 10 | f7 << 3 | cls
+
+
+#
+# ARM keys, (class, opcode, condition, flag, addressing mode)
+#
+TRANSFERS = {
+    (0, 4, 0): "STR",
+    (1, 4, 0): "LDR",
+    (0, 1, 0): "STRB",
+    (1, 1, 0): "LDRB",
+    (0, 2, 0): "STRH",
+    (1, 2, 0): "LDRH",
+    (1, 1, 1): "LDRSB",
+    (1, 2, 1): "LDRSH",
+}
+SIZE = {1: 0, 2: 1, 4: 2}
+# Opcodes, addressing modes & the name of the flag bit of each class.
+ARM = {
+    "dataproc": ([d.name for d in DATAPROC], ["imm", "reg", "reg-shift"], "S"),
+    "mul": (["MUL", "MLA", "UMULL", "UMLAL", "SMULL", "SMLAL"], ["reg"], "S"),
+    "transfer": (
+        [None] * 16,
+        ["imm", "imm pre!", "imm post", None, "reg", "reg pre!", "reg post"],
+        "U",
+    ),
+    "block": (
+        ["STM", "LDM"],
+        ["DA", "IA", "DB", "IB", "DA!", "IA!", "DB!", "IB!"],
+        None,
+    ),
+    "branch": (["B", "BL"], ["imm"], None),
+    "bx": (["BX"], ["reg"], None),
+    "mrs": (["MRS"], ["reg"], None),
+    "msr": (["MSR"], ["imm", "reg"], None),
+    "swi": (["SWI"], ["imm"], None),
+}
+for (l, size, sign), name in TRANSFERS.items():
+    ARM["transfer"][0][l | SIZE[size] << 1 | sign << 3] = name
+CLASSES = list(ARM)
+
+
+def arm_key(word: int) -> int:
+    """Returns the coverage key of an ARM instruction, None if undefined."""
+    try:
+        h, cond, args = orig.get("arm_decode", arm_cpu.decode)(word)
+    except RuntimeError:
+        return None
+    op = flag = mode = 0
+    if h in (arm_cpu._dp_imm, arm_cpu._dp_reg, arm_cpu._dp_rsr):
+        cls, op, flag = "dataproc", args[0], args[1]
+        mode = (arm_cpu._dp_imm, arm_cpu._dp_reg, arm_cpu._dp_rsr).index(h)
+    elif h is arm_cpu._mul:
+        cls, flag, op = "mul", args[0], args[1]
+    elif h is arm_cpu._mull:
+        cls, flag, op = "mul", args[0], 2 + 2 * args[1] + args[2]
+    elif h in (arm_cpu._ldst_imm, arm_cpu._ldst_reg):
+        l, size, sign, p, u, w = args[:6]
+        cls, op, flag = "transfer", l | SIZE[size] << 1 | sign << 3, u
+        mode = (h is arm_cpu._ldst_reg) << 2 | (w if p else 2)
+    elif h is arm_cpu._block:
+        l, p, u, w = args[:4]
+        cls, op, mode = "block", l, w << 2 | p << 1 | u
+    elif h is arm_cpu._branch:
+        cls, op = "branch", args[0]
+    elif h is arm_cpu._msr:
+        cls, mode = "msr", args[1] is not None
+    else:
+        cls = {arm_cpu._bx: "bx", arm_cpu._mrs: "mrs", arm_cpu._swi: "swi"}[h]
+    return CLASSES.index(cls) << 12 | op << 8 | cond << 4 | flag << 3 | mode
+
+
+#
+# Bitmaps
+#
+class Coverage:
+    """Encoding bitmaps, one per emulator & assembler of BITS."""
+
+    def __init__(self):
+        self.maps = {k: np.zeros(1 << (b - 3), np.uint8) for k, b in BITS.items()}
+
+    def mark(self, kind: str, word: int):
+        """Marks the encoding of an instruction word as exercised."""
+        key = (rv_key if kind.startswith("riscv") else arm_key)(word)
+        if key is not None:
+            self.maps[kind][key >> 3] |= 1 << (key & 7)
+
+    def keys(self, kind: str) -> set:
+        """Returns the keys marked in a bitmap."""
+        bits = np.unpackbits(self.maps[kind], bitorder="little")
+        return set(np.flatnonzero(bits).tolist())
+
+    def merge(self, other: "Coverage"):
+        for k, m in other.maps.items():
+            self.maps[k] |= m
+
+    def save(self, fn: str):
+        np.savez_compressed(fn, **self.maps)
+
+    @classmethod
+    def load(cls, fn: str) -> "Coverage":
+        cov = cls()
+        with np.load(fn) as f:
+            for k in cov.maps:
+                cov.maps[k] |= f[k]
+        return cov
+
+    def report(self, kind: str) -> str:
+        """Lists the encodings never exercised in one of the bitmaps."""
+        if kind.startswith("riscv"):
+            return rv_report(kind, self.keys(kind))
+        return arm_report(kind, self.keys(kind))
+
+
+def rv_report(kind: str, keys: set) -> str:
+    lines, seen, total, hit = [], 0, 0, 0
+    mnemonics = [m for m in ISA if m not in PSEUDO]
+    for m in mnemonics:
+        enc = ISA[m] + [0, 0]
+        f7 = enc[2] & 0x7F if enc[0] == SYSTEM else enc[2]
+        f3, f7 = rv_fields(enc[0], enc[1], f7)
+        names = rv_classes(enc[0], f3, f7)
+        used = sum(1 << i for i, n in enumerate(names) if n)
+        base = (enc[0] >> 2) << 13 | f3 << 10 | f7 << 3
+        classes = [c for c in range(8) if c & ~used == 0]
+        missing = [c for c in classes if base | c not in keys]
+        total += len(classes)
+        hit += len(classes) - len(missing)
+        if len(missing) == len(classes):
+            lines.append(f"  {m:10} never")
+            continue
+        seen += 1
+        if missing:
+            desc = [
+                "+".join(n for i, n in enumerate(names) if c >> i & 1) or "plain"
+                for c in missing
+            ]
+            lines.append(f"  {m:10} missing " + ", ".join(desc))
+    head = f"{kind}: {seen} of {len(mnemonics)} mnemonics, {hit} of {total} classes"
+    return "\n".join([head] + lines)
+
+
+def arm_report(kind: str, keys: set) -> str:
+    lines, seen, total = [], 0, 0
+    for ci, (cls, (ops, modes, flag)) in enumerate(ARM.items()):
+        conds = set()
+        for op, name in enumerate(ops):
+            if name is None:
+                continue
+            total += 1
+            hits = [k & 0xFF for k in keys if k >> 8 == ci << 4 | op]
+            if not hits:
+                lines.append(f"  {cls:9} {name:6} never")
+                continue
+            seen += 1
+            conds.update(k >> 4 for k in hits)
+            flags = [0, 1] if flag else [0]
+            if cls == "dataproc" and op >> 2 == 0b10:
+                # Compares always set the flags.
+                flags = [1]
+            miss = [
+                m for i, m in enumerate(modes) if m and i not in {k & 7 for k in hits}
+            ]
+            miss += [
+                f"{flag}={f}" for f in flags if f not in {k >> 3 & 1 for k in hits}
+            ]
+            if miss:
+                lines.append(f"  {cls:9} {name:6} missing " + ", ".join(miss))
+        if conds and len(conds) < 15:
+            missing = [CONDITION(c).name for c in range(15) if c not in conds]
+            lines.append(f"  {cls:9} {'':6} conditions missing " + ", ".join(missing))
+    return "\n".join([f"{kind}: {seen} of {total} opcodes"] + lines)
+
+
+#
+# Recording
+#
+coverage = Coverage()
+orig = {}
+
+
+def riscv_hit(h):
+    """Returns the handler marking the first execution of h at an address."""
+    fused = h in riscv_cpu.FUSED
+
+    def hit(rd, rs1, rs2, func3, func7, imm):
+        pc = riscv_cpu.registers[riscv_cpu.PC]
+        d = (h, rd, rs1, rs2, func3, func7, imm)
+        for table in (riscv_cpu.decoded, riscv_cpu.unfused):
+            if table.get(pc, (None,))[0] is hit:
+                table[pc] = d
+        # Fused entries count as many instructions as they hold.
+        for i in range(rs2 if fused else 1):
+            coverage.mark("riscv_cpu", riscv_cpu.fetch32(pc + 4 * i))
+        return h(rd, rs1, rs2, func3, func7, imm)
+
+    return hit
+
+
+def arm_hit(h):
+    def hit(*args):
+        pc = arm_cpu.R[15] - 8
+        d = arm_cpu.decoded.get(pc)
+        if d is not None and d[0] is hit:
+            arm_cpu.decoded[pc] = (h,) + d[1:]
+        coverage.mark("arm_cpu", arm_cpu.fetch32(pc))
+        return h(*args)
+
+    return hit
+
+
+def enable(cov: Coverage = None):
+    """Starts recording into cov, a new Coverage by default."""
+    global coverage, HITS, ARM_HITS
+    coverage = cov or Coverage()
+    if orig:
+        return
+    rv = list(riscv_cpu.HANDLERS.values()) + [riscv_cpu._illegal]
+    HITS = {h: riscv_hit(h) for h in rv + list(riscv_cpu.FUSED)}
+    ARM_HITS = {}
+    orig.update(
+        decode=riscv_cpu.decode,
+        predecode=riscv_cpu.predecode,
+        FUSED=riscv_cpu.FUSED,
+        arm_decode=arm_cpu.decode,
+        asm32=arm_asm.asm32,
+        sections=riscv_asm.sections,
+    )
+    # Fused sequences must still be recognized behind their hit handlers.
+    riscv_cpu.FUSED = orig["FUSED"] | {HITS[h] for h in orig["FUSED"]}
+
+    def wrap(d: tuple) -> tuple:
+        return (HITS[d[0]],) + d[1:] if d[0] in HITS else d
+
+    def decode(ins: int) -> tuple:
+        return wrap(orig["decode"](ins))
+
+    def predecode(base: int = 0x80000000, size: int = None, fusion: bool = True):
+        orig["predecode"](base, size, fusion)
+        off = base - 0x80000000
+        size = (len(riscv_cpu.memory) - off if size is None else size) & ~3
+        for pc in range(base, base + size, 4):
+            for table in (riscv_cpu.decoded, riscv_cpu.unfused):
+                if pc in table:
+                    table[pc] = wrap(table[pc])
+
+    def arm_decode(ins: int) -> tuple:
+        h, cond, args = orig["arm_decode"](ins)
+        if h is not arm_cpu._halt:
+            h = ARM_HITS.get(h) or ARM_HITS.setdefault(h, arm_hit(h))
+        return h, cond, args
+
+    def asm32(tokens) -> list[int]:
+        words = orig["asm32"](tokens)
+        for w in words:
+            coverage.mark("arm_asm", w)
+        return words
+
+    def sections(tokens, *args, **kwargs) -> tuple:
+        res = orig["sections"](tokens, *args, **kwargs)
+        for w in res[0]:
+            coverage.mark("riscv_asm", w)
+        return res
+
+    riscv_cpu.decode, riscv_cpu.predecode = decode, predecode
+    arm_cpu.decode, arm_asm.asm32, riscv_asm.sections = arm_decode, asm32, sections
+
+
+def disable() -> Coverage:
+    """Stops recording, puts the plain entries back & returns the coverage."""
+    if orig:
+        riscv_cpu.decode, riscv_cpu.predecode = orig["decode"], orig["predecode"]
+        riscv_cpu.FUSED = orig["FUSED"]
+        arm_cpu.decode, arm_asm.asm32 = orig["arm_decode"], orig["asm32"]
+        riscv_asm.sections = orig["sections"]
+        orig.clear()
+        plain = {w: h for h, w in list(HITS.items()) + list(ARM_HITS.items())}
+        # The tables only exist once the cpus were reset.
+        for cpu, name in (
+            (riscv_cpu, "decoded"),
+            (riscv_cpu, "unfused"),
+            (arm_cpu, "decoded"),
+        ):
+            table = getattr(cpu, name, {})
+            for pc, d in table.items():
+                if d[0] in plain:
+                    table[pc] = (plain[d[0]],) + d[1:]
+    return coverage
+
+
+#
+# Jobs, each returns the coverage it recorded
+#
+def run_elf(args) -> Coverage:
+    fn, limit = args
+    enable()
+    riscv_cpu.load_elf(fn)
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            riscv_cpu.run(limit)
+        except Exception as e:
+            print(f"  {fn}: {e}")
+    riscv_cpu.bus.flush()
+    return disable()
+
+
+def run_arm(args) -> Coverage:
+    fn, limit = args
+    enable()
+    arm_cpu.reset()
+    arm_cpu.load(fn)
+    try:
+        arm_cpu.run(limit)
+    except Exception as e:
+        print(f"  {fn}: {e}")
+    return disable()
+
+
+def run_asm(args) -> Coverage:
+    import asmbuild
+
+    fn, isa = args
+    enable()
+    with open(fn) as f:
+        try:
+            asmbuild.assemble(isa or asmbuild.detect_isa(fn), f.read())
+        except Exception as e:
+            print(f"  {fn}: {e}")
+    return disable()
+
+
+def run_fuzz(args) -> Coverage:
+    import fuzz
+
+    enable()
+    fuzz.fuzz(args)
+    return disable()
+
+
+def collect(job, args: list, workers: int = None) -> Coverage:
+    """Runs the jobs in parallel & merges their coverage."""
+    cov = Coverage()
+    with ProcessPoolExecutor(workers) as ex:
+        for c in ex.map(job, args, chunksize=max(1, len(args) // 64)):
+            cov.merge(c)
+    return cov
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("-o", "--out", help="file to save the coverage to, .npz")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+    cmd = p.add_subparsers(dest="cmd", required=True)
+    r = cmd.add_parser("run", help="run RISC-V ELF files in riscv_cpu")
+    r.add_argument("files", nargs="+", help="ELF files or glob patterns")
+    r.add_argument("--limit", type=int, default=10_000_000, help="instructions")
+    r = cmd.add_parser("arm", help="run ARM hex or ELF files in arm_cpu")
+    r.add_argument("files", nargs="+", help="hex or ELF files or glob patterns")
+    r.add_argument("--limit", type=int, default=10_000_000, help="instructions")
+    r = cmd.add_parser("asm", help="assemble files")
+    r.add_argument("files", nargs="+", help="assembly files or glob patterns")
+    r.add_argument("--isa", choices=["arm", "riscv"], default=None)
+    r = cmd.add_parser("fuzz", help="run fuzz.py programs in riscv_cpu")
+    r.add_argument("--seeds", type=int, default=100, help="number of programs")
+    r.add_argument("--start", type=int, default=0, help="first seed")
+    r.add_argument("--length", type=int, default=200, help="instructions per program")
+    r.add_argument("--limit", type=int, default=100000, help="instructions to run")
+    r = cmd.add_parser("report", help="merge & report saved coverage")
+    r.add_argument("files", nargs="+", help=".npz files")
+    a = p.parse_args()
+
+    start = time.perf_counter()
+    files = [f for x in getattr(a, "files", []) for f in sorted(glob.glob(x)) or [x]]
+    if a.cmd == "run":
+        files = [f for f in files if not f.endswith(".dump")]
+        cov = collect(run_elf, [(f, a.limit) for f in files], a.jobs)
+    elif a.cmd == "arm":
+        cov = collect(run_arm, [(f, a.limit) for f in files], a.jobs)
+    elif a.cmd == "asm":
+        cov = collect(run_asm, [(f, a.isa) for f in files], a.jobs)
+    elif a.cmd == "fuzz":
+        seeds = range(a.start, a.start + a.seeds)
+        cov = collect(
+            run_fuzz, [(s, a.length, "python", a.limit) for s in seeds], a.jobs
+        )
+    else:
+        cov = Coverage()
+        for f in files:
+            cov.merge(Coverage.load(f))
+    for kind, m in cov.maps.items():
+        if m.any():
+            print(cov.report(kind))
+    if a.out:
+        cov.save(a.out)
+    print(f"{len(files) or a.seeds} inputs in {time.perf_counter() - start:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
 import sys
 import binascii
 
-with open(sys.argv[1], "rb") as f:
-    memory = f.read()
-    print(
-        "\n".join(
-            [
-                binascii.hexlify(memory[i : i + 4][::-1]).decode("utf-8")
-                for i in range(0, len(memory), 4)
-            ]
-        )
+
+def makehex(memory: bytes) -> str:
+    """Formats a binary as hex words, one 32 bit little-endian word per line."""
+    return "\n".join(
+        [
+            binascii.hexlify(memory[i : i + 4][::-1]).decode("utf-8")
+            for i in range(0, len(memory), 4)
+        ]
     )
+
+
+def main(argv: list[str] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    with open(argv[0], "rb") as f:
+        print(makehex(f.read()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Morphgen
+
+One command for the assemblers, emulators & tools of the project. Only the
+standard library is imported up front, each subcommand imports the modules
+it needs, so short calls from build scripts don't pay for the rest.
+
+    $ morphgen asm-riscv testfs/riscv_minimal.s minimal.elf
+    $ morphgen asm-arm testfs/arm32_subtract.s subtract.elf
+    $ morphgen run minimal.elf
+    $ morphgen run test/fib.hex --isa arm
+    $ morphgen hex firmware.bin
+    $ morphgen bench
+    $ morphgen test
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Imports & loads of each subcommand, timed by bench, image is a small hex.
+STARTUP = {
+    "python": "pass",
+    "morphgen": "import morphgen",
+    "hex": "import makehex",
+    "asm-riscv": "import riscv_asm",
+    "asm-arm": "import arm_asm",
+    "run": "import riscv_cpu; riscv_cpu.load({image!r})",
+    "run arm": "import arm_cpu; arm_cpu.reset(); arm_cpu.load({image!r})",
+    "run elf": "import riscv_cpu, elftools.elf.elffile",
+}
+
+
+def isa_of(fn: str, default: str) -> str:
+    """Returns the instruction set of an ELF file by its machine, else default."""
+    with open(fn, "rb") as f:
+        head = f.read(20)
+    if head[:4] != b"\x7fELF":
+        return default
+    from elf import EM_ARM
+
+    return "arm" if int.from_bytes(head[18:20], "little") == EM_ARM else "riscv"
+
+
+#
+# Subcommands
+#
+def asm_riscv(a):
+    import riscv_asm
+
+    riscv_asm.main([a.file] + ([a.out] if a.out else []))
+
+
+def asm_arm(a):
+    import arm_asm
+
+    arm_asm.main([a.file] + ([a.out] if a.out else []))
+
+
+def run(a):
+    failed = 0
+    for fn in a.files:
+        print(f"Execute : {fn}")
+        if isa_of(fn, a.isa) == "arm":
+            import arm_cpu
+
+            arm_cpu.reset()
+            arm_cpu.load(fn)
+            print("  ran %d instructions" % arm_cpu.run(a.limit))
+            print(arm_cpu.registers_to_str())
+            continue
+        import riscv_cpu
+
+        riscv_cpu.load(fn)
+        try:
+            n = riscv_cpu.run(a.limit)
+        except Exception as e:
+            print(f"  {e}")
+            failed += 1
+            continue
+        finally:
+            riscv_cpu.bus.flush()
+        print("  ran %d instructions" % n)
+        print(riscv_cpu.registers_to_str(riscv_cpu.registers))
+    sys.exit(1 if failed else 0)
+
+
+def hex_(a):
+    import makehex
+
+    makehex.main([a.file])
+
+
+def startup(code: str, runs: int) -> float:
+    """Returns the least seconds of runs fresh interpreters running code."""
+    import subprocess
+    import time
+
+    best = float("inf")
+    for _ in range(runs):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def bench(a):
+    import tempfile
+
+    base = startup(STARTUP["python"], a.runs)
+    print(f"  {'python':10} {1000 * base:7.1f} ms  interpreter startup")
+    with tempfile.TemporaryDirectory() as d:
+        image = os.path.join(d, "nops.hex")
+        with open(image, "w") as f:
+            f.write("00000013\n" * 1024)
+        for name, code in STARTUP.items():
+            if name != "python":
+                t = startup(code.format(image=image), a.runs)
+                print(f"  {name:10} {1000 * t:7.1f} ms  {1000 * (t - base):+7.1f} ms")
+
+
+def test(a):
+    import unittest
+
+    os.chdir(ROOT)
+    argv = ["morphgen test", "discover", "-s", "test", "-t", "."] + a.args
+    unittest.main(module=None, argv=argv)
+
+
+def main(argv: list[str] = None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    cmd = p.add_subparsers(dest="cmd", required=True)
+    s = cmd.add_parser("asm-riscv", help="assemble RISC-V")
+    s.add_argument("file", help="assembly file")
+    s.add_argument("out", nargs="?", help="ELF file to write")
+    s.set_defaults(func=asm_riscv)
+    s = cmd.add_parser("asm-arm", help="assemble ARM")
+    s.add_argument("file", help="assembly file")
+    s.add_argument("out", nargs="?", help="ELF file to write")
+    s.set_defaults(func=asm_arm)
+    s = cmd.add_parser("run", help="run ELF files, hex images or binaries")
+    s.add_argument("files", nargs="+")
+    s.add_argument("--isa", choices=["riscv", "arm"], default="riscv")
+    s.add_argument("--limit", type=int, default=None, help="instructions")
+    s.set_defaults(func=run)
+    s = cmd.add_parser("hex", help="print a binary as hex words")
+    s.add_argument("file", help="binary file")
+    s.set_defaults(func=hex_)
+    s = cmd.add_parser("bench", help="time the startup of each subcommand")
+    s.add_argument("--runs", type=int, default=10)
+    s.set_defaults(func=bench)
+    s = cmd.add_parser("test", help="run the unit tests, passing on unittest options")
+    s.set_defaults(func=test)
+    # Options unknown to test go to unittest.
+    a, a.args = p.parse_known_args(argv)
+    if a.args and a.cmd != "test":
+        p.error("unrecognized arguments: " + " ".join(a.args))
+    a.func(a)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Multi-Hart Simulation
+
+Runs N harts of riscv_cpu, each in its own process so they run in parallel,
+sharing the guest RAM through multiprocessing.shared_memory. Registers, CSRs,
+decoded instructions & devices stay private to each hart, mhartid tells them
+apart.
+
+The RV32A atomics of all harts hold one lock, & the LR reservations live in
+a shared table, one word per hart. SC & AMOs break the reservations of other
+harts on the word they write, as do plain stores, checked only while any
+reservation is held. Plain stores take the lock too, so none is lost in the
+middle of an AMO. An SC further fails if the word no longer holds the value
+its LR read, which catches plain stores racing it.
+
+With a quantum the harts meet at a barrier every quantum instructions, so
+none runs ahead of the others by more. Without, they run freely.
+
+    $ python multihart.py program.elf --harts 4 --quantum 1000
+"""
+import argparse
+import multiprocessing as mp
+import time
+from multiprocessing.shared_memory import SharedMemory
+from threading import BrokenBarrierError
+
+import riscv_cpu
+from devices import virt
+from elf import elf_code
+from riscv import CSR
+
+BASE = 0x80000000
+
+
+class SharedReservation(riscv_cpu.Reservation):
+    """The reservations of all harts, a word address or -1 each.
+
+    The word after those of the harts counts the reservations held.
+
+    :param table: The table as a memoryview of int64.
+    :param hart: Index of this hart.
+    :param lock: Lock shared by all harts, reentrant as SC & AMOs store.
+    """
+
+    def __init__(self, table: memoryview, hart: int, lock):
+        super().__init__()
+        self.table, self.hart, self.lock = table, hart, lock
+        self.n = len(table) - 1
+        self.value = None
+
+    def reserve(self, addr: int):
+        if self.table[self.hart] < 0:
+            self.table[self.n] += 1
+        self.table[self.hart] = addr
+        self.value = riscv_cpu.rmem(addr, 4)
+
+    def take(self, addr: int) -> bool:
+        ok = self.table[self.hart] == addr and riscv_cpu.rmem(addr, 4) == self.value
+        self.drop(self.hart)
+        return ok
+
+    def drop(self, hart: int):
+        if self.table[hart] >= 0:
+            self.table[hart] = -1
+            self.table[self.n] -= 1
+
+    def stored(self, addr: int, n: int):
+        """Breaks the reservations of other harts on the words written."""
+        words = {addr & ~3, (addr + n - 1) & ~3}
+        with self.lock:
+            for h in range(self.n):
+                if h != self.hart and self.table[h] in words:
+                    self.drop(h)
+
+
+def locked_store(store, rsv: SharedReservation):
+    """Wraps wmem to store under the lock of the atomics.
+
+    So a plain store can't land between the read & the write of another
+    hart's AMO & be lost. It breaks the reservations on the words written.
+    """
+
+    def wmem(addr: int, val: int, n: int = 4):
+        with rsv.lock:
+            store(addr, val, n)
+            if rsv.table[rsv.n]:
+                rsv.stored(addr & 0xFFFFFFFF, n)
+
+    return wmem
+
+
+def hart(
+    i: int,
+    mem_name: str,
+    rsv_name: str,
+    entry: int,
+    code: list,
+    tohost: int,
+    limit: int,
+    quantum: int,
+    lock,
+    barrier,
+    alive,
+    results,
+):
+    """Runs hart i on the shared memory & puts its result to results.
+
+    Only code, the (address, size) of each code segment, is predecoded.
+    """
+    shm, rshm = SharedMemory(mem_name), SharedMemory(rsv_name)
+    table = rshm.buf.cast("q")
+    riscv_cpu.reset()
+    riscv_cpu.memory = shm.buf
+    riscv_cpu.bus = virt(clock=lambda: riscv_cpu.instret)
+    riscv_cpu.tohost = tohost
+    riscv_cpu.csrs[CSR["mhartid"]] = i
+    # Other harts change memory, loops waiting on it are not idle.
+    riscv_cpu.SPIN_CHECK = float("inf")
+    riscv_cpu.reservation = rsv = SharedReservation(table, i, lock)
+    riscv_cpu.wmem = locked_store(riscv_cpu.wmem, rsv)
+    for base, size in code:
+        riscv_cpu.predecode(base, size)
+    riscv_cpu.registers[riscv_cpu.PC] = entry
+    status, error = "limit", None
+    left = float("inf") if limit is None else limit
+    try:
+        while left > 0:
+            n = min(quantum or left, left)
+            ran = riscv_cpu.run(n)
+            left -= ran
+            if ran < n:
+                status = "halted"
+                break
+            if barrier is not None:
+                barrier.wait()
+    except BrokenBarrierError:
+        pass
+    except Exception as e:
+        status, error = "error", f"{type(e).__name__}: {e}"
+    riscv_cpu.bus.flush()
+    results.put(
+        {
+            "hart": i,
+            "status": status,
+            "error": error,
+            "instret": riscv_cpu.instret,
+            "registers": riscv_cpu.registers.registers[:],
+        }
+    )
+    if barrier is not None:
+        # Keep meeting the running harts at the barrier, the last one done
+        # breaks it.
+        with alive.get_lock():
+            alive.value -= 1
+            last = alive.value == 0
+        try:
+            if last:
+                barrier.abort()
+            while True:
+                barrier.wait()
+        except BrokenBarrierError:
+            pass
+    # The views must be gone before the shared memory closes.
+    riscv_cpu.memory = bytearray()
+    table.release()
+    shm.close()
+    rshm.close()
+
+
+def simulate(
+    image,
+    harts: int = 2,
+    quantum: int = None,
+    limit: int = None,
+    entry: int = BASE,
+    tohost: int = None,
+) -> tuple:
+    """Runs a program on a number of harts, all starting at its entry point.
+
+    :param image: ELF file, or the raw bytes of the memory from BASE.
+    :param quantum: Instructions between barriers, None runs freely.
+    :param limit: Instructions each hart runs at most.
+    :param entry: Entry point of raw images.
+    :param tohost: Address of the tohost word of raw images.
+    :returns: The result of each hart & the final memory.
+    """
+    if isinstance(image, str):
+        entry, code = riscv_cpu.load_elf(image), elf_code(image)
+        image, tohost = bytes(riscv_cpu.memory), riscv_cpu.tohost
+    else:
+        code = [(BASE, len(image))]
+    mem = SharedMemory(create=True, size=max(len(image), 0x10000))
+    rsv = SharedMemory(create=True, size=8 * (harts + 1))
+    try:
+        mem.buf[: len(image)] = image
+        table = rsv.buf.cast("q")
+        for h in range(harts):
+            table[h] = -1
+        table[harts] = 0
+        table.release()
+        ctx = mp.get_context()
+        lock, results = ctx.RLock(), ctx.Queue()
+        barrier = ctx.Barrier(harts) if quantum else None
+        alive = ctx.Value("i", harts)
+        procs = [
+            ctx.Process(
+                target=hart,
+                args=(
+                    i,
+                    mem.name,
+                    rsv.name,
+                    entry,
+                    code,
+                    tohost,
+                    limit,
+                    quantum,
+                    lock,
+                    barrier,
+                    alive,
+                    results,
+                ),
+            )
+            for i in range(harts)
+        ]
+        for p in procs:
+            p.start()
+        res = sorted((results.get() for _ in procs), key=lambda r: r["hart"])
+        for p in procs:
+            p.join()
+        return res, bytes(mem.buf)
+    finally:
+        for shm in (mem, rsv):
+            shm.close()
+            shm.unlink()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("file", help="ELF file")
+    p.add_argument("--harts", type=int, default=2)
+    p.add_argument("--quantum", type=int, default=None, help="instructions")
+    p.add_argument("--limit", type=int, default=None, help="instructions per hart")
+    a = p.parse_args()
+
+    start = time.perf_counter()
+    res, _ = simulate(a.file, a.harts, a.quantum, a.limit)
+    for r in res:
+        print(f"  hart {r['hart']}: {r['status']:7} {r['instret']:>10} instructions")
+        if r["error"]:
+            print(f"    {r['error']}")
+    print(f"{len(res)} harts in {time.perf_counter() - start:.2f}s.")
+
+
+if __name__ == "__main__":
+    main()
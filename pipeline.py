@@ -0,0 +1,180 @@
+"""5-Stage Pipeline Timing Model
+
+Estimates the cycles the in-order pipeline of the cores takes for a program,
+
+    fetch -> decode -> execute -> memory access -> write back
+
+without simulating the HDL. riscv_cpu executes the program, the model only
+times the trace of executed instructions:
+
+- With forwarding the results of MEM & WB go straight to EX, so only a load
+  followed by a user of its result stalls, for a cycle. Without forwarding,
+  operands are read in ID, at the earliest in the WB of their producer.
+- Branches are predicted not taken & resolved in EX, so taken branches &
+  jalr flush the two younger instructions. jal is resolved in ID.
+
+    $ python pipeline.py "modules/riscv-tests/isa/rv32ui-p-*"
+"""
+import argparse
+import glob
+
+import riscv_cpu
+from riscv import OPCODE
+
+# Opcode name of each handler.
+KIND = {riscv_cpu.HANDLERS[op]: name for name, op in OPCODE.items()}
+# Number of source registers read, rs1 & then rs2.
+READS = {"JALR": 1, "LOAD": 1, "ALU": 1, "SYSTEM": 1, "BRANCH": 2, "STORE": 2}
+READS["OP"] = 2
+# Opcodes which do not write rd.
+NO_RD = {"BRANCH", "STORE", "FENCE"}
+
+
+class Pipeline:
+    """Times a trace of PCs on the 5-stage pipeline.
+
+    :param forwarding: Whether results are forwarded to EX.
+    :param branch_penalty: Cycles lost to a taken branch, jalr or trap.
+    :param jump_penalty: Cycles lost to a jal.
+    """
+
+    def __init__(
+        self, forwarding: bool = True, branch_penalty: int = 2, jump_penalty: int = 1
+    ):
+        self.forwarding = forwarding
+        self.branch_penalty = branch_penalty
+        self.jump_penalty = jump_penalty
+        self.instructions = 0
+        self.stalls = dict.fromkeys(["load-use", "raw", "control"], 0)
+        self.hazards = dict.fromkeys(["raw", "forwarded", "load-use", "control"], 0)
+        # Cycle the last instruction was in EX & the bubbles in front of the next.
+        self.ex, self.flush = -1, 0
+        # First cycle a consumer of each register may be in EX, the cycle its
+        # producer was in EX & whether that was a load.
+        self.ready = [0] * 32
+        self.written = [-3] * 32
+        self.load = [False] * 32
+        self.pending = None
+
+    @property
+    def cycles(self) -> int:
+        # The first instruction fills IF & ID, the last drains MEM & WB.
+        return self.ex + 5 if self.instructions else 0
+
+    @property
+    def cpi(self) -> float:
+        return self.cycles / self.instructions if self.instructions else 0.0
+
+    def feed(self, pcs: list[int]):
+        """Times the next PCs of the trace.
+
+        Whether a branch was taken is only known from the PC after it, so the
+        last PC waits for the next batch or finish.
+        """
+        if not pcs:
+            return
+        if self.pending is not None:
+            self._time(self.pending, pcs[0])
+        for pc, npc in zip(pcs, pcs[1:]):
+            self._time(pc, npc)
+        self.pending = pcs[-1]
+
+    def finish(self):
+        """Times the last instruction of the trace."""
+        if self.pending is not None:
+            self._time(self.pending, None)
+            self.pending = None
+
+    def _time(self, pc: int, npc: int):
+        h, rd, rs1, rs2, func3 = riscv_cpu.plain(pc)[:5]
+        kind = KIND.get(h)
+        ex = nominal = self.ex + 1 + self.flush
+
+        # Data hazards on results of the instructions still in the pipeline.
+        nsrc = 0 if kind == "SYSTEM" and func3 & 0b100 else READS.get(kind, 0)
+        stall, cause, hazard = 0, "raw", False
+        for r in (rs1, rs2)[:nsrc]:
+            if not r or nominal - self.written[r] > 2:
+                continue
+            hazard = True
+            if self.load[r] and nominal - self.written[r] == 1:
+                self.hazards["load-use"] += 1
+            if self.ready[r] - nominal > stall:
+                stall = self.ready[r] - nominal
+                cause = "load-use" if self.forwarding and self.load[r] else "raw"
+        if hazard:
+            self.hazards["raw"] += 1
+            if self.forwarding and not stall:
+                self.hazards["forwarded"] += 1
+        if stall:
+            self.stalls[cause] += stall
+            ex += stall
+
+        if kind not in NO_RD and rd:
+            load = kind == "LOAD"
+            if self.forwarding:
+                self.ready[rd] = ex + (2 if load else 1)
+            else:
+                self.ready[rd] = ex + 3
+            self.written[rd], self.load[rd] = ex, load
+
+        # Control hazards, anything but the next instruction flushes.
+        self.flush = 0
+        if npc is not None and npc != pc + 4:
+            self.flush = self.jump_penalty if kind == "JAL" else self.branch_penalty
+            self.stalls["control"] += self.flush
+            self.hazards["control"] += 1
+        self.ex = ex
+        self.instructions += 1
+
+    def report(self) -> str:
+        """Returns the CPI & the stall & hazard counts."""
+        s, h = self.stalls, self.hazards
+        return "\n".join(
+            [
+                "  %d instructions, %d cycles, CPI %.3f"
+                % (self.instructions, self.cycles, self.cpi),
+                "  stalls  : load-use %d, raw %d, control %d"
+                % (s["load-use"], s["raw"], s["control"]),
+                "  hazards : raw %d (%d forwarded), load-use %d, control %d"
+                % (h["raw"], h["forwarded"], h["load-use"], h["control"]),
+            ]
+        )
+
+
+def simulate(file: str, pipeline: Pipeline, limit: int = None) -> Pipeline:
+    """Runs an ELF file in riscv_cpu & times it on the pipeline."""
+    riscv_cpu.load_elf(file)
+    try:
+        for pcs in riscv_cpu.trace(limit):
+            pipeline.feed(pcs)
+    finally:
+        pipeline.finish()
+        riscv_cpu.bus.flush()
+    return pipeline
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("files", nargs="+", help="ELF files or glob patterns")
+    p.add_argument("--no-forwarding", action="store_true")
+    p.add_argument("--branch-penalty", type=int, default=2)
+    p.add_argument("--jump-penalty", type=int, default=1)
+    p.add_argument("--limit", type=int, default=None, help="instructions to run")
+    a = p.parse_args()
+
+    files = [x for f in a.files for x in sorted(glob.glob(f)) or [f]]
+    for x in files:
+        if x.endswith(".dump"):
+            continue
+        print(f"Execute : {x}")
+        pipe = Pipeline(not a.no_forwarding, a.branch_penalty, a.jump_penalty)
+        try:
+            simulate(x, pipe, a.limit)
+        except Exception as e:
+            print(f"  {e}")
+        print(pipe.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -12,25 +12,105 @@ OPCODE = {
     "ALU": 0b0010011,
     "FENCE": 0b0001111,
     "SYSTEM": 0b1110011,
+    "AMO": 0b0101111,
 }
 
+# Encoding of each mnemonic as [opcode, func3, func7], SYSTEM instructions
+# with func3 0 are told apart by the func12 in place of func7.
 ISA = {
     "lui": [0b0110111],
     "auipc": [0b0010111],
     "addi": [0b0010011, 0b000],
+    "slti": [0b0010011, 0b010],
+    "sltiu": [0b0010011, 0b011],
+    "xori": [0b0010011, 0b100],
+    "ori": [0b0010011, 0b110],
+    "andi": [0b0010011, 0b111],
+    "slli": [0b0010011, 0b001, 0],
+    "srli": [0b0010011, 0b101, 0],
+    "srai": [0b0010011, 0b101, 0b0100000],
     "mv": [0b0010011, 0b000, 0],
     "li": [0b0010011, 0b000, 0],
     "jr": [0b1100111, 0b000],
     "jalr": [0b1100111, 0b000],
     "jal": [0b1101111],
+    "beq": [0b1100011, 0b000],
+    "bne": [0b1100011, 0b001],
+    "blt": [0b1100011, 0b100],
+    "bge": [0b1100011, 0b101],
+    "bltu": [0b1100011, 0b110],
+    "bgeu": [0b1100011, 0b111],
     "sb": [0b0100011, 0b000],
     "sh": [0b0100011, 0b001],
     "sw": [0b0100011, 0b010],
     "lb": [0b0000011, 0b000],
     "lh": [0b0000011, 0b001],
     "lw": [0b0000011, 0b010],
+    "lbu": [0b0000011, 0b100],
+    "lhu": [0b0000011, 0b101],
     "add": [0b0110011, 0b000, 0],
     "sub": [0b0110011, 0b000, 0b0100000],
+    "sll": [0b0110011, 0b001, 0],
+    "slt": [0b0110011, 0b010, 0],
+    "sltu": [0b0110011, 0b011, 0],
+    "xor": [0b0110011, 0b100, 0],
+    "srl": [0b0110011, 0b101, 0],
+    "sra": [0b0110011, 0b101, 0b0100000],
+    "or": [0b0110011, 0b110, 0],
+    "and": [0b0110011, 0b111, 0],
+    "fence": [0b0001111, 0b000],
+    "fence.i": [0b0001111, 0b001],
+    "ecall": [0b1110011, 0b000, 0x000],
+    "ebreak": [0b1110011, 0b000, 0x001],
+    "wfi": [0b1110011, 0b000, 0x105],
+    "mret": [0b1110011, 0b000, 0x302],
+    "csrrw": [0b1110011, 0b001],
+    "csrrs": [0b1110011, 0b010],
+    "csrrc": [0b1110011, 0b011],
+    "csrrwi": [0b1110011, 0b101],
+    "csrrsi": [0b1110011, 0b110],
+    "csrrci": [0b1110011, 0b111],
+    # RV32A, func7 holds funct5 above the aq & rl bits.
+    "lr.w": [0b0101111, 0b010, 0b0001000],
+    "sc.w": [0b0101111, 0b010, 0b0001100],
+    "amoswap.w": [0b0101111, 0b010, 0b0000100],
+    "amoadd.w": [0b0101111, 0b010, 0b0000000],
+    "amoxor.w": [0b0101111, 0b010, 0b0010000],
+    "amoand.w": [0b0101111, 0b010, 0b0110000],
+    "amoor.w": [0b0101111, 0b010, 0b0100000],
+    "amomin.w": [0b0101111, 0b010, 0b1000000],
+    "amomax.w": [0b0101111, 0b010, 0b1010000],
+    "amominu.w": [0b0101111, 0b010, 0b1100000],
+    "amomaxu.w": [0b0101111, 0b010, 0b1110000],
+}
+# Pseudo-instructions of ISA, encoded as one of the above.
+PSEUDO = {"mv", "li", "jr"}
+
+# Machine mode control & status registers.
+CSR = {
+    "mstatus": 0x300,
+    "misa": 0x301,
+    "mie": 0x304,
+    "mtvec": 0x305,
+    "mscratch": 0x340,
+    "mepc": 0x341,
+    "mcause": 0x342,
+    "mtval": 0x343,
+    "mip": 0x344,
+    "mcycle": 0xB00,
+    "minstret": 0xB02,
+    "mcycleh": 0xB80,
+    "minstreth": 0xB82,
+    "cycle": 0xC00,
+    "time": 0xC01,
+    "instret": 0xC02,
+    "cycleh": 0xC80,
+    "timeh": 0xC81,
+    "instreth": 0xC82,
+    "mvendorid": 0xF11,
+    "marchid": 0xF12,
+    "mimpid": 0xF13,
+    "mhartid": 0xF14,
 }
 
 REG = {
@@ -1,8 +1,11 @@
 """RISCV Assembler"""
+import io
 import sys
 import re
+from collections import namedtuple
 from enum import Enum
 
+from elf import elf_layout, elf_writer, pack_data, pack_fixup, resolve_data, EM_RISCV
 from riscv import ISA, REG
 
 
@@ -13,6 +16,23 @@ class Program(Enum):
     COMMENT = 4
 
 
+# A single tokenized line, pc is the byte offset of instructions & labels.
+Token = namedtuple("Token", ["kind", "words", "pc"])
+
+# Classifies a line by its first word in a single match.
+LINE = re.compile(
+    r"[\t ,()]*(?:(?P<directive>\.)|(?P<label>\w+:)|(?P<comment>\#)"
+    r"|(?P<instruction>[^\t ,()]))"
+)
+WORDS = re.compile(r"[\t ,()]+")
+KINDS = {
+    "label": Program.LABEL,
+    "directive": Program.DIRECTIVE,
+    "comment": Program.COMMENT,
+    "instruction": Program.INSTRUCTION,
+}
+
+
 def bm(bits: int = 32) -> int:
     """Returns a bitmask based for the number of bits given."""
     return 2**bits - 1
@@ -26,23 +46,27 @@ def two_compl(val: int, bits: int = 32):
         return val
 
 
+def tokenize(fp):
+    """Reads the assembly code line by line & yields its tokenized symbols."""
+    pc = 0
+    for line in fp:
+        line = line.rstrip("\r\n")
+        m = LINE.match(line)
+        if m is None:
+            continue
+        kind = KINDS[m.lastgroup]
+        sl = [w for w in WORDS.split(line) if w]
+        if kind == Program.INSTRUCTION:
+            yield Token(kind, sl, pc)
+            # The call pseudo-op expands to auipc & jalr.
+            pc += 8 if sl[0] == "call" else 4
+        else:
+            yield Token(kind, sl, pc if kind == Program.LABEL else None)
+
+
 def parse(content: str):
     """Reads the assmbly code and returns list of tokenized symbols."""
-    program, pc = [], 0
-    for line in content.split("\n"):
-        sl = list(filter(None, re.split(r"\t+|,| |\(|\)", line)))
-        if sl:
-            if re.match("\.+", sl[0]):
-                program.append((Program.DIRECTIVE, sl))
-            elif re.match("\w+(?: \w+)*:", sl[0]):
-                program.append((Program.LABEL, sl, pc))
-            elif re.match("\#+", sl[0]):
-                program.append((Program.COMMENT, sl))
-            else:
-                program.append((Program.INSTRUCTION, sl, pc))
-                pc += 4
-
-    return program
+    return list(tokenize(io.StringIO(content)))
 
 
 def encode(enc: list[int], ins: list[str]) -> int:
@@ -129,25 +153,76 @@ def encode(enc: list[int], ins: list[str]) -> int:
     return enc
 
 
-def main():
+def section_name(words: list[str]) -> str:
+    """Maps a section directive to one of .text, .data or .bss."""
+    name = words[1] if words[0] == ".section" else words[0]
+    if name.startswith(".bss") or name.startswith(".sbss"):
+        return ".bss"
+    if name.startswith(".text"):
+        return ".text"
+    return ".data"
+
+
+def sections(tokens, base: int = 0x80000000) -> tuple:
+    """Assembles the tokens into the .text, .data & .bss sections.
+
+    :param base: Load address of .text, data words referring to labels hold
+        their absolute addresses.
+    :returns: The encoded instructions, the .data bytes, the .bss size, the
+        symbols as a mapping of name to (section, offset) & the global names.
+    """
+    enc, data, bss, symbols, globl = list(), bytearray(), 0, dict(), set()
+    sec, fixups = ".text", []
+    for t in tokens:
+        if t[0] == Program.INSTRUCTION:
+            enc = encode(enc, t)
+        # Local labels like .LC0: are tokenized as directives.
+        elif t[0] == Program.LABEL or t[1][0].endswith(":"):
+            off = {".text": len(enc) * 4, ".data": len(data), ".bss": bss}[sec]
+            symbols[t[1][0][:-1]] = (sec, off)
+        elif t[0] == Program.DIRECTIVE:
+            if t[1][0] in (".text", ".data", ".bss", ".section", ".rodata"):
+                sec = section_name(t[1])
+            elif t[1][0] in (".globl", ".global"):
+                globl.add(t[1][1])
+            elif sec == ".data":
+                data += pack_fixup(t[1], len(data), fixups)
+            elif sec == ".bss":
+                bss += len(pack_data(t[1], bss))
+    # Labels may be referenced ahead of their definition.
+    addrs = elf_layout(len(enc) * 4, len(data), base)
+    return enc, resolve_data(data, fixups, symbols, addrs), bss, symbols, globl
+
+
+def main(argv: list[str] = None):
+    """Assembles a file, argv holds it & optionally the ELF file to write."""
+    argv = sys.argv[1:] if argv is None else argv
     try:
-        x = sys.argv[1]
-    except ValueError:
+        x = argv[0]
+    except IndexError:
         raise ValueError("No input file provided.")
 
     print(f"Read : {x}")
-    content = open(x, "r").read()
-
-    t = parse(content)
-    enc = list()
-    for line in t:
-        if line[0] == Program.INSTRUCTION:
-            enc = encode(enc, line)
-
-    # Print results.
-    print("    Instructions:")
-    for e in enc:
-        print("\t%08x " % e)
+    with open(x, "r") as f:
+        if len(argv) > 1:
+            enc, data, bss, symbols, globl = sections(tokenize(f))
+            text = b"".join(e.to_bytes(4, "little") for e in enc)
+            entry = 0x80000000 + symbols["main"][1] if "main" in symbols else None
+            elf_writer(argv[1], text, data, bss, symbols, globl, EM_RISCV, entry=entry)
+            print(f"Write : {argv[1]}")
+        else:
+            # Encode while reading, the first words show up before the file ends.
+            enc = (
+                e
+                for t in tokenize(f)
+                if t[0] == Program.INSTRUCTION
+                for e in encode([], t)
+            )
+
+        # Print results.
+        print("    Instructions:")
+        for e in enc:
+            print("\t%08x " % e)
 
 
 if __name__ == "__main__":
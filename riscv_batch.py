@@ -0,0 +1,282 @@
+"""Batched RV32I Processor
+
+Runs many independent harts in lockstep. The machine states are held as
+NumPy arrays, registers as (N, 33) & memory as (N, size), and every step
+decodes & executes one instruction on all running harts at once. Harts
+following different paths simply take different masks in each step.
+
+There is no timer, so like riscv_cpu without one, a hart jumping or taking a
+branch to itself halts, as nothing can end the loop.
+"""
+import sys
+
+import numpy as np
+
+from riscv import OPCODE
+from riscv_cpu import PC, dins, imm_b, imm_i, imm_j, imm_s, imm_u, sext
+
+# Hart status codes, HALTED by a jump or branch to itself.
+RUNNING, PASSED, FAILED, FAULT, HALTED = 0, 1, 2, 3, 4
+M32 = 0xFFFFFFFF
+
+
+class Harts:
+    """N independent RV32I machine states.
+
+    :param n: Number of harts.
+    :param size: Memory per hart in bytes.
+    :param base: Address of the first byte of memory.
+    """
+
+    def __init__(self, n: int, size: int = 0x10000, base: int = 0x80000000):
+        self.n, self.size, self.base = n, size, base
+        self.regs = np.zeros((n, 33), np.uint32)
+        self.mem = np.zeros((n, size), np.uint8)
+        self.status = np.zeros(n, np.int8)
+        self.inscnt = np.zeros(n, np.int64)
+        self.regs[:, PC] = base
+
+    def load(self, image: bytes, harts=None, addr: int = None):
+        """Copies a raw image to the memory of the given (default all) harts."""
+        off = (self.base if addr is None else addr) - self.base
+        data = np.frombuffer(image, np.uint8)
+        self.mem[slice(None) if harts is None else harts, off : off + len(data)] = data
+
+    def load_elf(self, file: str, harts=None):
+        """Loads the PT_LOAD segments of an ELF file to the given harts."""
+        from elf import elf_reader
+
+        self.load(elf_reader(b"\x00" * self.size, file, base=self.base), harts)
+
+    def _read(self, idx, addr, nbytes: int):
+        # Bytes past the end are only read by narrower loads & masked off.
+        val = self.mem[idx, addr].astype(np.int64)
+        for k in range(1, nbytes):
+            a = np.minimum(addr + k, self.size - 1)
+            val |= self.mem[idx, a].astype(np.int64) << (8 * k)
+        return val
+
+    def _bad(self, addr, nbytes: int):
+        return (addr < 0) | (addr > self.size - nbytes)
+
+    def step(self) -> int:
+        """Executes one instruction on every running hart.
+
+        :returns: Number of harts which executed an instruction.
+        """
+        idx = np.flatnonzero(self.status == RUNNING)
+        if not len(idx):
+            return 0
+        regs = self.regs[idx].astype(np.int64)
+        pc = regs[:, PC]
+        off = pc - self.base
+
+        # Harts fetching outside of memory fault & drop out of this step.
+        bad = self._bad(off, 4)
+        if bad.any():
+            self.status[idx[bad]] = FAULT
+            idx, regs, pc, off = idx[~bad], regs[~bad], pc[~bad], off[~bad]
+        ins = self._read(idx, off, 4)
+
+        #
+        # Decode
+        #
+        op = dins(ins, 6, 0)
+        rd = dins(ins, 11, 7)
+        f3 = dins(ins, 14, 12)
+        f7 = dins(ins, 31, 25)
+        rows = np.arange(len(idx))
+        v1 = regs[rows, dins(ins, 19, 15)]
+        v2 = regs[rows, dins(ins, 24, 20)]
+        s1, s2 = sext(v1, 32), sext(v2, 32)
+
+        val = np.zeros(len(idx), np.int64)
+        wr = np.zeros(len(idx), bool)
+        npc = pc + 4
+        fault = np.zeros(len(idx), bool)
+        done = np.zeros(len(idx), np.int8)
+
+        #
+        # Execute, one masked update per opcode class
+        #
+        m = op == OPCODE["LUI"]
+        val[m], wr[m] = imm_u(ins[m]), True
+
+        m = op == OPCODE["AUIPC"]
+        val[m], wr[m] = pc[m] + imm_u(ins[m]), True
+
+        m = op == OPCODE["JAL"]
+        if m.any():
+            j = imm_j(ins[m])
+            val[m], wr[m] = pc[m] + 4, True
+            npc[m] = pc[m] + j
+            done[m] = np.where(j == 0, HALTED, 0)
+
+        m = op == OPCODE["JALR"]
+        val[m], wr[m] = pc[m] + 4, True
+        npc[m] = (v1[m] + imm_i(ins[m])) & ~1
+
+        m = op == OPCODE["BRANCH"]
+        if m.any():
+            b, c3 = imm_b(ins[m]), f3[m]
+            a1, a2, b1, b2 = v1[m], v2[m], s1[m], s2[m]
+            taken = (
+                ((c3 == 0b000) & (a1 == a2))
+                | ((c3 == 0b001) & (a1 != a2))
+                | ((c3 == 0b100) & (b1 < b2))
+                | ((c3 == 0b101) & (b1 >= b2))
+                | ((c3 == 0b110) & (a1 < a2))
+                | ((c3 == 0b111) & (a1 >= a2))
+            )
+            npc[m] = np.where(taken, pc[m] + b, pc[m] + 4)
+            done[m] = np.where(taken & (b == 0), HALTED, 0)
+
+        m = op == OPCODE["ALU"]
+        if m.any():
+            imm, c3, a, sa = imm_i(ins[m]), f3[m], v1[m], s1[m]
+            sh = imm & 31
+            val[m] = np.select(
+                [
+                    c3 == 0b000,
+                    c3 == 0b001,
+                    c3 == 0b010,
+                    c3 == 0b011,
+                    c3 == 0b100,
+                    (c3 == 0b101) & (f7[m] == 0b0100000),
+                    c3 == 0b101,
+                    c3 == 0b110,
+                ],
+                [
+                    a + imm,
+                    a << sh,
+                    sa < imm,
+                    a < (imm & M32),
+                    a ^ imm,
+                    sa >> sh,
+                    a >> sh,
+                    a | imm,
+                ],
+                a & imm,
+            )
+            wr[m] = True
+
+        m = op == OPCODE["OP"]
+        if m.any():
+            c3, a, b, sa, sb = f3[m], v1[m], v2[m], s1[m], s2[m]
+            sh, alt = b & 31, f7[m] == 0b0100000
+            val[m] = np.select(
+                [
+                    (c3 == 0b000) & alt,
+                    c3 == 0b000,
+                    c3 == 0b001,
+                    c3 == 0b010,
+                    c3 == 0b011,
+                    c3 == 0b100,
+                    (c3 == 0b101) & alt,
+                    c3 == 0b101,
+                    c3 == 0b110,
+                ],
+                [
+                    a - b,
+                    a + b,
+                    a << sh,
+                    sa < sb,
+                    a < b,
+                    a ^ b,
+                    sa >> sh,
+                    a >> sh,
+                    a | b,
+                ],
+                a & b,
+            )
+            # Only sub & sra have a funct7, others like the M extension fault.
+            bad = (f7[m] != 0) & ~(alt & ((c3 == 0b000) | (c3 == 0b101)))
+            wr[m], fault[m] = ~bad, bad
+
+        m = op == OPCODE["LOAD"]
+        if m.any():
+            c3 = f3[m]
+            n = np.where((c3 & 0b11) == 0, 1, np.where((c3 & 0b11) == 1, 2, 4))
+            addr = v1[m] + imm_i(ins[m]) - self.base
+            bad = self._bad(addr, n) | (c3 == 0b011) | (c3 > 0b101)
+            addr = np.where(bad, 0, addr)
+            raw = self._read(idx[m], addr, 4)
+            val[m] = np.select(
+                [c3 == 0b000, c3 == 0b001, c3 == 0b100, c3 == 0b101],
+                [sext(raw & 0xFF, 8), sext(raw & 0xFFFF, 16), raw & 0xFF, raw & 0xFFFF],
+                raw & M32,
+            )
+            wr[m], fault[m] = ~bad, bad
+
+        m = op == OPCODE["STORE"]
+        if m.any():
+            c3 = f3[m]
+            n = 1 << c3
+            addr = v1[m] + imm_s(ins[m]) - self.base
+            bad = self._bad(addr, n) | (c3 > 0b010)
+            fault[m] = bad
+            ok = ~bad
+            sidx, saddr, sval, sn = idx[m][ok], addr[ok], v2[m][ok], n[ok]
+            for k in range(4):
+                k_ = sn > k
+                self.mem[sidx[k_], saddr[k_] + k] = (sval[k_] >> (8 * k)) & 0xFF
+
+        m = op == OPCODE["SYSTEM"]
+        if m.any():
+            c3, csr = f3[m], dins(ins[m], 31, 20)
+            ecall = (c3 == 0) & (rd[m] == 0)
+            gp = regs[m][:, 3]
+            done[m] = np.where(
+                ecall & (gp > 1),
+                FAILED,
+                np.where(((c3 == 0b001) | (c3 == 0b101)) & (csr == 3072), PASSED, 0),
+            )
+            # Without a CSR file CSRRS(I) & CSRRC(I) read back the CSR number.
+            rs = (c3 & 0b011) == 0b010
+            rc = (c3 & 0b011) == 0b011
+            val[m] = np.where(rc, csr & ~v1[m], csr)
+            wr[m] = rs | rc
+            # A halting instruction does not advance the pc.
+            npc[m] = np.where(done[m] != 0, pc[m], npc[m])
+
+        # RV32I only, atomics fault.
+        known = np.isin(op, [v for k, v in OPCODE.items() if k != "AMO"])
+        fault |= ~known
+
+        #
+        # Write back, faulting harts keep their state
+        #
+        wr &= (rd != 0) & ~fault
+        regs[rows[wr], rd[wr]] = val[wr]
+        regs[:, PC] = np.where(fault, pc, npc)
+        self.regs[idx] = (regs & M32).astype(np.uint32)
+        self.inscnt[idx[~fault & (done == 0)]] += 1
+        self.status[idx[fault]] = FAULT
+        self.status[idx[done != 0]] = done[done != 0]
+        return len(idx)
+
+    def run(self, limit: int = None) -> int:
+        """Steps until all harts stopped or limit steps ran, returns the steps."""
+        steps = 0
+        while (limit is None or steps < limit) and self.step():
+            steps += 1
+        return steps
+
+
+if __name__ == "__main__":
+    import glob
+    import time
+
+    files = [x for x in glob.glob(sys.argv[1]) if not x.endswith(".dump")]
+    h = Harts(len(files))
+    for i, x in enumerate(files):
+        h.load_elf(x, i)
+    t = time.perf_counter()
+    steps = h.run()
+    dt = time.perf_counter() - t
+    for x, s, c in zip(files, h.status, h.inscnt):
+        print(
+            "%-48s %-7s %d instructions"
+            % (x, ["RUNNING", "PASSED", "FAILED", "FAULT", "HALTED"][s], c)
+        )
+    print("%d steps, %d instructions in %.2fs" % (steps, h.inscnt.sum(), dt))
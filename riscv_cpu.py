@@ -1,9 +1,48 @@
 """32-Bit Processor"""
+import contextlib
 import struct
 import glob
+import sys
+import time
 
-from elf import elf_reader
-from riscv import ABI, OPCODE
+from devices import CLINT, Bus, Halt, virt
+from elf import dump_to_file, elf_code, elf_reader, elf_symbol
+from riscv import ABI, CSR, OPCODE
+
+# Index of the program counter in the register file.
+PC = 32
+# Returned by handlers which end a basic block, a control transfer or a CSR
+# write. Truthy like True, so step loops simply run on.
+BLOCK = 2
+
+MSTATUS, MIE, MTVEC, MEPC = CSR["mstatus"], CSR["mie"], CSR["mtvec"], CSR["mepc"]
+MCAUSE, MTVAL, MIP = CSR["mcause"], CSR["mtval"], CSR["mip"]
+# mstatus bits, M-mode only so MPP always reads back as machine mode.
+MSTATUS_MIE, MSTATUS_MPIE, MSTATUS_MPP = 1 << 3, 1 << 7, 3 << 11
+# mie bit of the timer interrupt.
+MIE_MTIE = 1 << 7
+# Writable bits of each CSR, all others read as 0 or are derived.
+WMASK = {
+    MSTATUS: MSTATUS_MIE | MSTATUS_MPIE,
+    MIE: 0x888,
+    MTVEC: ~0b10,
+    CSR["mscratch"]: ~0,
+    MEPC: ~0b11,
+    MCAUSE: ~0,
+    MTVAL: ~0,
+}
+TRAPS = {
+    0: "Misaligned jump",
+    2: "Illegal instruction",
+    3: "Breakpoint",
+    4: "Misaligned load",
+    6: "Misaligned store",
+}
+# Fewer words are decoded one by one faster than NumPy is imported.
+NUMPY_MIN = 8192
+# Instructions run between probes for idle loops, & the most instructions an
+# iteration of one may take.
+SPIN_CHECK, SPIN_MAX = 1 << 14, 64
 
 
 class Registers:
@@ -21,9 +60,12 @@ class Registers:
 
 def reset():
     """Initializes memory."""
-    global registers, memory, PC
+    global registers, memory, PC, decoded, bus, csrs, instret, irq, clint, tohost
+    global unfused, fused_by, fusions, reservation
     # 64k memory
-    memory = b"\x00" * 0x10000
+    memory = bytearray(0x10000)
+    # Devices mapped outside of memory, none by default.
+    bus = Bus()
     # Instruction registers: 31 general purpose registers & 2 special-purpose
     # registers that each contain 32 bits in RV32 CPU,
     #
@@ -31,6 +73,68 @@ def reset():
     registers = Registers()
     # Set PC to 32
     PC = 32
+    # Decoded instructions by address, each a (handler, rd, rs1, rs2, func3,
+    # func7, imm) tuple, filled by predecode or on first execution.
+    decoded = {}
+    # Control & status registers, the counters are offsets to instret.
+    csrs = dict.fromkeys(CSR.values(), 0)
+    csrs[CSR["misa"]] = (1 << 30) | (1 << 8) | 1
+    instret = 0
+    # Whether interrupts are enabled at all, & the timer raising them.
+    irq, clint = False, None
+    # Address of the riscv-tests tohost word, stores to it halt the cpu.
+    tohost = None
+    # Fused sequences, the plain decoded first instruction by the address of
+    # each, the address of each by those of the instructions they cover, &
+    # the number of times each idiom ran.
+    unfused, fused_by = {}, {}
+    fusions = dict.fromkeys(IDIOMS, 0)
+    # Reservation of the last LR, shared between harts by multihart.py.
+    reservation = Reservation()
+
+
+def load_elf(fn: str) -> int:
+    """Resets the cpu, loads an ELF file & sets the PC to its entry point.
+
+    The devices of the virt machine are attached, timed by instret, & a
+    tohost symbol ends the run like in the riscv-tests. Only the executable
+    segments are predecoded, data is decoded once it is run, if ever.
+    """
+    global memory, bus, tohost
+    from elftools.elf.elffile import ELFFile
+
+    reset()
+    memory = elf_reader(memory, fn)
+    bus = virt(clock=lambda: instret)
+    tohost = elf_symbol(fn, "tohost")
+    for base, size in elf_code(fn):
+        predecode(base, size)
+    with open(fn, "rb") as f:
+        registers[PC] = ELFFile(f).header.e_entry
+    return registers[PC]
+
+
+def load(fn: str) -> int:
+    """Loads an ELF file, a hex image or a raw binary & returns the entry point.
+
+    Hex images hold one 32 bit word per line. Both they & binaries are loaded
+    to & run from 0x80000000, with the devices of the virt machine attached,
+    without importing pyelftools.
+    """
+    global memory, bus
+    with open(fn, "rb") as f:
+        data = f.read()
+    if data[:4] == b"\x7fELF":
+        return load_elf(fn)
+    if fn.endswith(".hex"):
+        words = data.decode().split()
+        data = b"".join(int(w, 16).to_bytes(4, "little") for w in words)
+    reset()
+    memory[: len(data)] = data
+    bus = virt(clock=lambda: instret)
+    predecode(0x80000000, len(data))
+    registers[PC] = 0x80000000
+    return registers[PC]
 
 
 def registers_to_str(registers) -> str:
@@ -59,34 +163,55 @@ def dins(ins: int, e: int, s: int):
 
 
 def sext(val: int, bits: int):
-    """Performs sign extension by number of bits given."""
-    if val >> (bits - 1) == 1:
-        return -((1 << bits) - val)
-    else:
-        return val
+    """Performs sign extension by number of bits given.
+
+    Branch free, so it works the same on ints & NumPy integer arrays.
+    """
+    sb = 1 << (bits - 1)
+    return ((val & ((sb << 1) - 1)) ^ sb) - sb
 
 
-def wmem(addr, data):
-    """Write back to memory."""
-    global memory
-    addr -= 0x80000000
-    assert addr >= 0 and addr < len(memory)
-    memory = memory[:addr] + data + memory[addr + len(data) :]
+def wmem(addr: int, val: int, n: int = 4):
+    """Writes n bytes of val to memory, outside of memory to the bus."""
+    addr &= bm()
+    if addr == tohost:
+        # riscv-tests write 1 on success & the failed test number << 1 | 1.
+        raise Halt(val >> 1)
+    off = addr - 0x80000000
+    if off < 0 or off + n > len(memory):
+        return bus.write(addr, val, n)
+    memory[off : off + n] = (val & bm(8 * n)).to_bytes(n, "little")
+    # Stores to code drop the decoded instructions, they are decoded again.
+    a = addr & ~3
+    decoded.pop(a, None)
+    if (off & 3) + n > 4:
+        decoded.pop(a + 4, None)
+        decoded.pop(fused_by.get(a + 4), None)
+    decoded.pop(fused_by.get(a), None)
 
 
 def fetch32(addr):
-    addr -= 0x80000000
-    if addr < 0 or addr >= len(memory):
-        raise Exception("read out of memory: 0x%x" % addr)
-    return struct.unpack("I", memory[addr : addr + 4])[0]
+    return rmem(addr, 4)
+
+
+def rmem(addr: int, n: int, signed: bool = False) -> int:
+    """Reads n bytes from memory as little-endian integer.
+
+    Addresses outside of memory are read from the device bus.
+    """
+    off = (addr & bm()) - 0x80000000
+    if off < 0 or off + n > len(memory):
+        val = bus.read(addr & bm(), n)
+        return sext(val, 8 * n) if signed else val
+    return int.from_bytes(memory[off : off + n], "little", signed=signed)
 
 
 def imm_j(ins: int) -> int:
     """J-type instruction format."""
     return sext(
-        (dins(ins, 32, 31) << 20)
+        (dins(ins, 31, 31) << 20)
         | (dins(ins, 30, 21) << 1)
-        | (dins(ins, 21, 20) << 11)
+        | (dins(ins, 20, 20) << 11)
         | (dins(ins, 19, 12) << 12),
         21,
     )
@@ -121,15 +246,383 @@ def imm_b(ins: int) -> int:
     )
 
 
-def step():
-    """Process instructions."""
-    #
-    # (1) Instruction Fetch
-    #
-    ins = fetch32(registers[PC])
-    #
-    # (2) Instruction Decode
-    #
+#
+# Control & status registers & traps
+#
+def rcsr(csr: int) -> int:
+    """Reads a CSR, the counters are derived from instret.
+
+    mcycle & minstret hold the offset of the counter to instret, shared by
+    the upper halves & the user mode aliases.
+    """
+    if csr >> 8 in (0xB, 0xC):
+        if csr & 0x1F == 0x01:
+            val = clint.mtime if clint else instret
+        else:
+            val = instret + csrs[0xB00 | csr & 0x1F]
+        return (val >> 32 if csr & 0x80 else val) & bm()
+    if csr == MIP:
+        return (clint.msip << 3 | clint.pending() << 7) if clint else 0
+    if csr == MSTATUS:
+        return csrs[csr] | MSTATUS_MPP
+    return csrs[csr]
+
+
+def wcsr(csr: int, val: int):
+    """Writes the writable bits of a CSR & rearms interrupts."""
+    global irq, clint
+    if csr >> 8 == 0xB:
+        # The offset to instret moves, so the counter reads back val.
+        key = 0xB00 | csr & 0x1F
+        old = instret + csrs[key]
+        s = 32 if csr & 0x80 else 0
+        new = (old & ~(bm() << s)) | ((val & bm()) << s)
+        csrs[key] += new - old
+    elif csr in WMASK:
+        csrs[csr] = val & WMASK[csr] & bm()
+    irq = bool(csrs[MSTATUS] & MSTATUS_MIE and csrs[MIE])
+    clint = bus.get(CLINT)
+
+
+def trap(cause: int, tval: int = 0):
+    """Enters the trap handler at mtvec, returns BLOCK.
+
+    Programs without trap handler, mtvec of 0, stop with an exception.
+    """
+    if not csrs[MTVEC]:
+        from disasm import riscv
+
+        pc = registers[PC]
+        ins = riscv(fetch32(pc), pc, True) if 0 <= pc - 0x80000000 < len(memory) else ""
+        raise ValueError(
+            "%s at 0x%x: %s" % (TRAPS.get(cause, "Trap %d" % cause), pc, ins)
+        )
+    csrs[MEPC], csrs[MCAUSE], csrs[MTVAL] = registers[PC], cause, tval & bm()
+    ie = csrs[MSTATUS] & MSTATUS_MIE
+    csrs[MSTATUS] = (csrs[MSTATUS] & ~(MSTATUS_MIE | MSTATUS_MPIE)) | (ie << 4)
+    base, vectored = csrs[MTVEC] & ~3, csrs[MTVEC] & 1
+    registers[PC] = base + 4 * (cause & bm(31)) if vectored and cause >> 31 else base
+    wcsr(MSTATUS, csrs[MSTATUS])
+    return BLOCK
+
+
+def interrupt():
+    """Takes the highest priority pending & enabled interrupt, if any."""
+    pending = rcsr(MIP) & csrs[MIE]
+    # External, software & timer interrupts in order of priority.
+    for code in (11, 3, 7):
+        if pending >> code & 1:
+            return trap(1 << 31 | code)
+
+
+#
+# (3) Execution & (4) Memory Access, one handler per opcode. Each handler
+# writes back its result, moves the PC on & returns False to halt the cpu.
+#
+def _lui(rd, rs1, rs2, func3, func7, imm):
+    registers[rd] = imm
+    registers[PC] += 4
+    return True
+
+
+def _auipc(rd, rs1, rs2, func3, func7, imm):
+    registers[rd] = registers[PC] + imm
+    registers[PC] += 4
+    return True
+
+
+def _jal(rd, rs1, rs2, func3, func7, imm):
+    if imm & 3:
+        return trap(0, registers[PC] + imm)
+    if rd != 0:
+        registers[rd] = registers[PC] + 4
+    registers[PC] += imm
+    # j . waits for the timer.
+    return BLOCK if imm else spin()
+
+
+def _jalr(rd, rs1, rs2, func3, func7, imm):
+    wpc = (registers[rs1] + imm) & ~1
+    if wpc & 3:
+        return trap(0, wpc)
+    registers[rd] = registers[PC] + 4
+    registers[PC] = wpc
+    return BLOCK
+
+
+def _alu(rd, rs1, rs2, func3, func7, imm):
+    # ADDI (Add Immediate)
+    if func3 == 0b000:
+        registers[rd] = registers[rs1] + imm
+    # SLLI (Shift Left Logical Immediate)
+    elif func3 == 0b001:
+        registers[rd] = registers[rs1] << (imm & bm(5))
+    # SLTI (Set Less Than Immediate)
+    elif func3 == 0b010:
+        registers[rd] = 1 if sext(registers[rs1], 32) < sext(imm, 32) else 0
+    # SLTIU (Set Less Than Immediate Unsigned)
+    elif func3 == 0b011:
+        registers[rd] = 1 if (registers[rs1] & bm()) < (imm & bm()) else 0
+    # XORI (Exclusive OR Immediate)
+    elif func3 == 0b100:
+        registers[rd] = registers[rs1] ^ imm
+    # SRLI (Shift Right Logical Immediate) & SRAI (Shift Right Arithmetic Immediate)
+    elif func3 == 0b101:
+        if func7 == 0b0100000:
+            registers[rd] = sext(registers[rs1], 32) >> (imm & bm(5))
+        else:
+            registers[rd] = registers[rs1] >> (imm & bm(5))
+    # ORI (OR Immediate)
+    elif func3 == 0b110:
+        registers[rd] = registers[rs1] | imm
+    # ANDI (AND Immediate)
+    else:
+        registers[rd] = registers[rs1] & imm
+    registers[PC] += 4
+    return True
+
+
+def _op(rd, rs1, rs2, func3, func7, imm):
+    # ADD & SUB
+    if func3 == 0b000:
+        if func7 == 0b0:
+            registers[rd] = (registers[rs1] + registers[rs2]) & bm()
+        else:
+            registers[rd] = (registers[rs1] - registers[rs2]) & bm()
+    # SLL
+    elif func3 == 0b001:
+        registers[rd] = registers[rs1] << (registers[rs2] & bm(5))
+    # SLT (Set Less Than)
+    elif func3 == 0b010:
+        registers[rd] = 1 if sext(registers[rs1], 32) < sext(registers[rs2], 32) else 0
+    # SLTU (Set Less Than Unsigned)
+    elif func3 == 0b011:
+        registers[rd] = 1 if (registers[rs1] & bm()) < (registers[rs2] & bm()) else 0
+    # XOR (Exclusive OR)
+    elif func3 == 0b100:
+        registers[rd] = registers[rs1] ^ registers[rs2]
+    # SRA (Shift Right Arithmetic) & SRL (Shift Right Logical)
+    elif func3 == 0b101:
+        if func7 == 0b0100000:
+            registers[rd] = sext(registers[rs1], 32) >> (registers[rs2] & bm(5))
+        else:
+            registers[rd] = registers[rs1] >> (registers[rs2] & bm(5))
+    # OR
+    elif func3 == 0b110:
+        registers[rd] = registers[rs1] | registers[rs2]
+    # AND
+    else:
+        registers[rd] = registers[rs1] & registers[rs2]
+    registers[PC] += 4
+    return True
+
+
+def _system(rd, rs1, rs2, func3, func7, imm):
+    csr = imm & bm(12)
+    if func3 == 0b000:
+        # ECALL, without trap handler gp tells whether a test failed.
+        if csr == 0x000:
+            if csrs[MTVEC]:
+                return trap(11)
+            if registers[3] > 1:
+                # riscv-tests fail with gp set to the test number << 1 | 1.
+                raise Exception(
+                    f"Failure in current test {registers[3] >> 1}. gp {registers[3]}"
+                )
+        # EBREAK
+        elif csr == 0x001:
+            return trap(3)
+        # MRET
+        elif csr == 0x302:
+            pie = csrs[MSTATUS] & MSTATUS_MPIE
+            wcsr(MSTATUS, csrs[MSTATUS] & ~MSTATUS_MIE | MSTATUS_MPIE | (pie >> 4))
+            registers[PC] = csrs[MEPC]
+            return BLOCK
+        # WFI waits for the timer, if it is enabled to end the wait.
+        elif csr == 0x105:
+            registers[PC] += 4
+            c = bus.get(CLINT)
+            ticks = c and csrs[MIE] & MIE_MTIE and c.deadline()
+            if ticks:
+                skip(c, ticks)
+            return BLOCK
+        else:
+            return trap(2)
+        registers[PC] += 4
+        return True
+    # CSRRW(I), CSRRS(I) & CSRRC(I), the immediate forms take rs1 as value.
+    op, val = func3 & 0b011, rs1 if func3 & 0b100 else registers[rs1]
+    # unimp, a write to the read-only cycle, halts programs without trap handler.
+    if op == 0b01 and csr == 3072 and not csrs[MTVEC]:
+        print("  ecall", rd, rs1, csr, "success")
+        return False
+    write = op == 0b01 or rs1 != 0
+    if op == 0 or csr not in csrs or (write and csr >> 10 == 0b11):
+        return trap(2)
+    old = rcsr(csr)
+    if write:
+        wcsr(csr, val if op == 0b01 else old | val if op == 0b10 else old & ~val)
+    registers[rd] = old
+    registers[PC] += 4
+    return BLOCK if write else True
+
+
+def _branch(rd, rs1, rs2, func3, func7, imm):
+    # beq | bne | blt | bge | bltu | bgeu
+    if (
+        (func3 == 0b000 and registers[rs1] == registers[rs2])
+        | (func3 == 0b001 and registers[rs1] != registers[rs2])
+        | (func3 == 0b100 and sext(registers[rs1], 32) < sext(registers[rs2], 32))
+        | (func3 == 0b101 and sext(registers[rs1], 32) >= sext(registers[rs2], 32))
+        | (func3 == 0b110 and registers[rs1] < registers[rs2])
+        | (func3 == 0b111 and registers[rs1] >= registers[rs2])
+    ):
+        if imm & 3:
+            return trap(0, registers[PC] + imm)
+        registers[PC] += imm
+        # A branch to itself waits for the timer, its registers never change.
+        return BLOCK if imm else spin()
+    registers[PC] += 4
+    return True
+
+
+def _store(rd, rs1, rs2, func3, func7, imm):
+    # sb (Store Byte) | sh (Store Halfword) | sw (Store Word)
+    if func3 > 0b010:
+        raise ValueError("STORE instruction failure.")
+    try:
+        wmem(registers[rs1] + imm, registers[rs2], 1 << func3)
+    except Halt as e:
+        bus.flush()
+        if e.code:
+            raise Exception(f"Failure in current test. exit code {e.code}")
+        return False
+    registers[PC] += 4
+    return True
+
+
+def _load(rd, rs1, rs2, func3, func7, imm):
+    # lb (Load Byte)
+    if func3 == 0b000:
+        registers[rd] = rmem(registers[rs1] + imm, 1, True)
+    # lh (Load Halfword)
+    elif func3 == 0b001:
+        registers[rd] = rmem(registers[rs1] + imm, 2, True)
+    # lw (Load Word)
+    elif func3 == 0b010:
+        registers[rd] = rmem(registers[rs1] + imm, 4)
+    # lbu (Load Byte Unsigned)
+    elif func3 == 0b100:
+        registers[rd] = rmem(registers[rs1] + imm, 1)
+    # lhu (Load Halfword Unsigned)
+    elif func3 == 0b101:
+        registers[rd] = rmem(registers[rs1] + imm, 2)
+    else:
+        raise ValueError("LOAD instruction failure.")
+    registers[PC] += 4
+    return True
+
+
+def _fence(rd, rs1, rs2, func3, func7, imm):
+    # FENCE.I, code may have been written by another hart.
+    if func3 == 0b001:
+        decoded.clear()
+        unfused.clear()
+        fused_by.clear()
+    registers[PC] += 4
+    return True
+
+
+#
+# RV32A atomics, each read-modify-write holds the lock of the reservations.
+#
+class Reservation:
+    """The reservation set of LR/SC, a single word, of a single hart."""
+
+    lock = contextlib.nullcontext()
+
+    def __init__(self):
+        self.addr = None
+
+    def reserve(self, addr: int):
+        self.addr = addr
+
+    def take(self, addr: int) -> bool:
+        """Clears the reservation, returns whether an SC to addr succeeds."""
+        ok, self.addr = self.addr == addr, None
+        return ok
+
+
+LR, SC = 0b00010, 0b00011
+AMO = {
+    0b00001: lambda a, b: b,
+    0b00000: lambda a, b: a + b,
+    0b00100: lambda a, b: a ^ b,
+    0b01100: lambda a, b: a & b,
+    0b01000: lambda a, b: a | b,
+    0b10000: lambda a, b: min(a, b, key=lambda x: sext(x, 32)),
+    0b10100: lambda a, b: max(a, b, key=lambda x: sext(x, 32)),
+    0b11000: min,
+    0b11100: max,
+}
+
+
+def _amo(rd, rs1, rs2, func3, func7, imm):
+    # lr.w | sc.w | amoswap.w | amoadd.w | amoxor.w | amoand.w | amoor.w |
+    # amomin.w | amomax.w | amominu.w | amomaxu.w, aq & rl are implied.
+    op, addr = func7 >> 2, registers[rs1]
+    if func3 != 0b010 or (op not in AMO and op not in (LR, SC)):
+        return trap(2)
+    if addr & 3:
+        return trap(4 if op == LR else 6, addr)
+    with reservation.lock:
+        if op == LR:
+            registers[rd] = rmem(addr, 4)
+            reservation.reserve(addr)
+        elif op == SC:
+            ok = reservation.take(addr)
+            if ok:
+                wmem(addr, registers[rs2])
+            registers[rd] = 0 if ok else 1
+        else:
+            old = rmem(addr, 4)
+            wmem(addr, AMO[op](old, registers[rs2]))
+            registers[rd] = old
+    registers[PC] += 4
+    return True
+
+
+def _illegal(rd, rs1, rs2, func3, func7, imm):
+    return trap(2)
+
+
+HANDLERS = {
+    OPCODE["LUI"]: _lui,
+    OPCODE["AUIPC"]: _auipc,
+    OPCODE["JAL"]: _jal,
+    OPCODE["JALR"]: _jalr,
+    OPCODE["BRANCH"]: _branch,
+    OPCODE["LOAD"]: _load,
+    OPCODE["STORE"]: _store,
+    OPCODE["ALU"]: _alu,
+    OPCODE["OP"]: _op,
+    OPCODE["SYSTEM"]: _system,
+    OPCODE["FENCE"]: _fence,
+    OPCODE["AMO"]: _amo,
+}
+
+# Immediate format of each opcode, all others are I-type.
+IMM = {
+    OPCODE["LUI"]: imm_u,
+    OPCODE["AUIPC"]: imm_u,
+    OPCODE["JAL"]: imm_j,
+    OPCODE["BRANCH"]: imm_b,
+    OPCODE["STORE"]: imm_s,
+}
+
+
+def decode(ins: int) -> tuple:
+    """(2) Instruction Decode, returns the handler & operands of ins."""
     # Bitwise ops to decode the instruction.
     opscode = dins(ins, 6, 0)
     # Compute register destination.
@@ -140,216 +633,429 @@ def step():
     # Get instruction defining encodings.
     func3 = dins(ins, 14, 12)
     func7 = dins(ins, 31, 25)
+    imm = rs2 if opscode == OPCODE["OP"] else IMM.get(opscode, imm_i)(ins)
+    return HANDLERS.get(opscode, _illegal), rd, rs1, rs2, func3, func7, imm
 
-    write_new_pc = opscode in [OPCODE["JAL"], OPCODE["JALR"], OPCODE["BRANCH"]]
-    imm = {
-        OPCODE["LUI"]: imm_u(ins),
-        OPCODE["AUIPC"]: imm_u(ins),
-        OPCODE["JAL"]: imm_j(ins),
-        OPCODE["JALR"]: imm_i(ins),
-        OPCODE["BRANCH"]: imm_b(ins),
-        OPCODE["LOAD"]: imm_i(ins),
-        OPCODE["STORE"]: imm_s(ins),
-        OPCODE["ALU"]: imm_i(ins),
-        OPCODE["OP"]: rs2,
-        OPCODE["SYSTEM"]: imm_i(ins),
-        OPCODE["FENCE"]: imm_i(ins),
-    }[opscode]
 
-    #
-    # (3) Execution
-    #
-    if opscode == OPCODE["JAL"]:
-        if rd != 0:
-            registers[rd] = registers[PC] + 4
-        registers[PC] += imm
+def decode_all(data, off: int = 0, count: int = None) -> list[tuple]:
+    """Decodes count (default all) little-endian words of a buffer at once.
 
-    elif opscode == OPCODE["LUI"]:
-        registers[rd] = imm
+    The words are viewed as a NumPy array and all fields & immediates are
+    pulled out with array shifts & masks. Falls back to decoding word by word
+    without NumPy, & for fewer than NUMPY_MIN words unless it is imported.
 
-    elif opscode == OPCODE["AUIPC"]:
-        registers[rd] = registers[PC] + imm
+    :param data: Buffer holding the instructions, like memory.
+    :param off: Byte offset of the first instruction.
+    """
+    count = (len(data) - off) >> 2 if count is None else count
+    np = None
+    if count >= NUMPY_MIN or "numpy" in sys.modules:
+        with contextlib.suppress(ImportError):
+            import numpy as np
+    if np is None:
+        return [decode(w) for w in struct.unpack_from("<%dI" % count, data, off)]
 
-    elif opscode == OPCODE["JALR"]:
-        wpc = (registers[rs1] + imm) & ~1
-        registers[rd] = registers[PC] + 4
-        registers[PC] = wpc
-
-    elif opscode == OPCODE["ALU"]:
-        # ADDI (Add Immediate)
-        if func3 == 0b000:
-            registers[rd] = registers[rs1] + imm
-        # SLLI (Shift Left Logical Immediate)
-        elif func3 == 0b001:
-            registers[rd] = registers[rs1] << (imm & bm(5))
-        # SLTI (Set Less Than Immediate)
-        elif func3 == 0b010:
-            registers[rd] = 1 if sext(registers[rs1], 32) < sext(imm, 32) else 0
-        # SLTIU (Set Less Than Immediate Unsigned)
-        elif func3 == 0b011:
-            registers[rd] = 1 if (registers[rs1] & bm()) < (imm & bm()) else 0
-        # XORI (Exclusive OR Immediate)
-        elif func3 == 0b100:
-            registers[rd] = registers[rs1] ^ imm
-        # SRLI (Shift Right Logical Immediate) & SRAI (Shift Right Arithmetic Immediate)
-        elif func3 == 0b101:
-            if func7 == 0b0100000:
-                sb = registers[rs1] >> 31
-                if sb == 0:
-                    registers[rd] = registers[rs1] >> (imm & bm(5))
-                else:
-                    shamt = imm & bm(5)
-                    registers[rd] = (registers[rs1] >> shamt) ^ (
-                        bm(shamt) << (32 - shamt)
-                    )
-            else:
-                registers[rd] = registers[rs1] >> (imm & bm(5))
-        # ORI (OR Immediate)
-        elif func3 == 0b110:
-            registers[rd] = registers[rs1] | imm
-        # ANDI (AND Immediate)
-        elif func3 == 0b111:
-            registers[rd] = registers[rs1] & imm
-        else:
-            raise ValueError(f"ALU instruction failure.")
-
-    elif opscode == OPCODE["OP"]:
-        # ADD & SUB
-        if func3 == 0b000:
-            if func7 == 0b0:
-                registers[rd] = (registers[rs1] + registers[rs2]) & bm()
-            else:
-                registers[rd] = (registers[rs1] - registers[rs2]) & bm()
-        # SLL
-        elif func3 == 0b001:
-            registers[rd] = registers[rs1] << (registers[rs2] & bm(5))
-        # SLT (Set Less Than)
-        elif func3 == 0b010:
-            registers[rd] = (
-                1 if sext(registers[rs1], 32) < sext(registers[rs2], 32) else 0
-            )
-        # SLTU (Set Less Than Unsigned)
-        elif func3 == 0b011:
-            registers[rd] = (
-                1 if (registers[rs1] & bm()) < (registers[rs2] & bm()) else 0
-            )
-        # XOR (Exclusive OR)
-        elif func3 == 0b100:
-            registers[rd] = registers[rs1] ^ registers[rs2]
-        # SRA (Shift Right Arithmetic) & SRL (Shift Right Logical)
-        elif func3 == 0b101:
-            if func7 == 0b0100000:
-                registers[rd] = sext(registers[rs1], 32) >> sext(
-                    (registers[rs2] & bm(5)), 32
-                )
-            else:
-                registers[rd] = registers[rs1] >> (registers[rs2] & bm(5))
-        # OR
-        elif func3 == 0b110:
-            registers[rd] = registers[rs1] | registers[rs2]
-        # AND
-        elif func3 == 0b111:
-            registers[rd] = registers[rs1] & registers[rs2]
-        else:
-            raise ValueError(f"OP instruction failure.")
+    ins = np.frombuffer(data, "<u4", count, off).astype(np.int64)
+    op = dins(ins, 6, 0)
+    rs2 = dins(ins, 24, 20)
+    imm = np.select(
+        [
+            (op == OPCODE["LUI"]) | (op == OPCODE["AUIPC"]),
+            op == OPCODE["JAL"],
+            op == OPCODE["BRANCH"],
+            op == OPCODE["STORE"],
+            op == OPCODE["OP"],
+        ],
+        [imm_u(ins), imm_j(ins), imm_b(ins), imm_s(ins), rs2],
+        imm_i(ins),
+    )
+    return list(
+        zip(
+            [HANDLERS.get(o, _illegal) for o in op.tolist()],
+            dins(ins, 11, 7).tolist(),
+            dins(ins, 19, 15).tolist(),
+            rs2.tolist(),
+            dins(ins, 14, 12).tolist(),
+            dins(ins, 31, 25).tolist(),
+            imm.tolist(),
+        )
+    )
 
-    elif opscode == OPCODE["SYSTEM"]:
-        csr = dins(ins, 31, 20)
-        # ECALL
-        if rd == 0b000 and func3 == 0b000:
-            if registers[3] > 1:
-                raise Exception(f"Failure in current test. gp {registers[3]}")
-        # CSRRW & CSRRWI
-        elif (func3 == 0b001) | (func3 == 0b101):
-            if csr == 3072:
-                print("  ecall", rd, rs1, csr, "success")
-                return False
-        # CSRRS & CSRRSI
-        elif (func3 == 0b010) | (func3 == 0b110):
-            registers[rd] = csr
-        # CSRRC & CSRRCI
-        elif (func3 == 0b011) | (func3 == 0b111):
-            csr &= ~registers[rs1]
-            registers[rd] = csr
-        else:
-            raise ValueError(f"SYSTEM instruction failure.")
-
-    elif opscode == OPCODE["BRANCH"]:
-        # beq | bne | blt | bge | bltu | bgeu
-        if (
-            (func3 == 0b000 and registers[rs1] == registers[rs2])
-            | (func3 == 0b001 and registers[rs1] != registers[rs2])
-            | (func3 == 0b100 and sext(registers[rs1], 32) < sext(registers[rs2], 32))
-            | (func3 == 0b101 and sext(registers[rs1], 32) >= sext(registers[rs2], 32))
-            | (func3 == 0b110 and registers[rs1] < registers[rs2])
-            | (func3 == 0b111 and registers[rs1] >= registers[rs2])
-        ):
-            registers[PC] += imm
-            if not imm:
-                registers[PC] += 4
+
+#
+# Macro-op fusion of the idioms of compiled code, each sequence runs as one
+# handler. The rs2 field of a fused entry holds its number of instructions.
+#
+def _lui_addi(rd, rs1, n, func3, func7, imm):
+    # lui & addi loading a 32 bit constant.
+    global instret
+    fusions["lui+addi"] += 1
+    instret += 1
+    registers[rd] = imm
+    registers[PC] += 8
+    return True
+
+
+def _auipc_jalr(rd, rs1, n, func3, func7, imm):
+    # The call pseudo-op, the jalr links to rs1 & jumps relative to its pc.
+    global instret
+    fusions["auipc+jalr"] += 1
+    pc = registers[PC]
+    registers[rd] = pc + func7
+    registers[PC] = pc + 4
+    instret += 1
+    return _jalr(rs1, rd, 0, 0, 0, imm)
+
+
+def _auipc_lw(rd, rs1, n, func3, func7, imm):
+    # A pc-relative load, of a global or a literal, to rs1.
+    global instret
+    fusions["auipc+lw"] += 1
+    pc = registers[PC]
+    registers[rd] = pc + func7
+    registers[PC] = pc + 4
+    instret += 1
+    return _load(rs1, rd, 0, 0b010, 0, imm)
+
+
+def _spill(rd, rs1, n, func3, func7, imm):
+    # addi sp, sp, -N & the sw of the registers to the new frame, in func7.
+    global instret
+    fusions["spill"] += 1
+    registers[2] = registers[2] + imm
+    registers[PC] += 4
+    for rs2, off in func7:
+        instret += 1
+        r = _store(0, 2, rs2, 0b010, 0, off)
+        if r is not True:
+            return r
+    return True
+
+
+IDIOMS = {
+    "lui+addi": _lui_addi,
+    "auipc+jalr": _auipc_jalr,
+    "auipc+lw": _auipc_lw,
+    "spill": _spill,
+}
+FUSED = frozenset(IDIOMS.values())
+# Most stores fused into a spill.
+SPILL = 16
+
+
+def fuse(pcs: list[int], ds: list[tuple]) -> list[tuple]:
+    """Replaces the first instruction of each idiom by its fused handler.
+
+    The other instructions keep their entries, jumps may land on them. Stores
+    to a fused sequence drop it, see wmem.
+
+    :param pcs: Addresses of consecutive instructions.
+    :param ds: Their decoded tuples.
+    :returns: The decoded tuples with the fused entries.
+    """
+    out, i, n = list(ds), 0, len(ds)
+    while i < n - 1:
+        h, rd, rs1, _, func3, _, imm = ds[i]
+        h2, rd2, rs12, rs22, func32, _, imm2 = ds[i + 1]
+        f = None
+        if h is _lui and h2 is _alu and func32 == 0 and rd2 == rs12 == rd != 0:
+            f = (_lui_addi, rd, 0, 2, 0, 0, (imm + imm2) & 0xFFFFFFFF)
+        elif h is _auipc and rd != 0 and rs12 == rd:
+            if h2 is _jalr and func32 == 0:
+                f = (_auipc_jalr, rd, rd2, 2, 0, imm, imm2)
+            elif h2 is _load and func32 == 0b010:
+                f = (_auipc_lw, rd, rd2, 2, 0, imm, imm2)
+        elif h is _alu and func3 == 0 and rd == rs1 == 2 and imm < 0:
+            stores = []
+            for d in ds[i + 1 : i + 1 + SPILL]:
+                if d[0] is not _store or d[2] != 2 or d[4] != 0b010:
+                    break
+                stores.append((d[3], d[6]))
+            if stores:
+                f = (_spill, 2, 2, 1 + len(stores), 0, tuple(stores), imm)
+        if f is None:
+            i += 1
+            continue
+        out[i] = f
+        unfused[pcs[i]] = ds[i]
+        for j in range(1, f[3]):
+            fused_by[pcs[i + j]] = pcs[i]
+        i += f[3]
+    return out
+
+
+def plain(pc: int) -> tuple:
+    """Returns the decoded instruction at pc, never a fused one."""
+    d = decoded.get(pc)
+    if d is None:
+        return decode(fetch32(pc))
+    return unfused[pc] if d[0] in FUSED else d
+
+
+def unfuse():
+    """Puts the plain instructions back in place of all fused sequences."""
+    for pc, d in unfused.items():
+        if pc in decoded and decoded[pc][0] in FUSED:
+            decoded[pc] = d
+    unfused.clear()
+    fused_by.clear()
+
+
+def predecode(base: int = 0x80000000, size: int = None, fusion: bool = True):
+    """Decodes a whole code segment at once ahead of execution.
+
+    So step only has to look the decoded instruction up.
+
+    :param base: Address of the first instruction.
+    :param size: Size of the segment in bytes, defaults to the end of memory.
+    :param fusion: Whether to fuse the idioms of IDIOMS.
+    """
+    off = base - 0x80000000
+    size = (len(memory) - off if size is None else size) & ~3
+    pcs = range(base, base + size, 4)
+    ds = decode_all(memory, off, size >> 2)
+    decoded.update(zip(pcs, fuse(pcs, ds) if fusion else ds))
+
+
+#
+# Idle loops
+#
+class Probe:
+    """Stands in for the bus while probing a loop, records the devices used."""
+
+    def __init__(self, bus: Bus):
+        self.bus, self.devices, self.writes = bus, set(), 0
+
+    def read(self, addr: int, n: int) -> int:
+        self.devices.add(self.bus.find(addr)[0])
+        return self.bus.read(addr, n)
+
+    def write(self, addr: int, val: int, n: int):
+        self.writes += 1
+        self.bus.write(addr, val, n)
+
+    def __getattr__(self, name):
+        return getattr(self.bus, name)
+
+
+def skip(clint: CLINT, ticks: int, n: int = 1, limit: float = float("inf")):
+    """Lets up to ticks of the timer pass, n instructions of a loop at a time.
+
+    A virtual timer ticks with instret, which moves on by whole iterations,
+    at most to limit. The host clock is slept on instead.
+    """
+    global instret
+    if clint.realtime:
+        time.sleep(ticks / clint.freq)
+    else:
+        instret += max(min(ticks, limit - instret) // n, 0) * n
+
+
+def spin(n: int = 1, limit: float = float("inf")):
+    """Skips the iterations of a loop which cannot make progress, n
+    instructions each, up to the one in which the timer fires.
+
+    :returns: BLOCK, or False to halt if nothing can end the loop.
+    """
+    c = bus.get(CLINT)
+    ticks = c and c.deadline()
+    if ticks:
+        skip(c, ticks - 1, n, limit)
+        return BLOCK
+    if c and c.pending() and irq and csrs[MIE] & MIE_MTIE:
+        return BLOCK
+    return False
+
+
+def idle(limit: float = float("inf")) -> bool:
+    """Probes whether the cpu spins in a loop which cannot make progress.
+
+    The loop runs once more, at most SPIN_MAX instructions up to the pc it
+    started at. If the registers, CSRs & memory are the same again, with no
+    device written & none read which may still receive input, every further
+    iteration is the same until the timer fires & spin skips them.
+
+    :returns: False once the cpu halted.
+    """
+    global bus
+    pc, start = registers[PC], instret
+    state = (registers.registers[:], dict(csrs), bytes(memory))
+    probe = bus = Probe(bus)
+    try:
+        while instret - start < SPIN_MAX and instret < limit:
+            r = step(limit)
+            if r is not True:
+                if r is False:
+                    return False
+                if irq:
+                    interrupt()
+                if registers[PC] == pc:
+                    break
         else:
-            registers[PC] += 4
+            return True
+    finally:
+        bus = probe.bus
+    if probe.writes or any(d.receiving() for d in probe.devices):
+        return True
+    if (registers.registers, csrs, memory) != state:
+        return True
+    return spin(instret - start, limit) is not False
+
 
+def step(stop: float = float("inf")):
+    """Process instructions.
+
+    :param stop: Instruction count a fused sequence may not pass, it runs its
+        first instruction alone instead.
+    """
+    global instret
     #
-    # (4) Memory Access
+    # (1) Instruction Fetch & (2) Decode, looked up once decoded.
     #
-    elif opscode == OPCODE["STORE"]:
-        # sb (Store Byte)
-        if func3 == 0b000:
-            wmem(
-                registers[rs1] + imm,
-                struct.pack("B", registers[rs2] & bm(8)),
-            )
-        # sh (Store Halfword)
-        elif func3 == 0b001:
-            wmem(
-                registers[rs1] + imm,
-                struct.pack("H", registers[rs2] & bm(16)),
-            )
-        # sw (Store Word)
-        elif func3 == 0b010:
-            wmem(registers[rs1] + imm, struct.pack("I", registers[rs2]))
-        else:
-            raise ValueError("STORE instruction failure.")
-
-    elif opscode == OPCODE["LOAD"]:
-        # lb (Load Byte)
-        if func3 == 0b000:
-            registers[rd] = sext(fetch32(registers[rs1] + imm) & bm(8), 8)
-        # lh (Load Halfword)
-        elif func3 == 0b001:
-            registers[rd] = sext(fetch32(registers[rs1] + imm) & bm(16), 16)
-        # lw (Load Word)
-        elif func3 == 0b010:
-            registers[rd] = fetch32(registers[rs1] + imm)
-        # lbu (Load Byte Unsigned)
-        elif func3 == 0b100:
-            registers[rd] = fetch32(registers[rs1] + imm) & bm(8)
-        # lhu (Load Halfword Unsigned)
-        elif func3 == 0b101:
-            registers[rd] = fetch32(registers[rs1] + imm) & bm(16)
-        else:
-            raise ValueError("LOAD instruction failure.")
+    pc = registers[PC]
+    d = decoded.get(pc)
+    if d is None:
+        d = decoded[pc] = decode(fetch32(pc))
+    if d[0] in FUSED and instret + d[3] > stop:
+        d = unfused[pc]
     #
-    # (5) Write Back
+    # (3) Execution, (4) Memory Access & (5) Write Back
     #
-    if not write_new_pc:
-        registers[PC] += 4
-    return True
+    h, rd, rs1, rs2, func3, func7, imm = d
+    instret += 1
+    return h(rd, rs1, rs2, func3, func7, imm)
+
+
+def run(limit: int = None) -> int:
+    """Runs until the cpu halts or limit instructions ran, taking interrupts.
+
+    Pending interrupts are only checked where a handler returns BLOCK, after
+    control transfers & CSR writes, so straight-line code never pays for them.
+
+    A fused sequence which would pass the limit runs its first instruction
+    alone, a WFI waiting for the timer counts the ticks it waited though.
+
+    Every SPIN_CHECK instructions idle probes for a loop which cannot make
+    progress, skipping its iterations to the next timer interrupt or halting
+    if none can come.
+
+    :returns: Number of instructions executed.
+    """
+    global instret
+    regs, start = registers.registers, instret
+    stop = float("inf") if limit is None else instret + limit
+    # No fused sequence, at most 1 + SPILL long, can pass stop before tail.
+    check, tail = instret + SPIN_CHECK, stop - SPILL - 1
+    while instret < stop:
+        pc = regs[PC]
+        d = decoded.get(pc)
+        if d is None:
+            d = decoded[pc] = decode(fetch32(pc))
+        if instret >= tail and d[0] in FUSED and instret + d[3] > stop:
+            d = unfused[pc]
+        h, rd, rs1, rs2, func3, func7, imm = d
+        instret += 1
+        r = h(rd, rs1, rs2, func3, func7, imm)
+        if r is not True:
+            if r is False:
+                break
+            if irq:
+                interrupt()
+            if instret >= check:
+                if not idle(stop):
+                    break
+                check = instret + SPIN_CHECK
+    return instret - start
+
+
+def trace(limit: int = None, batch: int = 4096, mem: list = None):
+    """Runs like run, yields the PCs of the executed instructions in lists.
+
+    Timing models consume the lists, which keeps the cost of tracing to an
+    append per instruction.
+
+    :param batch: Number of PCs per list.
+    :param mem: List the addresses of loads & stores are appended to, with
+        bit 32 set for stores. The consumer clears it after each batch.
+    """
+    global instret
+    regs, stop, n, pcs = registers.registers, -1 if limit is None else limit, 0, []
+    while n != stop:
+        pc = regs[PC]
+        d = decoded.get(pc)
+        if d is None:
+            d = decoded[pc] = decode(fetch32(pc))
+        h, rd, rs1, rs2, func3, func7, imm = d
+        if h in FUSED:
+            # Traces hold every instruction, fused ones run one by one.
+            h, rd, rs1, rs2, func3, func7, imm = unfused[pc]
+        instret += 1
+        n += 1
+        pcs.append(pc)
+        if mem is not None and (h is _load or h is _store):
+            mem.append((regs[rs1] + imm) & 0xFFFFFFFF | (h is _store) << 32)
+        try:
+            r = h(rd, rs1, rs2, func3, func7, imm)
+        except Exception:
+            # The trace up to a failing instruction still counts.
+            yield pcs
+            raise
+        if len(pcs) == batch:
+            yield pcs
+            pcs = []
+        if r is not True:
+            if r is False:
+                break
+            if irq:
+                interrupt()
+    if pcs:
+        yield pcs
+
+
+def bbv(interval: int, limit: int = None):
+    """Runs like run, yields the basic block vector of each interval.
+
+    A vector maps the address each block was entered at to the instructions
+    run in it. Blocks end where handlers return BLOCK, so an interval closes
+    at the first block end after interval instructions.
+    """
+    global instret
+    regs, vec = registers.registers, {}
+    stop = float("inf") if limit is None else instret + limit
+    last, entry, end = instret, regs[PC], instret + interval
+    while instret < stop:
+        pc = regs[PC]
+        d = decoded.get(pc)
+        if d is None:
+            d = decoded[pc] = decode(fetch32(pc))
+        h, rd, rs1, rs2, func3, func7, imm = d
+        instret += 1
+        r = h(rd, rs1, rs2, func3, func7, imm)
+        if r is not True:
+            if r is False:
+                break
+            if irq:
+                interrupt()
+            vec[entry] = vec.get(entry, 0) + instret - last
+            last, entry = instret, regs[PC]
+            if instret >= end:
+                yield vec
+                vec, end = {}, instret + interval
+    if instret > last:
+        vec[entry] = vec.get(entry, 0) + instret - last
+    if vec:
+        yield vec
 
 
 if __name__ == "__main__":
-    for x in glob.glob("modules/riscv-tests/isa/rv32ui-p-*"):
+    for x in sorted(glob.glob("modules/riscv-tests/isa/rv32[um]i-p-*")):
         if x.endswith(".dump"):
             continue
         print(f"Execute : {x}")
-        # Reset memory and registers.
-        reset()
-        # Reading the elf program header to memory.
-        memory = elf_reader(memory, x, True)
-
-        registers[PC] = 0x80000000
-        inscnt = 0
-        while step():
-            inscnt += 1
-        print("  ran %d instructions\n" % inscnt)
+        # Reset memory & registers & read the elf program header to memory.
+        load_elf(x)
+        dump_to_file(x, memory)
+        inscnt = run()
+        bus.flush()
+        print("  ran %d instructions" % inscnt)
+        print("  fused: %s\n" % ", ".join("%s %d" % f for f in fusions.items()))
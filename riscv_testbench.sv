@@ -6,6 +6,10 @@ module testbench;
   reg resetn;
   wire trap;
   reg [7:0] cnt;
+  // Clock cycles run & the limit, +cycles=N. +trace prints every step.
+  integer cycle = 0;
+  integer cycles;
+  reg trace;
 
   riscv c (
     .clk (clk),
@@ -36,11 +40,12 @@ module testbench;
 
   always @(posedge clk) begin
     cnt <= cnt + 1;
+    cycle <= cycle + 1;
     resetn <= 0;
   end
 
   always @(posedge clk) begin
-    if (c.step[6] == 1'b1) begin
+    if (trace && c.step[6] == 1'b1) begin
       $display("%b: %h %d pc:%h -- opcode:%b -- func:%h alt:%d left:%h imm:%h pend:%h d_addr:%h d_data:%h trap:%d",
         c.step, c.i_data, c.resetn, c.pc, c.opcode, c.alu_func, c.alu_alt, c.alu_left, c.alu_imm, c.pend, c.d_addr, c.d_data, c.trap);
     end
@@ -48,12 +53,16 @@ module testbench;
 
   always @(posedge trap) begin
     $display("TRAP", c.regs[3]);
+    $display("cycles %0d", cycle);
     $finish;
   end
 
   initial begin
     int char_0, char_1, char_2, char_3;
-    #50000
+    trace = $test$plusargs("trace");
+    if (!$value$plusargs("cycles=%d", cycles))
+      cycles = 5000;
+    repeat (cycles) @(posedge clk);
     // At the end of risc-v test, we should see OK\n or
     // Err\n in registers a0-a3 ()
     char_0 = `hdl_path_regf[10];
@@ -61,6 +70,7 @@ module testbench;
     char_2 = `hdl_path_regf[12];
     char_3 = `hdl_path_regf[13];
     $display($sformatf("RISC-V TEST Result: %s%s%s%s", char_0, char_1, char_2, char_3));
+    $display("cycles %0d", cycle);
     $finish;
   end
 endmodule
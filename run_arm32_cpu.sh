@@ -1,5 +1,3 @@
 #!/bin/bash -e
-python3 makehex.py $1 > /tmp/test.bin
-iverilog -Wall -g2012 -o acpu cpu_testbench.v cpu/ram.v cpu/arm_cpu.v && vvp acpu +firmware=test/subtract.hex
-rm -rf acpu 
-rm -rf tmp/test.bin
+# Runs hex images on the ARM core, e.g. ./run_arm32_cpu.sh test/subtract.hex
+exec python3 "$(dirname "$0")/vsim.py" arm "${@:-test/subtract.hex}"
@@ -1,5 +1,3 @@
 #!/bin/bash -e
-python3 makehex.py $1 > test.bin
-iverilog -Wall -g2012 -o riscv riscv_testbench.sv cpu/riskv_cpu.v && vvp riscv +firmware=test.bin
-rm -rf riscv 
-rm -rf test.bin
+# Runs binaries or hex images on the RISC-V core, e.g. ./run_riskv_cpu.sh test.bin
+exec python3 "$(dirname "$0")/vsim.py" riscv "$@"
@@ -0,0 +1,281 @@
+"""Sampled Simulation
+
+Estimates the statistics of the timing models of pipeline.py & uarch.py for
+a whole run from a few detailed windows, SimPoint style. riscv_cpu
+fast-forwards with run, the cheapest functional mode, & switches to trace
+for each window, warming the models up first. Both work on the same cpu
+state, so the cost of the detailed models is bounded by the sample size, not
+the program length.
+
+Windows are either taken at a fixed interval or at the simulation points a
+profiling run picks. That run records the basic block vector of every
+interval, clusters the vectors with k-means & picks the interval closest to
+the center of each cluster, weighted by the size of the cluster.
+
+    $ python sampling.py program.elf --interval 100000 --window 10000
+    $ python sampling.py program.elf --simpoints 5 --icache 4096:2:32:lru
+"""
+import argparse
+import time
+from itertools import accumulate
+
+import numpy as np
+
+import riscv_cpu
+from pipeline import Pipeline
+from uarch import UArch, cache, predictor
+
+
+#
+# Detailed Windows
+#
+def counters(model) -> dict:
+    """Returns the event counters of a Pipeline or UArch by name."""
+    c = {"instructions": model.instructions}
+    if isinstance(model, Pipeline):
+        c["cycles"] = model.ex + 1
+        c.update(("%s stalls" % k, v) for k, v in model.stalls.items())
+        return c
+    c.update(loads=model.loads, stores=model.stores)
+    for name, caches in (("I$", model.icaches), ("D$", model.dcaches)):
+        for x in caches:
+            c[f"{name} {x} misses"] = x.misses
+    for p in model.predictors:
+        c[f"BP {p} mispredicts"] = p.mispredicts
+    return c
+
+
+def detailed(models: list, n: int) -> int:
+    """Runs n instructions through the models, returns the number run."""
+    mem, cnt = [], 0
+    for pcs in riscv_cpu.trace(n, mem=mem):
+        cnt += len(pcs)
+        for m in models:
+            if isinstance(m, UArch):
+                m.feed(pcs, mem)
+            else:
+                m.feed(pcs)
+        mem.clear()
+    # The outcome of the last branch is unknown, the run goes on elsewhere.
+    for m in models:
+        if isinstance(m, Pipeline):
+            m.finish()
+        else:
+            m.last = None
+    return cnt
+
+
+def window(models: list, warmup: int, n: int) -> tuple:
+    """Warms the models up & returns the counters of the next n instructions.
+
+    :returns: The differences of the counters & whether the program halted.
+    """
+    if warmup and detailed(models, warmup) < warmup:
+        return None, True
+    before = [counters(m) for m in models]
+    cnt = detailed(models, n)
+    delta = {}
+    for m, b in zip(models, before):
+        delta.update((k, v - b[k]) for k, v in counters(m).items())
+    return delta, cnt < n
+
+
+def forward(n: int) -> bool:
+    """Fast-forwards n instructions, returns whether the program halted."""
+    return n > 0 and riscv_cpu.run(n) < n
+
+
+def extrapolate(samples: list[tuple], total: int) -> dict:
+    """Scales the weighted per-instruction rates of the samples to total.
+
+    :param samples: (weight, counters) of each window.
+    :param total: Instructions of the whole run.
+    """
+    samples = [(w, c) for w, c in samples if c and c["instructions"]]
+    norm = sum(w for w, _ in samples)
+    stats = {"instructions": total}
+    for k in samples[0][1] if samples else ():
+        if k != "instructions":
+            rate = sum(w * c[k] / c["instructions"] for w, c in samples) / norm
+            stats[k] = rate * total
+    return stats
+
+
+#
+# Periodic Sampling
+#
+def periodic(models: list, interval: int, n: int, warmup: int = 0) -> tuple:
+    """Takes a window of n instructions every interval instructions.
+
+    :returns: The extrapolated statistics & the number of windows.
+    """
+    samples = []
+    while True:
+        if forward(interval - warmup - n):
+            break
+        delta, halted = window(models, warmup, n)
+        if delta:
+            samples.append((1, delta))
+        if halted:
+            break
+    return extrapolate(samples, riscv_cpu.instret), len(samples)
+
+
+#
+# Simulation Points
+#
+def profile(interval: int, limit: int = None) -> list[dict]:
+    """Returns the basic block vectors of the intervals of a run."""
+    return list(riscv_cpu.bbv(interval, limit))
+
+
+def project(vectors: list[dict], dims: int = 15, seed: int = 0) -> np.ndarray:
+    """Normalizes the vectors & projects them to dims random dimensions."""
+    blocks = sorted({pc for v in vectors for pc in v})
+    index = {pc: i for i, pc in enumerate(blocks)}
+    m = np.zeros((len(vectors), len(blocks)))
+    for i, v in enumerate(vectors):
+        for pc, cnt in v.items():
+            m[i, index[pc]] = cnt
+    m /= np.maximum(m.sum(axis=1, keepdims=True), 1)
+    rnd = np.random.default_rng(seed)
+    return m @ rnd.uniform(-1, 1, (len(blocks), dims))
+
+
+def kmeans(x: np.ndarray, k: int, seed: int = 0, runs: int = 5) -> tuple:
+    """Clusters the rows of x, the best of a few runs of Lloyd's algorithm.
+
+    :returns: The centers & the cluster of each row.
+    """
+    rnd = np.random.default_rng(seed)
+    k = min(k, len(x))
+    best = None
+    for _ in range(runs):
+        # k-means++ seeding, spread out the initial centers.
+        centers = x[[rnd.integers(len(x))]]
+        while len(centers) < k:
+            d = ((x[:, None] - centers[None]) ** 2).sum(-1).min(1)
+            p = d / d.sum() if d.sum() else None
+            centers = np.vstack([centers, x[rnd.choice(len(x), p=p)]])
+        for _ in range(100):
+            labels = ((x[:, None] - centers[None]) ** 2).sum(-1).argmin(1)
+            new = np.array(
+                [
+                    x[labels == j].mean(0) if (labels == j).any() else centers[j]
+                    for j in range(k)
+                ]
+            )
+            if np.allclose(new, centers):
+                break
+            centers = new
+        inertia = ((x - centers[labels]) ** 2).sum()
+        if best is None or inertia < best[0]:
+            best = (inertia, centers, labels)
+    return best[1], best[2]
+
+
+def simpoints(vectors: list[dict], k: int, dims: int = 15, seed: int = 0) -> list:
+    """Picks the intervals closest to the center of each cluster.
+
+    :returns: (start, length, weight) of each picked interval in the order of
+        the run, start counted in instructions from that of the profile.
+    """
+    x = project(vectors, dims, seed)
+    centers, labels = kmeans(x, k, seed)
+    sizes = [sum(v.values()) for v in vectors]
+    starts = list(accumulate(sizes, initial=0))
+    points = []
+    for j in range(len(centers)):
+        members = np.flatnonzero(labels == j)
+        if len(members):
+            i = int(members[((x[members] - centers[j]) ** 2).sum(1).argmin()])
+            points.append((starts[i], sizes[i], len(members) / len(x)))
+    return sorted(points)
+
+
+def sample_points(models: list, points: list, warmup: int = 0) -> list[tuple]:
+    """Runs a window of each simulation point, the program loaded from reset.
+
+    :param points: (start, length, weight) of each point in the order of the
+        run.
+    :returns: (weight, counters) of each window.
+    """
+    samples, base = [], riscv_cpu.instret
+    for start, n, w in points:
+        # Fast-forward to the start of the interval, less the warmup.
+        skip = base + start - warmup - riscv_cpu.instret
+        if forward(skip):
+            break
+        delta, halted = window(models, warmup + min(skip, 0), n)
+        if delta:
+            samples.append((w, delta))
+        if halted:
+            break
+    return samples
+
+
+def report(stats: dict) -> str:
+    lines = ["  %d instructions (estimated)" % stats["instructions"]]
+    if "cycles" in stats:
+        lines.append(
+            "  %d cycles, CPI %.3f"
+            % (stats["cycles"], stats["cycles"] / max(stats["instructions"], 1))
+        )
+    for k, v in stats.items():
+        if k not in ("instructions", "cycles"):
+            lines.append("  %-40s %d" % (k, v))
+    return "\n".join(lines)
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("file", help="ELF file")
+    p.add_argument("--interval", type=int, default=100000)
+    p.add_argument("--window", type=int, default=10000, help="periodic windows")
+    p.add_argument("--warmup", type=int, default=1000)
+    p.add_argument("--simpoints", type=int, default=0, help="clusters, k")
+    p.add_argument("--icache", action="append", default=[])
+    p.add_argument("--dcache", action="append", default=[])
+    p.add_argument("--bp", action="append", default=[])
+    p.add_argument("--full", action="store_true", help="compare to a full run")
+    a = p.parse_args()
+
+    def models():
+        u = UArch(map(cache, a.icache), map(cache, a.dcache), map(predictor, a.bp))
+        return [Pipeline()] + ([u] if a.icache or a.dcache or a.bp else [])
+
+    start = time.perf_counter()
+    riscv_cpu.load_elf(a.file)
+    if a.simpoints:
+        vectors = profile(a.interval)
+        total = riscv_cpu.instret
+        points = simpoints(vectors, a.simpoints)
+        print(
+            "Simulation points: "
+            + ", ".join("%d (%.1f%%)" % (i, 100 * w) for i, _, w in points)
+        )
+        riscv_cpu.load_elf(a.file)
+        stats = extrapolate(sample_points(models(), points, a.warmup), total)
+    else:
+        stats, n = periodic(models(), a.interval, a.window, a.warmup)
+        print(f"{n} windows of {a.window} instructions")
+    riscv_cpu.bus.flush()
+    print(report(stats))
+    print("  in %.2fs" % (time.perf_counter() - start))
+
+    if a.full:
+        start = time.perf_counter()
+        riscv_cpu.load_elf(a.file)
+        ms = models()
+        detailed(ms, None)
+        riscv_cpu.bus.flush()
+        full = {}
+        for m in ms:
+            full.update(counters(m))
+        print("Full detailed run:")
+        print(report(full).replace(" (estimated)", ""))
+        print("  in %.2fs" % (time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
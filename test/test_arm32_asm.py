@@ -1,43 +1,72 @@
 import sys
 import os
+import io
 import unittest
 from pathlib import Path
 
 sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
 
-from arm_asm import asm32, parser
+from arm_asm import tokenize, Program
+import armcorpus
 
 TESTFS = ["testfs/arm32_subtract.s", "testfs/arm32_prime.s", "testfs/arm32_fib.s"]
-TARGETFS = ["test/subtract.hex", "test/prime.hex", "test/fib.hex"]
 
 
 class TestARMAssembler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.results = armcorpus.check_all(armcorpus.discover())
+
     def test_arm_asm(self):
-        ts, asmfs = [], []
-        for x in TESTFS:
+        self.assertTrue(any(r["golden"] for r in self.results))
+        for r in self.results:
+            with self.subTest(file=r["file"]):
+                if r["golden"] is None:
+                    self.skipTest("no expected image, build it with --build")
+                self.assertNotIn("error", r)
+                for m in r["mismatches"]:
+                    with self.subTest(word=m[0]):
+                        self.fail(f"{r['file']}\n" + armcorpus.describe(*m))
+
+    def test_diff(self):
+        self.assertEqual(armcorpus.diff([1, None, 3, 0], [1, 2, 3]), [])
+        self.assertEqual(
+            armcorpus.diff([1, 2, 5], [1, 2, 3, 4]), [(2, 5, 3), (3, None, 4)]
+        )
+        self.assertIn("(missing)", armcorpus.describe(*armcorpus.diff([1, 2], [1])[0]))
+
+    def test_tokenize_stream(self):
+        src = (
+            "\t.text\n\t.global\tmain\nmain:\n\tpush\t{fp, lr}\n\tldr\tr3, [fp, #-8]\n"
+            ".L3:\n\tstr\tfp, [sp, #-4]!\n\t@ c\n\tldmfd\tsp!, {r4, r5}\n\t.word\t.LC0\n"
+        )
+        D, L, I, C = (
+            Program.DIRECTIVE,
+            Program.LABEL,
+            Program.INSTRUCTION,
+            Program.COMMENT,
+        )
+        self.assertEqual(
+            list(tokenize(io.StringIO(src))),
+            [
+                (D, [".text"], None),
+                (D, [".global", "main"], None),
+                (L, ["main:"], 0),
+                (I, ["push", "{", "fp", "lr", "}"], 0),
+                (I, ["ldr", "r3", "[", "fp", "#-8", "]"], 1),
+                (L, [".L3:"], 2),
+                (I, ["str", "fp", "[", "sp", "#-4", "]", "!"], 2),
+                (C, ["@", "c"], None),
+                (I, ["ldmfd", "sp!", "{", "r4", "r5", "}"], 3),
+                (D, [".word", ".LC0"], None),
+            ],
+        )
+        # Tokens are yielded while reading, with each instruction of the files.
+        for x, n in zip(TESTFS, (16, 41, 51)):
             with open(x, "r") as f:
-                asmfs.append(asm32(parser(f.read())))
-
-        for x in TARGETFS:
-            with open(x, "rb") as f:
-                ts.append(list(filter(None, f.read().replace(b" ", b"").split(b"\n"))))
-
-        for i, t in enumerate(ts):
-            for j, y in enumerate(t):
-                try:
-                    ts[i][j] = int(y, base=16)
-                except ValueError:
-                    ts[i][j] = str("*")
-
-        for i, (t, asm) in enumerate(zip(ts, asmfs)):
-            for j, (y, x) in enumerate(zip(t, asm)):
-                if type(t[j]) == str:
-                    continue
-                self.assertEqual(
-                    y,
-                    x,
-                    f"Test {i + 1} of {TESTFS[i]} failed for instruction {j+1}: target: {hex(t[j])} != actual: {hex(asm[j])}.",
-                )
+                ts = tokenize(f)
+                self.assertEqual(next(ts).kind, Program.DIRECTIVE)
+                self.assertEqual(sum(t.kind == I for t in ts), n)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import sys
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import arm_cpu
+from arm_asm import asm32, dump_to_elf, dump_to_hex, tokenize
+
+
+def execute(ins: list[int], **regs) -> int:
+    with tempfile.TemporaryDirectory() as d:
+        dump_to_hex(ins, os.path.join(d, "t.hex"))
+        arm_cpu.reset()
+        arm_cpu.load(os.path.join(d, "t.hex"))
+    for r, v in regs.items():
+        arm_cpu.R[int(r[1:])] = v
+    return arm_cpu.run(10000)
+
+
+class TestARMProcessor(unittest.TestCase):
+    def test_subtract(self):
+        arm_cpu.reset()
+        arm_cpu.load("test/subtract.hex")
+        self.assertEqual(arm_cpu.run(), 16)
+        self.assertEqual(arm_cpu.R[0], 0)
+        self.assertEqual(arm_cpu.R[13], 0x10000)
+        self.assertEqual(arm_cpu.R[15], arm_cpu.HALT)
+
+    def test_load_elf(self):
+        with open("testfs/arm32_subtract.s", "r") as f:
+            ts = list(tokenize(f))
+        ins = asm32([t._replace(words=list(t.words)) for t in ts])
+        with tempfile.TemporaryDirectory() as d:
+            # ELF files are told by their magic bytes, not by their name.
+            dump_to_elf(ins, ts, os.path.join(d, "subtract"))
+            arm_cpu.reset()
+            self.assertEqual(arm_cpu.load(os.path.join(d, "subtract")), 0x10000)
+        self.assertEqual((arm_cpu.BASE, arm_cpu.R[15]), (0x10000, 0x10000))
+        self.assertEqual(arm_cpu.run(), 16)
+        self.assertEqual(arm_cpu.R[15], arm_cpu.HALT)
+
+    def test_fib(self):
+        arm_cpu.reset()
+        arm_cpu.load("test/fib.hex")
+        arm_cpu.R[0] = 9
+        arm_cpu.run()
+        self.assertEqual(arm_cpu.R[0], 34)
+
+    def test_fib_asm(self):
+        with open("testfs/arm32_fib.s", "r") as f:
+            ins = asm32(tokenize(f))
+        execute(ins, r0=12)
+        self.assertEqual(arm_cpu.R[0], 144)
+
+    def test_execute(self):
+        execute(
+            [
+                0xE3A00001,  # mov r0, #1
+                0xE1A01F80,  # mov r1, r0, lsl #31
+                0xE0912001,  # adds r2, r1, r1
+                0x03A0A001,  # moveq r10, #1
+                0xE3E03000,  # mvn r3, #0
+                0xE1B04023,  # movs r4, r3, lsr #32
+                0x23A0B001,  # movcs r11, #1
+                0xE3500002,  # cmp r0, #2
+                0xB3A05007,  # movlt r5, #7
+                0xA3A06007,  # movge r6, #7
+                0xE92D0003,  # push {r0, r1}
+                0xE8BD000C,  # pop {r2, r3}
+                0xE0070595,  # mul r7, r5, r5
+                0xE52D5004,  # str r5, [sp, #-4]!
+                0xE5DD8000,  # ldrb r8, [sp]
+                0xE49D9004,  # ldr r9, [sp], #4
+                0xE12FFF1E,  # bx lr
+            ]
+        )
+        R = arm_cpu.R
+        self.assertEqual(R[10], 1)
+        self.assertEqual((R[4], R[11]), (0, 1))
+        self.assertEqual((R[5], R[6]), (7, 0))
+        self.assertEqual((R[2], R[3]), (1, 0x80000000))
+        self.assertEqual((R[7], R[8], R[9]), (49, 7, 7))
+        self.assertEqual(R[13], 0x10000)
+
+    def test_long_multiply(self):
+        execute(
+            [
+                0xE0810392,  # umull r0, r1, r2, r3
+                0xE0C54392,  # smull r4, r5, r2, r3
+                0xE0A10392,  # umlal r0, r1, r2, r3
+                0xE0F54392,  # smlals r4, r5, r2, r3
+                0x43A06001,  # movmi r6, #1
+                0x03A07001,  # moveq r7, #1
+                0xE12FFF1E,  # bx lr
+            ],
+            r2=0xFFFFFFFF,
+            r3=2,
+        )
+        R = arm_cpu.R
+        self.assertEqual((R[0], R[1]), (0xFFFFFFFC, 3))
+        self.assertEqual((R[4], R[5]), (0xFFFFFFFC, 0xFFFFFFFF))
+        self.assertEqual((R[6], R[7]), (1, 0))
+
+    def test_lazy_flags(self):
+        execute(
+            [
+                0xE3A00102,  # mov r0, #0x80000000
+                0xE3500001,  # cmp r0, #1
+                0xE3B01000,  # movs r1, #0
+                0xE10F2000,  # mrs r2, cpsr
+                0x63A03001,  # movvs r3, #1
+                0x23A04001,  # movcs r4, #1
+                0x03A05001,  # moveq r5, #1
+                0xE2B16000,  # adcs r6, r1, #0
+                0x33A07001,  # movcc r7, #1
+                0xE12FFF1E,  # bx lr
+            ]
+        )
+        R = arm_cpu.R
+        self.assertEqual(R[2], 0x70000010)
+        self.assertEqual((R[3], R[4], R[5], R[6], R[7]), (1, 1, 1, 1, 1))
+        self.assertEqual(arm_cpu.nzcv(), [0, 0, 0, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys
+import os
+import contextlib
+import io
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import asmbuild
+from arm_asm import asm32, parser
+
+SOURCE = Path("testfs/arm32_subtract.s").read_text()
+
+
+class TestAsmBuild(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.dir.name, "cache")
+        self.fn = os.path.join(self.dir.name, "arm_sub.s")
+        Path(self.fn).write_text(SOURCE)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def build(self, fn=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return asmbuild.build([fn or self.fn], jobs=1, cache=self.cache)
+
+    def test_hit_and_miss(self):
+        res = self.build()[self.fn]
+        self.assertEqual(res["text"], asm32(parser(SOURCE)))
+        # The cached tokens are left intact by the encoding.
+        self.assertEqual(res["tokens"], parser(SOURCE))
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+
+        with mock.patch.object(asmbuild, "assemble", side_effect=AssertionError):
+            self.assertEqual(self.build()[self.fn]["text"], res["text"])
+
+        # A changed source misses.
+        Path(self.fn).write_text(SOURCE + "\n")
+        self.build()
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+    def test_version_invalidates(self):
+        self.build()
+        with mock.patch.object(asmbuild, "asm_version", return_value="changed"):
+            with mock.patch.object(
+                asmbuild, "assemble", wraps=asmbuild.assemble
+            ) as assemble:
+                self.build()
+        assemble.assert_called_once()
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+    def test_same_source_once(self):
+        copy = os.path.join(self.dir.name, "arm_copy.s")
+        Path(copy).write_text(SOURCE)
+        with mock.patch.object(asmbuild, "assemble", wraps=asmbuild.assemble) as a:
+            with contextlib.redirect_stdout(io.StringIO()):
+                res = asmbuild.build([self.fn, copy], jobs=1, cache=self.cache)
+        a.assert_called_once()
+        self.assertEqual(res[copy]["text"], res[self.fn]["text"])
+        # Only the entry is left, no temp file.
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+
+    def test_failures_not_cached(self):
+        bad = os.path.join(self.dir.name, "arm_bad.s")
+        Path(bad).write_text("main:\n\tfrobnicate r0, r1\n")
+        for _ in range(2):
+            self.assertIn("error", self.build(bad)[bad])
+            self.assertFalse(os.path.exists(self.cache) and os.listdir(self.cache))
+
+
+if __name__ == "__main__":
+    unittest.main()
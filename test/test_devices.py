@@ -0,0 +1,68 @@
+import sys
+import os
+import io
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import riscv_cpu
+from devices import CLINT, UART, virt
+from fuzz import enc_i, enc_s
+
+
+class TestDevices(unittest.TestCase):
+    def test_uart_batching(self):
+        out = io.BytesIO()
+        uart = UART(out, io.BytesIO(b"ab"), limit=4)
+        for c in b"hel":
+            uart.write(UART.THR, c, 1)
+        self.assertEqual(out.getvalue(), b"")
+        uart.write(UART.THR, ord("l"), 1)
+        self.assertEqual(out.getvalue(), b"hell")
+        self.assertEqual(uart.read(UART.LSR, 1) & UART.DR, UART.DR)
+        self.assertEqual([uart.read(UART.RBR, 1) for _ in range(2)], [97, 98])
+        self.assertEqual(uart.read(UART.LSR, 1) & UART.DR, 0)
+
+    def test_clint(self):
+        t = [100]
+        clint = CLINT(lambda: t[0])
+        self.assertEqual(clint.read(CLINT.MTIME, 4), 100)
+        clint.write(CLINT.MTIMECMP, 150, 4)
+        clint.write(CLINT.MTIMECMP + 4, 0, 4)
+        self.assertFalse(clint.pending())
+        t[0] = 150
+        self.assertTrue(clint.pending())
+        clint.write(CLINT.MTIME, 0, 4)
+        self.assertEqual(clint.mtime, 0)
+
+    def test_bus(self):
+        prog = [
+            0x100002B7,  # lui t0, 0x10000
+            enc_i(0b0010011, 6, 0b000, 0, ord("o")),  # li t1, 'o'
+            enc_s(0b0100011, 0b000, 5, 6, 0),  # sb t1, 0(t0)
+            enc_i(0b0010011, 6, 0b000, 0, ord("k")),  # li t1, 'k'
+            enc_s(0b0100011, 0b000, 5, 6, 0),  # sb t1, 0(t0)
+            enc_i(0b0000011, 10, 0b100, 5, 5),  # lbu a0, 5(t0)
+            0x001002B7,  # lui t0, 0x100
+            0x00005337,  # lui t1, 0x5
+            enc_i(0b0010011, 6, 0b000, 6, 0x555),  # addi t1, t1, 0x555
+            enc_s(0b0100011, 0b010, 5, 6, 0),  # sw t1, 0(t0)
+            enc_i(0b0010011, 10, 0b000, 0, 1),  # li a0, 1, never reached
+        ]
+        out = io.BytesIO()
+        riscv_cpu.reset()
+        riscv_cpu.bus = virt(out)
+        riscv_cpu.memory[: len(prog) * 4] = b"".join(
+            w.to_bytes(4, "little") for w in prog
+        )
+        riscv_cpu.registers[riscv_cpu.PC] = 0x80000000
+        while riscv_cpu.step():
+            pass
+        self.assertEqual(out.getvalue(), b"ok")
+        self.assertEqual(riscv_cpu.registers[10], UART.THRE)
+        self.assertEqual(riscv_cpu.registers[riscv_cpu.PC], 0x80000000 + 9 * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
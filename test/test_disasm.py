@@ -0,0 +1,81 @@
+import sys
+import os
+import re
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import fuzz
+from disasm import arm, read_image, riscv, riscv_image
+from fuzz import enc_i, enc_j
+
+TESTFS = ["testfs/arm32_subtract.s", "testfs/arm32_prime.s", "testfs/arm32_fib.s"]
+TARGETFS = ["test/subtract.hex", "test/prime.hex", "test/fib.hex"]
+
+
+class TestDisasm(unittest.TestCase):
+    def test_riscv_round_trip(self):
+        # Every generated instruction disassembles to the text it came with.
+        for seed in range(5):
+            self.assertEqual(fuzz.check_asm(fuzz.generate(seed, 300)[1]), [])
+
+    def test_riscv_image(self):
+        words = [
+            0x00000013,  # nop
+            enc_i(0b0010011, 10, 0b000, 0, -5),  # li a0, -5
+            enc_i(0b1110011, 11, 0b010, 0, 0x300),  # csrr a1, mstatus
+            enc_j(0b1101111, 0, -8),  # j 0x80000004
+            0x00008067,  # ret
+            0xC0001073,  # unimp
+            0xFFFFFFFF,
+        ]
+        image = b"".join(w.to_bytes(4, "little") for w in words)
+        self.assertEqual(
+            riscv_image(image, pseudo=True),
+            [
+                "nop",
+                "li a0,-5",
+                "csrr a1,mstatus",
+                "j 0x80000004",
+                "ret",
+                "unimp",
+                ".word 0xffffffff",
+            ],
+        )
+        self.assertEqual(riscv(words[2]), "csrrs a1,mstatus,x0")
+        self.assertEqual(riscv(words[3]), "jal x0,-8")
+        # RV32A with the ordering bits.
+        self.assertEqual(riscv(0x100522AF), "lr.w t0,(a0)")
+        self.assertEqual(riscv(0x0C55252F), "amoswap.w.aq a0,t0,(a0)")
+        self.assertEqual(riscv(0x0662A02F), "amoadd.w.aqrl x0,t1,(t0)")
+
+    def test_arm_gcc(self):
+        # The images disassemble to the gcc output they were assembled from,
+        # but for the branches & literal loads, which refer to labels.
+        for src, hexfile in zip(TESTFS, TARGETFS):
+            with open(src) as f:
+                lines = [
+                    re.sub(r",\s*", ", ", line.strip())
+                    for line in f
+                    if re.match(r"\t[a-z]", line)
+                ]
+            data = read_image(hexfile)[0]
+            words = [
+                int.from_bytes(data[i : i + 4], "little")
+                for i in range(0, len(data), 4)
+            ]
+            for pc, (line, word) in enumerate(zip(lines, words)):
+                if re.match(r"b|\w+\s.*\.L", line) and not line.startswith("bx"):
+                    continue
+                with self.subTest(src=src, pc=4 * pc):
+                    self.assertEqual(
+                        arm(word, 4 * pc).replace("\t", " "),
+                        re.sub(r"\s+", " ", line, 1),
+                    )
+        self.assertEqual(arm(0x1AFFFFFE, 0x100), "bne\t0x100")
+        self.assertEqual(arm(0xE1A03103), "lsl\tr3, r3, #2")
+
+
+if __name__ == "__main__":
+    unittest.main()
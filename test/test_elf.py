@@ -0,0 +1,90 @@
+import sys
+import os
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import arm_asm
+import riscv_cpu
+from elf import EM_ARM, elf_reader, elf_symbol, elf_writer, pack_data
+from riscv_asm import parse, sections
+
+
+class TestELFWriter(unittest.TestCase):
+    def test_riscv_round_trip(self):
+        with open("testfs/riscv_minimal.s", "r") as f:
+            enc, data, bss, symbols, globl = sections(parse(f.read()))
+
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, "minimal.elf")
+            text = b"".join(e.to_bytes(4, "little") for e in enc)
+            addrs = elf_writer(fn, text, data, bss, symbols, globl)
+
+            riscv_cpu.reset()
+            memory = elf_reader(riscv_cpu.memory, fn)
+
+        self.assertEqual(len(memory), len(riscv_cpu.memory))
+        for i, e in enumerate(enc):
+            self.assertEqual(struct.unpack_from("<I", memory, i * 4)[0], e)
+
+        off = addrs[".data"] - 0x80000000
+        self.assertEqual(memory[off : off + len(data)], data)
+        self.assertEqual(data, b"The sum is: %d\n\x00")
+        self.assertEqual(symbols["main"], (".text", 48))
+        self.assertIn("sum", globl)
+
+    def test_arm_round_trip(self):
+        with open("testfs/arm32_fib.s", "r") as f:
+            tokens = arm_asm.parser(f.read())
+        ins = arm_asm.asm32(tokens)
+        _, _, symbols, _ = arm_asm.sections(tokens)
+
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, "fib.elf")
+            arm_asm.dump_to_elf(ins, tokens, fn)
+            with open(fn, "rb") as f:
+                header = f.read(52)
+            memory = elf_reader(bytes(0x4000), fn, base=0x10000)
+
+        machine, _, entry = struct.unpack_from("<HII", header, 18)
+        self.assertEqual(machine, EM_ARM)
+        self.assertEqual(entry, 0x10000 + symbols["main"][1])
+        self.assertEqual(list(struct.unpack_from(f"<{len(ins)}I", memory)), ins)
+
+    def test_rodata_labels(self):
+        src = (
+            "\t.text\nmain:\n\t{}\n\t.section\t.rodata\n"
+            'table:\n\t.word\tmsg, main, 7\nmsg:\n\t.string\t"hi"\n'
+        )
+        for isa, base in (("riscv", 0x80000000), ("arm", 0x10000)):
+            with self.subTest(isa=isa), tempfile.TemporaryDirectory() as d:
+                fn = os.path.join(d, "rodata.elf")
+                if isa == "riscv":
+                    enc, data, bss, symbols, globl = sections(parse(src.format("nop")))
+                    text = b"".join(e.to_bytes(4, "little") for e in enc)
+                    addrs = elf_writer(fn, text, data, bss, symbols, globl)
+                else:
+                    tokens = arm_asm.parser(src.format("mov r0, r0"))
+                    _, _, symbols, _ = arm_asm.sections(tokens)
+                    arm_asm.dump_to_elf(arm_asm.asm32(tokens), tokens, fn)
+                    addrs = {".data": elf_symbol(fn, "table") - symbols["table"][1]}
+                memory = elf_reader(bytes(0x4000), fn, base=base)
+
+                off = addrs[".data"] - base
+                self.assertEqual(
+                    struct.unpack_from("<III", memory, off),
+                    (addrs[".data"] + 12, base, 7),
+                )
+                self.assertEqual(memory[off + 12 : off + 15], b"hi\0")
+
+    def test_unresolved_word(self):
+        self.assertEqual(pack_data([".word", "x"], symbols={"x": 8}), b"\x08\0\0\0")
+        with self.assertRaises(ValueError):
+            pack_data([".word", "x"])
+
+
+if __name__ == "__main__":
+    unittest.main()
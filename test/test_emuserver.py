@@ -0,0 +1,107 @@
+import sys
+import os
+import asyncio
+import base64
+import signal
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import emuserver
+from fuzz import enc_i, enc_j, enc_s
+
+# Writes "ok" to the UART & stops on the test finisher.
+OK = [
+    0x100002B7,  # lui t0, 0x10000
+    enc_i(0b0010011, 6, 0b000, 0, ord("o")),  # li t1, 'o'
+    enc_s(0b0100011, 0b000, 5, 6, 0),  # sb t1, 0(t0)
+    enc_i(0b0010011, 6, 0b000, 0, ord("k")),  # li t1, 'k'
+    enc_s(0b0100011, 0b000, 5, 6, 0),  # sb t1, 0(t0)
+    0x001002B7,  # lui t0, 0x100
+    0x00005337,  # lui t1, 0x5
+    enc_i(0b0010011, 6, 0b000, 6, 0x555),  # addi t1, t1, 0x555
+    enc_s(0b0100011, 0b010, 5, 6, 0),  # sw t1, 0(t0)
+]
+# Counts a0 up forever.
+LOOP = [enc_i(0b0010011, 10, 0b000, 10, 1), enc_j(0b1101111, 0, -4)]
+
+
+def binary(prog: list[int]) -> str:
+    return base64.b64encode(struct.pack("<%dI" % len(prog), *prog)).decode()
+
+
+class TestEmuServer(unittest.TestCase):
+    def test_execute(self):
+        emuserver.images.clear()
+        job = {"binary": binary(OK), "outputs": ["uart", "registers"]}
+        res = emuserver.execute(job)
+        self.assertEqual(res["status"], "halted")
+        self.assertEqual(res["uart"], "ok")
+        self.assertFalse(res["cached"])
+        # The cached image runs from its initial state again.
+        res = emuserver.execute(dict(job, limit=3))
+        self.assertTrue(res["cached"])
+        self.assertEqual((res["status"], res["instret"]), ("limit", 3))
+        self.assertEqual(res["uart"], "o")
+        res = emuserver.execute({"image": "missing.elf"})
+        self.assertEqual(res["status"], "error")
+
+    def test_server(self):
+        jobs = [
+            {"binary": binary(LOOP), "limit": 1000 + i, "outputs": ["registers"]}
+            for i in range(10)
+        ]
+        jobs.append({"binary": binary(OK)})
+
+        async def scenario(path):
+            server = emuserver.Server(2)
+            try:
+                async with await server.start(path):
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(
+                        None, emuserver.submit, jobs, path
+                    )
+            finally:
+                server.close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            results = asyncio.run(scenario(os.path.join(tmp, "emu.sock")))
+        self.assertEqual([r["id"] for r in results], list(range(11)))
+        for i, r in enumerate(results[:10]):
+            self.assertEqual((r["status"], r["instret"]), ("limit", 1000 + i))
+            self.assertEqual(r["registers"][10], (1001 + i) // 2)
+        self.assertEqual(results[10]["uart"], "ok")
+        # Each of the 2 workers loaded the loop once at most.
+        self.assertGreaterEqual(sum(r["cached"] for r in results[:10]), 8)
+
+    def test_worker_died(self):
+        async def scenario(server):
+            jobs = [{"binary": binary(LOOP), "limit": 10**9} for _ in range(4)]
+            tasks = [asyncio.create_task(server.run(j)) for j in jobs]
+            await asyncio.sleep(0.5)
+            for p in list(server.pool._processes.values()):
+                os.kill(p.pid, signal.SIGKILL)
+            died = await asyncio.gather(*tasks)
+            return died, await server.run({"binary": binary(OK)})
+
+        server = emuserver.Server(2)
+        broken = server.pool
+        try:
+            with mock.patch.object(server, "_pool", wraps=server._pool) as new:
+                died, res = asyncio.run(scenario(server))
+        finally:
+            server.close()
+        self.assertEqual([r["error"] for r in died], ["worker died"] * 4)
+        # Only one replacement, the broken pool is shut down.
+        new.assert_called_once()
+        self.assertIsNot(server.pool, broken)
+        self.assertTrue(broken._shutdown_thread)
+        self.assertEqual(res["uart"], "ok")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import sys
+import os
+import socket
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import riscv_cpu
+from fuzz import enc_b, enc_i, enc_s
+from gdbstub import GDBStub, checksum
+
+BASE = 0x80000000
+# Counts a0 down from 5 & stores it to 0x80000100 each time.
+PROG = [
+    0x800002B7,  # lui t0, 0x80000
+    enc_i(0b0010011, 10, 0b000, 0, 5),  # li a0, 5
+    enc_i(0b0010011, 10, 0b000, 10, -1),  # addi a0, a0, -1
+    enc_s(0b0100011, 0b010, 5, 10, 0x100),  # sw a0, 0x100(t0)
+    enc_b(0b1100011, 0b001, 10, 0, -8),  # bnez a0, -8
+    0xC0001073,  # unimp
+]
+
+
+def load():
+    riscv_cpu.reset()
+    riscv_cpu.memory[: len(PROG) * 4] = b"".join(w.to_bytes(4, "little") for w in PROG)
+    riscv_cpu.registers[riscv_cpu.PC] = BASE
+
+
+def reg(stub, n: int) -> int:
+    return int.from_bytes(bytes.fromhex(stub.handle("p%x" % n)), "little")
+
+
+class TestGDBStub(unittest.TestCase):
+    def test_breakpoints(self):
+        load()
+        stub = GDBStub()
+        self.assertEqual(stub.handle("Z0,%x,4" % (BASE + 12)), "OK")
+        for a0 in (4, 3):
+            self.assertEqual(stub.handle("c"), "S05")
+            self.assertEqual(reg(stub, 32), BASE + 12)
+            self.assertEqual(reg(stub, 10), a0)
+        # The instruction at the breakpoint is decoded again once it runs.
+        self.assertNotIn(BASE + 12, riscv_cpu.decoded)
+        self.assertEqual(stub.handle("s"), "S05")
+        self.assertEqual(reg(stub, 32), BASE + 16)
+        self.assertEqual(stub.handle("m%x,4" % (BASE + 0x100)), "03000000")
+        self.assertEqual(stub.handle("z0,%x,4" % (BASE + 12)), "OK")
+        self.assertEqual(stub.handle("c"), "W00")
+        self.assertEqual(riscv_cpu.instret, 2 + 5 * 3 + 1)
+
+    def test_watchpoints(self):
+        load()
+        stub = GDBStub()
+        stub.handle("P0a=07000000")
+        stub.handle("Z2,%x,2" % (BASE + 0x100))
+        self.assertEqual(stub.handle("c"), "T05watch:%x;" % (BASE + 0x100))
+        self.assertEqual(reg(stub, 32), BASE + 16)
+        self.assertEqual(reg(stub, 10), 4)
+        stub.handle("z2,%x,2" % (BASE + 0x100))
+        self.assertIs(riscv_cpu.HANDLERS[0b0100011], riscv_cpu._store)
+        self.assertEqual(stub.handle("c"), "W00")
+
+    def test_packets(self):
+        load()
+        stub = GDBStub()
+        stub.sock, gdb = socket.socketpair()
+        with stub.sock, gdb:
+            gdb.sendall(b"$g#67")
+            self.assertEqual(stub.packet(), "g")
+            self.assertEqual(gdb.recv(1), b"+")
+            stub.send(stub.handle("M%x,2:abcd" % (BASE + 0x200)))
+            self.assertEqual(gdb.recv(6), b"$OK#" + checksum(b"OK"))
+            self.assertEqual(riscv_cpu.memory[0x200:0x202], b"\xab\xcd")
+
+
+if __name__ == "__main__":
+    unittest.main()
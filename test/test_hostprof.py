@@ -0,0 +1,51 @@
+import sys
+import os
+import contextlib
+import io
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import hostprof
+import riscv_cpu
+from test.test_sampling import TOTAL, load
+
+
+class TestHostProf(unittest.TestCase):
+    def test_stages(self):
+        load()
+        rmem = riscv_cpu.rmem
+        hostprof.instrument()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                n = hostprof.run()
+        finally:
+            prof = hostprof.restore()
+        self.assertIs(riscv_cpu.rmem, rmem)
+        self.assertEqual(n, TOTAL)
+        self.assertEqual(riscv_cpu.registers[12], 5000)
+        self.assertEqual(prof.calls[("fetch",)], TOTAL)
+        self.assertEqual(prof.calls[("execute", "_load")], 1000)
+        self.assertEqual(prof.calls[("execute", "_load", "rmem")], 1000)
+        own = prof.self_ns()
+        self.assertEqual(
+            own[("execute", "_load")],
+            prof.ns[("execute", "_load")] - prof.ns[("execute", "_load", "rmem")],
+        )
+        lines = prof.folded().splitlines()
+        self.assertIn("riscv_cpu;execute;_load;rmem", [x.split()[0] for x in lines])
+        self.assertTrue(all(int(x.split()[1]) > 0 for x in lines))
+
+    def test_calls(self):
+        load()
+        with contextlib.redirect_stdout(io.StringIO()):
+            n, prof = hostprof.calls()
+        self.assertEqual(n, TOTAL)
+        self.assertEqual(prof.calls[("run", "_load", "rmem")], 1000)
+        # Each stack holds the time of those below it.
+        self.assertGreaterEqual(prof.ns[("run",)], prof.ns[("run", "_load")])
+
+
+if __name__ == "__main__":
+    unittest.main()
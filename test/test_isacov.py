@@ -0,0 +1,104 @@
+import sys
+import os
+import contextlib
+import io
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import arm_asm
+import arm_cpu
+import isacov
+import riscv_cpu
+from fuzz import enc_b, enc_i, enc_r, enc_u
+
+ROOT = Path(__file__).parent.parent
+PROG = [
+    enc_u(0b0110111, 5, 0x80001000),  # lui t0, 0x80001
+    enc_i(0b0010011, 5, 0b000, 5, -4),  # addi t0, t0, -4, fused
+    enc_i(0b0010011, 6, 0b000, 0, 100),  # li t1, 100
+    enc_r(0b0110011, 10, 0b000, 10, 6),  # add a0, a0, t1
+    enc_i(0b0010011, 6, 0b000, 6, -1),  # addi t1, t1, -1
+    enc_b(0b1100011, 0b001, 6, 0, -8),  # bnez t1, -8
+    0xC0001073,  # unimp
+    enc_r(0b0110011, 10, 0b000, 10, 6, 0b0100000),  # sub a0, a0, t1, never run
+]
+
+
+def run(predecode: bool = True) -> int:
+    riscv_cpu.reset()
+    riscv_cpu.memory[: len(PROG) * 4] = struct.pack("<%dI" % len(PROG), *PROG)
+    riscv_cpu.registers[riscv_cpu.PC] = 0x80000000
+    if predecode:
+        riscv_cpu.predecode()
+    with contextlib.redirect_stdout(io.StringIO()):
+        riscv_cpu.run()
+    return riscv_cpu.registers[10]
+
+
+class TestIsaCov(unittest.TestCase):
+    def tearDown(self):
+        isacov.disable()
+
+    def test_keys(self):
+        addi = isacov.rv_key(enc_i(0b0010011, 5, 0b000, 5, 4))
+        self.assertEqual(addi & 7, 0)
+        self.assertEqual(isacov.rv_key(enc_i(0b0010011, 0, 0b000, 0, -1)) & 7, 7)
+        # Immediates & registers other than x0 don't matter.
+        self.assertEqual(isacov.rv_key(enc_i(0b0010011, 9, 0b000, 3, 100)), addi)
+        sub = isacov.rv_key(PROG[-1])
+        self.assertNotEqual(sub, isacov.rv_key(PROG[3]))
+        self.assertIsNone(isacov.rv_key(0x4501))
+
+    def test_riscv(self):
+        decode = riscv_cpu.decode
+        for predecode in (True, False):
+            cov = isacov.Coverage()
+            isacov.enable(cov)
+            self.assertEqual(run(predecode), 5050)
+            keys = cov.keys("riscv_cpu")
+            self.assertEqual(keys, {isacov.rv_key(w) for w in PROG[:-1]})
+            # Every entry is plain again once it ran, the addi only ran fused.
+            plain = set(riscv_cpu.HANDLERS.values()) | isacov.orig["FUSED"]
+            for pc in range(0x80000000, 0x80000000 + 4 * (len(PROG) - 1), 4):
+                if pc not in riscv_cpu.fused_by:
+                    self.assertIn(riscv_cpu.decoded[pc][0], plain)
+            report = cov.report("riscv_cpu")
+            self.assertIn("sub        never", report)
+            self.assertIn("add        missing rd=x0", report)
+            isacov.disable()
+        self.assertIs(riscv_cpu.decode, decode)
+
+    def test_merge(self):
+        a, b = isacov.Coverage(), isacov.Coverage()
+        a.mark("riscv_cpu", PROG[3])
+        b.mark("riscv_cpu", PROG[-1])
+        a.merge(b)
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, "cov.npz")
+            a.save(fn)
+            c = isacov.Coverage.load(fn)
+        self.assertEqual(c.keys("riscv_cpu"), {isacov.rv_key(w) for w in PROG[3::4]})
+
+    def test_arm(self):
+        cov = isacov.Coverage()
+        isacov.enable(cov)
+        with open(ROOT / "testfs/arm32_subtract.s") as f:
+            with contextlib.redirect_stdout(io.StringIO()):
+                words = arm_asm.asm32(arm_asm.parser(f.read()))
+        self.assertEqual(
+            cov.keys("arm_asm"), {isacov.arm_key(w) for w in words} - {None}
+        )
+        arm_cpu.reset()
+        arm_cpu.R[15] = arm_cpu.load(str(ROOT / "test/subtract.hex"))
+        arm_cpu.run(10000)
+        report = cov.report("arm_cpu")
+        self.assertIn("dataproc  SUB    missing", report)
+        self.assertIn("mul       MUL    never", report)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import sys
+import os
+import contextlib
+import io
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import morphgen
+
+ROOT = Path(__file__).parent.parent
+
+
+def loaded(code: str) -> set:
+    """Returns the heavy modules imported by code in a fresh interpreter."""
+    out = subprocess.run(
+        [sys.executable, "-c", code + "\nimport sys; print(*sys.modules)"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    heavy = {"elftools", "numpy", "riscv_cpu", "arm_asm", "riscv_asm"}
+    return heavy & set(out)
+
+
+class TestMorphgen(unittest.TestCase):
+    def test_lazy(self):
+        self.assertEqual(loaded("import morphgen"), set())
+        self.assertEqual(loaded("import riscv_cpu"), {"riscv_cpu"})
+        # Loading & predecoding a hex image needs neither pyelftools nor NumPy.
+        code = morphgen.STARTUP["run"].format(image="test/subtract.hex")
+        self.assertEqual(loaded(code), {"riscv_cpu"})
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, "prog.hex")
+            with open(fn, "w") as f:
+                # li a0, 5; add a0, a0, a0; unimp
+                f.write("00500513\n00a50533\nc0001073\n")
+            # The UART writes to the stdout of the process.
+            res = subprocess.run(
+                [sys.executable, "morphgen.py", "run", fn],
+                cwd=ROOT,
+                capture_output=True,
+                text=True,
+            )
+        self.assertEqual(res.returncode, 0)
+        self.assertIn("ran 3 instructions", res.stdout)
+        self.assertIn("a0 : 0000000a", res.stdout)
+
+    def test_hex(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, "prog.bin")
+            with open(fn, "wb") as f:
+                f.write(bytes.fromhex("13055000" "3305a500"))
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                morphgen.main(["hex", fn])
+        self.assertEqual(out.getvalue(), "00500513\n00a50533\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import sys
+import os
+import struct
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import multihart
+from fuzz import enc_b, enc_i, enc_r, enc_s
+
+
+def amo(f5, rd, rs1, rs2, aq=0, rl=0):
+    return enc_r(0b0101111, rd, 0b010, rs1, rs2, f5 << 2 | aq << 1 | rl)
+
+
+K = 200
+# Each hart counts 3 words at 0x80001000 up K times, with amoadd.w, an LR/SC
+# loop & under a spinlock, & sets bit mhartid of the 4th word.
+PROG = [
+    0x80001437,  # lui s0, 0x80001
+    enc_i(0b0010011, 9, 0b000, 0, K),  # li s1, K
+    enc_i(0b0010011, 5, 0b000, 0, 1),  # li t0, 1
+    amo(0b00000, 0, 8, 5),  # amoadd.w zero, t0, (s0)
+    enc_i(0b0010011, 10, 0b000, 8, 4),  # addi a0, s0, 4
+    amo(0b00010, 6, 10, 0),  # lr.w t1, (a0)
+    enc_i(0b0010011, 6, 0b000, 6, 1),  # addi t1, t1, 1
+    amo(0b00011, 7, 10, 6),  # sc.w t2, t1, (a0)
+    enc_b(0b1100011, 0b001, 7, 0, -12),  # bnez t2, -12
+    enc_i(0b0010011, 11, 0b000, 8, 8),  # addi a1, s0, 8
+    amo(0b00001, 28, 11, 5, aq=1),  # amoswap.w.aq t3, t0, (a1)
+    enc_b(0b1100011, 0b001, 28, 0, -4),  # bnez t3, -4
+    enc_i(0b0000011, 29, 0b010, 8, 12),  # lw t4, 12(s0)
+    enc_i(0b0010011, 29, 0b000, 29, 1),  # addi t4, t4, 1
+    enc_s(0b0100011, 0b010, 8, 29, 12),  # sw t4, 12(s0)
+    amo(0b00001, 0, 11, 0, rl=1),  # amoswap.w.rl zero, zero, (a1)
+    enc_i(0b0010011, 9, 0b000, 9, -1),  # addi s1, s1, -1
+    enc_b(0b1100011, 0b001, 9, 0, -56),  # bnez s1, -56
+    enc_i(0b1110011, 30, 0b010, 0, 0xF14),  # csrr t5, mhartid
+    enc_r(0b0110011, 31, 0b001, 5, 30),  # sll t6, t0, t5
+    enc_i(0b0010011, 12, 0b000, 8, 16),  # addi a2, s0, 16
+    amo(0b01000, 0, 12, 31),  # amoor.w zero, t6, (a2)
+    0xC0001073,  # unimp
+]
+
+
+class TestMultiHart(unittest.TestCase):
+    def test_atomics(self):
+        image = struct.pack("<%dI" % len(PROG), *PROG)
+        for quantum in (None, 50):
+            with self.subTest(quantum=quantum):
+                res, mem = multihart.simulate(image, 4, quantum)
+                self.assertEqual([r["status"] for r in res], ["halted"] * 4)
+                words = struct.unpack_from("<5I", mem, 0x1000)
+                self.assertEqual(words, (4 * K, 4 * K, 0, 4 * K, 0b1111))
+
+    def test_limit(self):
+        image = struct.pack("<%dI" % len(PROG), *PROG)
+        res, mem = multihart.simulate(image, 2, 100, limit=1000)
+        self.assertEqual([r["status"] for r in res], ["limit"] * 2)
+        # The quanta keep the harts in step.
+        self.assertEqual([r["instret"] for r in res], [1000, 1000])
+
+    def test_locked_store(self):
+        # Plain stores hold the lock of the atomics & break reservations.
+        table = memoryview(bytearray(8 * 3)).cast("q")
+        table[0], table[1], table[2] = -1, 0x80001000, 1
+        lock, stores = mock.MagicMock(), []
+        rsv = multihart.SharedReservation(table, 0, lock)
+        wmem = multihart.locked_store(lambda *a: stores.append(lock.mock_calls[:]), rsv)
+        wmem(0x80001002, 7, 2)
+        self.assertEqual(stores, [[mock.call.__enter__()]])
+        self.assertEqual(lock.__exit__.call_count, lock.__enter__.call_count)
+        self.assertEqual(list(table), [-1, -1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
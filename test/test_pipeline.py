@@ -0,0 +1,64 @@
+import sys
+import os
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import riscv_cpu
+from fuzz import enc_b, enc_i, enc_r
+from pipeline import Pipeline
+
+UNIMP = 0xC0001073
+
+
+def timed(prog: list[int], **kwargs) -> Pipeline:
+    riscv_cpu.reset()
+    riscv_cpu.memory[: len(prog) * 4] = b"".join(w.to_bytes(4, "little") for w in prog)
+    riscv_cpu.registers[riscv_cpu.PC] = 0x80000000
+    pipe = Pipeline(**kwargs)
+    for pcs in riscv_cpu.trace(batch=2):
+        pipe.feed(pcs)
+    pipe.finish()
+    return pipe
+
+
+class TestPipeline(unittest.TestCase):
+    def test_straight(self):
+        pipe = timed([enc_i(0b0010011, i, 0b000, 0, i) for i in range(1, 9)] + [UNIMP])
+        self.assertEqual(pipe.instructions, 9)
+        self.assertEqual(pipe.cycles, 9 + 4)
+        self.assertEqual(sum(pipe.stalls.values()), 0)
+
+    def test_data_hazards(self):
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            enc_i(0b0000011, 10, 0b010, 5, 0),  # lw a0, 0(t0)
+            enc_r(0b0110011, 11, 0b000, 10, 10),  # add a1, a0, a0
+            enc_r(0b0110011, 12, 0b000, 11, 10),  # add a2, a1, a0
+            UNIMP,
+        ]
+        pipe = timed(prog)
+        self.assertEqual(pipe.stalls["load-use"], 1)
+        self.assertEqual(pipe.hazards["forwarded"], 2)
+        self.assertEqual(pipe.cycles, 5 + 4 + 1)
+
+        pipe = timed(prog, forwarding=False)
+        # lw waits on lui, 1st add on lw, 2nd add on the 1st.
+        self.assertEqual(pipe.stalls["raw"], 6)
+
+    def test_control(self):
+        prog = [
+            enc_b(0b1100011, 0b000, 0, 0, 8),  # beq zero, zero, 8
+            enc_i(0b0010011, 10, 0b000, 0, 1),  # li a0, 1, skipped
+            enc_b(0b1100011, 0b001, 0, 0, 8),  # bne zero, zero, 8
+            UNIMP,
+        ]
+        pipe = timed(prog)
+        self.assertEqual(pipe.instructions, 3)
+        self.assertEqual(pipe.stalls["control"], 2)
+        self.assertEqual(pipe.cycles, 3 + 4 + 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
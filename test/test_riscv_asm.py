@@ -0,0 +1,42 @@
+import sys
+import os
+import io
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+from riscv_asm import tokenize, Program
+
+
+class TestRISCVAssembler(unittest.TestCase):
+    def test_tokenize_stream(self):
+        src = (
+            "\t.text\n\t.globl\tmain\nmain:\n\taddi\tsp,sp,-16\n\tsw\tra,12(sp)\n"
+            '.LC0:\n\t# c\n\tlw\ta0, -4(s0)\n\n\t.string\t"hi there"\n'
+        )
+        D, L, I, C = (
+            Program.DIRECTIVE,
+            Program.LABEL,
+            Program.INSTRUCTION,
+            Program.COMMENT,
+        )
+        self.assertEqual(
+            list(tokenize(io.StringIO(src))),
+            [
+                (D, [".text"], None),
+                (D, [".globl", "main"], None),
+                (L, ["main:"], 0),
+                (I, ["addi", "sp", "sp", "-16"], 0),
+                (I, ["sw", "ra", "12", "sp"], 4),
+                # Local labels are tokenized as directives.
+                (D, [".LC0:"], None),
+                (C, ["#", "c"], None),
+                (I, ["lw", "a0", "-4", "s0"], 8),
+                (D, [".string", '"hi', 'there"'], None),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
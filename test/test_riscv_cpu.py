@@ -0,0 +1,434 @@
+import sys
+import os
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import riscv_cpu
+from riscv_cpu import PC
+
+
+def I(op, rd, f3, rs1, imm):
+    return ((imm & 0xFFF) << 20) | (rs1 << 15) | (f3 << 12) | (rd << 7) | op
+
+
+def S(f3, rs1, rs2, imm):
+    return (
+        (((imm >> 5) & 0x7F) << 25)
+        | (rs2 << 20)
+        | (rs1 << 15)
+        | (f3 << 12)
+        | ((imm & 0x1F) << 7)
+        | 0b0100011
+    )
+
+
+def R(rd, f3, rs1, rs2, f7=0):
+    return (f7 << 25) | (rs2 << 20) | (rs1 << 15) | (f3 << 12) | (rd << 7) | 0b0110011
+
+
+def B(f3, rs1, rs2, imm):
+    return (
+        (((imm >> 12) & 1) << 31)
+        | (((imm >> 5) & 0x3F) << 25)
+        | (rs2 << 20)
+        | (rs1 << 15)
+        | (f3 << 12)
+        | (((imm >> 1) & 0xF) << 8)
+        | (((imm >> 11) & 1) << 7)
+        | 0b1100011
+    )
+
+
+def J(rd, imm):
+    return (
+        (((imm >> 20) & 1) << 31)
+        | (((imm >> 1) & 0x3FF) << 21)
+        | (((imm >> 11) & 1) << 20)
+        | (((imm >> 12) & 0xFF) << 12)
+        | (rd << 7)
+        | 0b1101111
+    )
+
+
+# Sums 1..n with n read from 0x80000200, ends on unimp (csrrw x0, cycle, x0).
+SUM = [
+    0x800002B7,  # lui t0, 0x80000
+    I(0b0000011, 10, 0b010, 5, 0x200),  # lw a0, 0x200(t0)
+    I(0b0010011, 11, 0b000, 0, 0),  # li a1, 0
+    I(0b0010011, 12, 0b000, 0, 1),  # li a2, 1
+    B(0b100, 10, 12, 20),  # blt a0, a2, 20
+    R(11, 0b000, 11, 12),  # add a1, a1, a2
+    I(0b0010011, 12, 0b000, 12, 1),  # addi a2, a2, 1
+    S(0b010, 5, 11, 0x204),  # sw a1, 0x204(t0)
+    J(0, -16),  # j -16
+    S(0b000, 5, 11, 0x208),  # sb a1, 0x208(t0)
+    I(0b0000011, 13, 0b100, 5, 0x208),  # lbu a3, 0x208(t0)
+    I(0b0010011, 14, 0b101, 11, (0x20 << 5) | 1),  # srai a4, a1, 1
+    R(15, 0b000, 14, 11, 0x20),  # sub a5, a4, a1
+    0xC0001073,  # unimp
+]
+
+
+def image(prog: list[int], n: int) -> bytes:
+    mem = bytearray(0x10000)
+    mem[: len(prog) * 4] = b"".join(struct.pack("<I", w) for w in prog)
+    mem[0x200:0x204] = struct.pack("<I", n)
+    return bytes(mem)
+
+
+def execute(mem: bytes, predecode: bool = False) -> int:
+    riscv_cpu.reset()
+    riscv_cpu.memory = bytearray(mem)
+    riscv_cpu.registers[PC] = 0x80000000
+    if predecode:
+        riscv_cpu.predecode()
+    inscnt = 0
+    while riscv_cpu.step():
+        inscnt += 1
+    return inscnt
+
+
+class TestRISCVProcessor(unittest.TestCase):
+    def test_sum(self):
+        execute(image(SUM, 10))
+        self.assertEqual(riscv_cpu.registers[11], 55)
+        self.assertEqual(riscv_cpu.registers[13], 55)
+        self.assertEqual(riscv_cpu.registers[15], (27 - 55) & 0xFFFFFFFF)
+
+    def test_load_elf_predecodes_code(self):
+        from elf import elf_writer
+        from riscv_asm import parse, sections
+
+        with open("testfs/riscv_minimal.s", "r") as f:
+            enc, data, bss, symbols, globl = sections(parse(f.read()))
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, "minimal.elf")
+            text = b"".join(e.to_bytes(4, "little") for e in enc)
+            elf_writer(fn, text, data, bss, symbols, globl)
+            riscv_cpu.load_elf(fn)
+        # .data & the rest of memory are left to be decoded on demand.
+        self.assertEqual(
+            sorted(riscv_cpu.decoded),
+            list(range(0x80000000, 0x80000000 + len(text), 4)),
+        )
+
+    def test_predecode(self):
+        import random
+
+        rnd = random.Random(0)
+        words = [rnd.getrandbits(32) for _ in range(4096)] + SUM
+        riscv_cpu.reset()
+        riscv_cpu.memory = b"".join(struct.pack("<I", w) for w in words)
+        # Small images are decoded one by one, unless NumPy is imported.
+        with mock.patch.object(riscv_cpu, "NUMPY_MIN", 0):
+            riscv_cpu.predecode(fusion=False)
+        for i, w in enumerate(words):
+            self.assertEqual(
+                riscv_cpu.decoded[0x80000000 + i * 4], riscv_cpu.decode(w), hex(w)
+            )
+
+        inscnt = execute(image(SUM, 10), predecode=True)
+        self.assertEqual(riscv_cpu.registers[11], 55)
+        self.assertEqual(inscnt, execute(image(SUM, 10)))
+
+    def test_self_modifying(self):
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            I(0b0000011, 6, 0b010, 5, 16),  # lw t1, 16(t0)
+            S(0b010, 5, 6, 12),  # sw t1, 12(t0)
+            I(0b0010011, 10, 0b000, 0, 1),  # li a0, 1, overwritten
+            I(0b0010011, 10, 0b000, 0, 2),  # li a0, 2
+            0xC0001073,  # unimp
+        ]
+        execute(image(prog, 0), predecode=True)
+        self.assertEqual(riscv_cpu.registers[10], 2)
+
+    def test_fusion(self):
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            I(0b0010011, 2, 0b000, 5, 0x400),  # addi sp, t0, 0x400
+            I(0b0010011, 2, 0b000, 2, -16),  # addi sp, sp, -16
+            S(0b010, 2, 1, 12),  # sw ra, 12(sp)
+            S(0b010, 2, 2, 8),  # sw sp, 8(sp)
+            0x12345537,  # lui a0, 0x12345
+            I(0b0010011, 10, 0b000, 10, -0x788),  # addi a0, a0, -0x788
+            0x00000317,  # auipc t1, 0
+            I(0b0000011, 11, 0b010, 6, 0x200 - 28),  # lw a1, 0x200(t1)
+            0x00000397,  # auipc t2, 0
+            I(0b1100111, 1, 0b000, 7, 12),  # jalr ra, 12(t2)
+            I(0b0010011, 12, 0b000, 0, 1),  # li a2, 1, jumped over
+            # Overwrites the addi of the lui & addi above with a nop & runs
+            # them again.
+            I(0b0000011, 28, 0b010, 5, 0x204),  # lw t3, 0x204(t0)
+            S(0b010, 5, 28, 24),  # sw t3, 24(t0)
+            B(0b001, 12, 0, 8),  # bnez a2, 8
+            J(12, -40),  # jal a2, -40
+            0xC0001073,  # unimp
+        ]
+
+        def run(fusion: bool, limit: int = None) -> tuple:
+            riscv_cpu.reset()
+            riscv_cpu.memory = bytearray(image(prog, 7))
+            riscv_cpu.memory[0x204:0x208] = struct.pack("<I", 0x13)
+            riscv_cpu.registers[PC] = 0x80000000
+            riscv_cpu.predecode(fusion=fusion)
+            n = riscv_cpu.run(limit)
+            return riscv_cpu.registers.registers[:], bytes(riscv_cpu.memory), n
+
+        runs = [run(False), run(True)]
+        self.assertEqual(runs[0], runs[1])
+        regs = runs[1][0]
+        self.assertEqual(regs[10], 0x12345000)
+        self.assertEqual((regs[11], regs[1]), (7, 0x80000000 + 44))
+        self.assertEqual(
+            riscv_cpu.fusions,
+            {"lui+addi": 1, "auipc+jalr": 2, "auipc+lw": 2, "spill": 1},
+        )
+        self.assertEqual(riscv_cpu.memory[0x3F8:0x400], struct.pack("<II", regs[2], 0))
+
+        # A limit ending inside a fused sequence stops in it, like unfused.
+        for limit in range(1, runs[1][2]):
+            with self.subTest(limit=limit):
+                self.assertEqual(run(True, limit), run(False, limit))
+                self.assertEqual(run(True, limit)[2], limit)
+
+    def test_fusion_idle_limit(self):
+        # A loop of spills, the probe for spinning loops starts right before
+        # the limit & runs the last of them in step.
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            I(0b0010011, 2, 0b000, 5, 0x400),  # addi sp, t0, 0x400
+            I(0b0010011, 2, 0b000, 2, -64),  # addi sp, sp, -64
+        ]
+        prog += [S(0b010, 2, r, 4 * r) for r in range(1, 16)]  # sw x1..x15
+        prog += [I(0b0010011, 2, 0b000, 2, 64), J(0, -68)]  # addi sp, sp, 64 & j -68
+
+        start = riscv_cpu.SPIN_CHECK - 1
+        for limit in range(start, start + 2 * riscv_cpu.SPILL):
+            with self.subTest(limit=limit):
+                riscv_cpu.reset()
+                riscv_cpu.memory = bytearray(image(prog, 0))
+                riscv_cpu.registers[PC] = 0x80000000
+                riscv_cpu.predecode()
+                self.assertEqual(riscv_cpu.run(limit), limit)
+
+    def test_batch(self):
+        from riscv_batch import Harts, PASSED
+
+        n = 6
+        h = Harts(n)
+        for i in range(n):
+            h.load(image(SUM, i * 37), i)
+        h.run()
+        for i in range(n):
+            inscnt = execute(image(SUM, i * 37))
+            self.assertEqual(list(h.regs[i]), riscv_cpu.registers.registers)
+            self.assertEqual(bytes(h.mem[i]), riscv_cpu.memory)
+            self.assertEqual((h.status[i], h.inscnt[i]), (PASSED, inscnt))
+
+    def test_batch_funct7(self):
+        from riscv_batch import Harts, PASSED, FAULT
+
+        init = [I(0b0010011, 5, 0b000, 0, -8), I(0b0010011, 6, 0b000, 0, 2)]
+        progs = [
+            R(10, 0b000, 5, 6, 0x20),  # sub a0, t0, t1
+            R(10, 0b101, 5, 6, 0x20),  # sra a0, t0, t1
+            R(10, 0b000, 5, 6, 0x01),  # mul a0, t0, t1
+            R(10, 0b001, 5, 6, 0x20),  # sll a0, t0, t1 with the funct7 of sra
+        ]
+        h = Harts(len(progs))
+        for i, op in enumerate(progs):
+            h.load(image(init + [op, 0xC0001073], 0), i)
+        h.run(100)
+        self.assertEqual(list(h.status), [PASSED, PASSED, FAULT, FAULT])
+        self.assertEqual(list(h.regs[:2, 10]), [-10 & 0xFFFFFFFF, 0xFFFFFFFE])
+        # Faulting harts stop at the instruction & leave a0 alone.
+        self.assertEqual(list(h.regs[2:, PC]), [0x80000008] * 2)
+        self.assertEqual(list(h.regs[2:, 10]), [0, 0])
+
+    def test_branch_to_itself(self):
+        from riscv_batch import Harts, HALTED
+
+        progs = [
+            [B(0b000, 0, 0, 0), I(0b0010011, 10, 0b000, 0, 5), 0xC0001073],
+            [J(1, 0), I(0b0010011, 10, 0b000, 0, 5), 0xC0001073],
+        ]
+        h = Harts(len(progs))
+        for i, prog in enumerate(progs):
+            h.load(image(prog, 0), i)
+        h.run(100)
+        # Nothing can end the loop without a timer, both engines halt in it.
+        for i, prog in enumerate(progs):
+            inscnt = execute(image(prog, 0))
+            self.assertEqual(riscv_cpu.registers[PC], 0x80000000)
+            self.assertEqual(riscv_cpu.registers[10], 0)
+            self.assertEqual(list(h.regs[i]), riscv_cpu.registers.registers)
+            self.assertEqual((h.status[i], h.inscnt[i]), (HALTED, inscnt))
+
+    def test_load_end_of_memory(self):
+        prog = [
+            0x800102B7,  # lui t0, 0x80010
+            I(0b0000011, 10, 0b000, 5, -1),  # lb a0, -1(t0)
+            I(0b0000011, 11, 0b101, 5, -2),  # lhu a1, -2(t0)
+            0xC0001073,  # unimp
+        ]
+        mem = bytearray(image(prog, 0))
+        mem[-2:] = b"\x34\x92"
+        execute(bytes(mem))
+        self.assertEqual(riscv_cpu.registers[10], 0xFFFFFF92)
+        self.assertEqual(riscv_cpu.registers[11], 0x9234)
+
+    def test_timer_interrupt(self):
+        from devices import virt
+
+        def csr(rd, f3, rs1, n):
+            return I(0b1110011, rd, f3, rs1, n)
+
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            I(0b0010011, 6, 0b000, 5, 80),  # addi t1, t0, 80
+            csr(0, 0b001, 6, 0x305),  # csrw mtvec, t1
+            0x020043B7,  # lui t2, 0x2004, mtimecmp
+            I(0b0010011, 28, 0b000, 0, 50),  # li t3, 50
+            S(0b010, 7, 28, 0),  # sw t3, 0(t2)
+            S(0b010, 7, 0, 4),  # sw zero, 4(t2)
+            I(0b0010011, 28, 0b000, 0, 0x80),  # li t3, 0x80
+            csr(0, 0b001, 28, 0x304),  # csrw mie, t3
+            csr(0, 0b110, 8, 0x300),  # csrsi mstatus, 8
+            I(0b0010011, 11, 0b000, 11, 1),  # addi a1, a1, 1
+            I(0b0010011, 29, 0b000, 0, 3),  # li t4, 3
+            B(0b100, 10, 29, -8),  # blt a0, t4, -8
+            csr(12, 0b010, 0, 0x342),  # csrr a2, mcause
+            0x00100F37,  # lui t5, 0x100, test finisher
+            0x00005FB7,  # lui t6, 0x5
+            I(0b0010011, 31, 0b000, 31, 0x555),  # addi t6, t6, 0x555
+            S(0b010, 30, 31, 0),  # sw t6, 0(t5)
+            0,
+            0,
+            # Timer interrupt handler, moves mtimecmp 50 on.
+            I(0b0010011, 10, 0b000, 10, 1),  # addi a0, a0, 1
+            I(0b0000011, 28, 0b010, 7, 0),  # lw t3, 0(t2)
+            I(0b0010011, 28, 0b000, 28, 50),  # addi t3, t3, 50
+            S(0b010, 7, 28, 0),  # sw t3, 0(t2)
+            0x30200073,  # mret
+        ]
+        riscv_cpu.reset()
+        riscv_cpu.bus = virt(clock=lambda: riscv_cpu.instret)
+        riscv_cpu.memory[:] = image(prog, 0)
+        riscv_cpu.registers[PC] = 0x80000000
+        inscnt = riscv_cpu.run()
+        self.assertEqual(riscv_cpu.registers[10], 3)
+        self.assertEqual(riscv_cpu.registers[12], 0x80000007)
+        self.assertEqual(riscv_cpu.rcsr(0xB02), inscnt)
+        # Roughly every 50 instructions an interrupt, 3 of each loop.
+        self.assertAlmostEqual(riscv_cpu.registers[11], 150 // 3 - 5, delta=5)
+
+    def test_atomics(self):
+        def amo(f5, rd, rs1, rs2):
+            return R(rd, 0b010, rs1, rs2, f5 << 2) & ~0x7F | 0b0101111
+
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            I(0b0010011, 5, 0b000, 5, 0x200),  # addi t0, t0, 0x200
+            I(0b0010011, 6, 0b000, 0, -5),  # li t1, -5
+            amo(0b10000, 10, 5, 6),  # amomin.w a0, t1, (t0)
+            amo(0b11000, 11, 5, 0),  # amominu.w a1, zero, (t0)
+            amo(0b00000, 0, 5, 6),  # amoadd.w zero, t1, (t0)
+            amo(0b00011, 12, 5, 6),  # sc.w a2, t1, (t0), not reserved
+            amo(0b00010, 13, 5, 0),  # lr.w a3, (t0)
+            amo(0b00011, 14, 5, 0),  # sc.w a4, zero, (t0)
+            amo(0b00011, 15, 5, 6),  # sc.w a5, t1, (t0), reservation taken
+            I(0b0000011, 16, 0b010, 5, 0),  # lw a6, 0(t0)
+            0xC0001073,  # unimp
+        ]
+        execute(image(prog, 7))
+        regs = riscv_cpu.registers
+        self.assertEqual((regs[10], regs[11]), (7, 0xFFFFFFFB))
+        self.assertEqual((regs[12], regs[13]), (1, 0xFFFFFFFB))
+        self.assertEqual((regs[14], regs[15], regs[16]), (0, 1, 0))
+        prog[1] = I(0b0010011, 5, 0b000, 5, 0x202)  # addi t0, t0, 0x202
+        with self.assertRaisesRegex(ValueError, "Misaligned store"):
+            execute(image(prog, 7))
+
+    def idle(self, wait: list[int], delay: int) -> int:
+        """Runs wait until 3 timer interrupts, delay ticks apart, set a0 to 3."""
+        from devices import virt
+
+        def csr(rd, f3, rs1, n):
+            return I(0b1110011, rd, f3, rs1, n)
+
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            I(0b0010011, 6, 0b000, 5, 128),  # addi t1, t0, 128
+            csr(0, 0b001, 6, 0x305),  # csrw mtvec, t1
+            0x020043B7,  # lui t2, 0x2004, mtimecmp
+            0x000004B7 | delay,  # lui s1, delay >> 12
+            S(0b010, 7, 9, 0),  # sw s1, 0(t2)
+            S(0b010, 7, 0, 4),  # sw zero, 4(t2)
+            I(0b0010011, 28, 0b000, 0, 0x80),  # li t3, 0x80
+            csr(0, 0b001, 28, 0x304),  # csrw mie, t3
+            csr(0, 0b110, 8, 0x300),  # csrsi mstatus, 8
+            I(0b0010011, 29, 0b000, 0, 3),  # li t4, 3
+            *wait,
+            0x00100F37,  # lui t5, 0x100, test finisher
+            0x00005FB7,  # lui t6, 0x5
+            I(0b0010011, 31, 0b000, 31, 0x555),  # addi t6, t6, 0x555
+            S(0b010, 30, 31, 0),  # sw t6, 0(t5)
+        ]
+        prog += [0] * (32 - len(prog))
+        prog += [
+            # Timer interrupt handler, moves mtimecmp delay on.
+            I(0b0010011, 10, 0b000, 10, 1),  # addi a0, a0, 1
+            I(0b0000011, 28, 0b010, 7, 0),  # lw t3, 0(t2)
+            R(28, 0b000, 28, 9),  # add t3, t3, s1
+            S(0b010, 7, 28, 0),  # sw t3, 0(t2)
+            0x30200073,  # mret
+        ]
+        riscv_cpu.reset()
+        riscv_cpu.bus = virt(clock=lambda: riscv_cpu.instret)
+        riscv_cpu.memory[:] = image(prog, 0)
+        riscv_cpu.registers[PC] = 0x80000000
+        inscnt = riscv_cpu.run()
+        self.assertEqual(riscv_cpu.registers[10], 3)
+        return inscnt
+
+    def test_idle(self):
+        # Each waits 3 * 2^28 ticks, far too long to run every iteration.
+        delay = 0x10000000
+        # blt a0, t4, 0 branches to itself until the interrupts count a0 up.
+        self.assertGreater(self.idle([B(0b100, 10, 29, 0)], delay), 3 * delay)
+        # wfi & blt a0, t4, -4
+        wfi = [0x10500073, B(0b100, 10, 29, -4)]
+        self.assertGreater(self.idle(wfi, delay), 3 * delay)
+        # li a1, 7 & blt a0, t4, -4 never changes any register by itself.
+        loop = [I(0b0010011, 11, 0b000, 0, 7), B(0b100, 10, 29, -4)]
+        self.assertGreater(self.idle(loop, delay), 3 * delay)
+        # Skipped iterations count like run ones.
+        check, riscv_cpu.SPIN_CHECK = riscv_cpu.SPIN_CHECK, 1 << 62
+        try:
+            ref = self.idle(loop, 0x10000)
+        finally:
+            riscv_cpu.SPIN_CHECK = check
+        self.assertEqual(self.idle(loop, 0x10000), ref)
+        # j . halts if no interrupt can end it.
+        riscv_cpu.reset()
+        riscv_cpu.memory[:4] = struct.pack("<I", J(0, 0))
+        riscv_cpu.registers[PC] = 0x80000000
+        self.assertEqual(riscv_cpu.run(), 1)
+
+    def test_fuzz(self):
+        import fuzz
+
+        for seed in range(20):
+            _, cnt, diff, prog = fuzz.fuzz((seed, 200, "python", 10000))
+            self.assertEqual(diff, "", "seed %d: %s" % (seed, prog))
+            self.assertGreater(cnt, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys
+import os
+import struct
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import riscv_cpu
+import sampling
+from fuzz import enc_b, enc_i, enc_r, enc_u
+from pipeline import Pipeline
+
+# A load-use loop & then an ALU loop, 1000 iterations each.
+PROG = [
+    enc_u(0b0110111, 5, 0x80000000),  # lui t0, 0x80000
+    enc_i(0b0010011, 6, 0b000, 0, 1000),  # li t1, 1000
+    enc_i(0b0000011, 7, 0b010, 5, 0x400),  # lw t2, 0x400(t0)
+    enc_r(0b0110011, 10, 0b000, 7, 10),  # add a0, t2, a0
+    enc_i(0b0010011, 6, 0b000, 6, -1),  # addi t1, t1, -1
+    enc_b(0b1100011, 0b001, 6, 0, -12),  # bnez t1, -12
+    enc_i(0b0010011, 6, 0b000, 0, 1000),  # li t1, 1000
+    enc_i(0b0010011, 11, 0b000, 11, 3),  # addi a1, a1, 3
+    enc_i(0b0010011, 12, 0b000, 12, 5),  # addi a2, a2, 5
+    enc_i(0b0010011, 13, 0b000, 13, 7),  # addi a3, a3, 7
+    enc_i(0b0010011, 6, 0b000, 6, -1),  # addi t1, t1, -1
+    enc_b(0b1100011, 0b001, 6, 0, -16),  # bnez t1, -16
+    0xC0001073,  # unimp
+]
+TOTAL = 2 + 4 * 1000 + 1 + 5 * 1000 + 1
+
+
+def load():
+    riscv_cpu.reset()
+    riscv_cpu.memory[: len(PROG) * 4] = struct.pack("<%dI" % len(PROG), *PROG)
+    riscv_cpu.registers[riscv_cpu.PC] = 0x80000000
+    riscv_cpu.predecode()
+
+
+def full() -> dict:
+    load()
+    p = Pipeline()
+    sampling.detailed([p], None)
+    return sampling.counters(p)
+
+
+class TestSampling(unittest.TestCase):
+    def test_periodic(self):
+        ref = full()
+        self.assertEqual(ref["instructions"], TOTAL)
+        load()
+        stats, n = sampling.periodic([Pipeline()], 1000, 200, 50)
+        self.assertEqual(n, 9)
+        # The windows run on the same cpu state as the fast-forwards.
+        self.assertEqual(riscv_cpu.instret, TOTAL)
+        self.assertEqual(riscv_cpu.registers[12], 5000)
+        self.assertAlmostEqual(stats["cycles"] / ref["cycles"], 1, delta=0.01)
+        self.assertAlmostEqual(stats["load-use stalls"], 1000, delta=10)
+
+    def test_simpoints(self):
+        load()
+        vectors = sampling.profile(500)
+        self.assertEqual(sum(sum(v.values()) for v in vectors), TOTAL)
+        points = sampling.simpoints(vectors, 2)
+        # One point in each phase, weighted by its share of the intervals.
+        self.assertEqual(len(points), 2)
+        self.assertLess(points[0][0], 4000)
+        self.assertGreater(points[1][0], 4002)
+        self.assertAlmostEqual(sum(w for *_, w in points), 1)
+        load()
+        samples = sampling.sample_points([Pipeline()], points, 50)
+        stats = sampling.extrapolate(samples, TOTAL)
+        self.assertAlmostEqual(stats["cycles"] / full()["cycles"], 1, delta=0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import sys
+import os
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import riscv_cpu
+from fuzz import enc_b, enc_i, enc_s
+from uarch import Bimodal, Cache, Gshare, Predictor, UArch
+
+
+class TestUArch(unittest.TestCase):
+    def test_replacement(self):
+        # Lines 0, 2 & 4 map to set 0 of a 2-way cache with 2 sets.
+        stream = np.array([0, 2, 0, 4, 0, 2]) * 16
+        lru, fifo = Cache(64, 2, 16, "lru"), Cache(64, 2, 16, "fifo")
+        lru.access(stream)
+        fifo.access(stream)
+        # LRU keeps 0 & evicts 2, FIFO evicts 0 first.
+        self.assertEqual((lru.hits, lru.misses), (2, 4))
+        self.assertEqual((fifo.hits, fifo.misses), (1, 5))
+        # Accesses within a line hit.
+        lru.access(np.arange(0, 16, 4))
+        self.assertEqual(lru.hits, 6)
+
+    def test_predictors(self):
+        # A loop branch taken 3 times & then not, 20 times over.
+        taken = np.array([True, True, True, False] * 20)
+        pcs = np.full(len(taken), 0x80000010)
+        backward = np.ones(len(taken), bool)
+        static, bimodal, gshare = Predictor(), Bimodal(4), Gshare(6, 4)
+        for p in (static, bimodal, gshare):
+            p.feed(pcs, taken, backward)
+        self.assertEqual(static.mispredicts, 20)
+        self.assertEqual(bimodal.mispredicts, 21)
+        # The history learns the pattern after a few iterations.
+        self.assertLess(gshare.mispredicts, 10)
+
+    def test_trace(self):
+        prog = [
+            0x800002B7,  # lui t0, 0x80000
+            enc_i(0b0010011, 10, 0b000, 0, 10),  # li a0, 10
+            enc_s(0b0100011, 0b010, 5, 10, 0x100),  # sw a0, 0x100(t0)
+            enc_i(0b0000011, 11, 0b010, 5, 0x100),  # lw a1, 0x100(t0)
+            enc_i(0b0010011, 10, 0b000, 10, -1),  # addi a0, a0, -1
+            enc_b(0b1100011, 0b001, 10, 0, -12),  # bnez a0, -12
+            0xC0001073,  # unimp
+        ]
+        riscv_cpu.reset()
+        riscv_cpu.memory[: len(prog) * 4] = b"".join(
+            w.to_bytes(4, "little") for w in prog
+        )
+        riscv_cpu.registers[riscv_cpu.PC] = 0x80000000
+        u = UArch([Cache(64, 1, 16)], [Cache(64, 1, 16)], [Predictor()])
+        mem = []
+        for pcs in riscv_cpu.trace(batch=5, mem=mem):
+            u.feed(pcs, mem)
+            mem.clear()
+        self.assertEqual(u.instructions, 2 + 4 * 10 + 1)
+        self.assertEqual((u.loads, u.stores), (10, 10))
+        self.assertEqual(u.dcaches[0].misses, 1)
+        self.assertEqual(u.icaches[0].misses, 2)
+        self.assertEqual(
+            (u.predictors[0].branches, u.predictors[0].mispredicts), (10, 1)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
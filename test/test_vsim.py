@@ -0,0 +1,60 @@
+import sys
+import os
+import contextlib
+import io
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent))
+
+import vsim
+
+
+class TestVSim(unittest.TestCase):
+    def test_status(self):
+        self.assertEqual(
+            vsim.status("riscv", "TRAP          1\ncycles 812\n"), ("pass", 812)
+        )
+        self.assertEqual(
+            vsim.status("riscv", "TRAP          7\ncycles 90\n"), ("fail", 90)
+        )
+        self.assertEqual(
+            vsim.status("arm", "pc: 4\n\nfinished.\ncycles 50\n"), ("finished", 50)
+        )
+        self.assertEqual(vsim.status("arm", "TRAP. finished.\ncycles 9\n")[0], "pass")
+        self.assertEqual(vsim.status("arm", "syntax error\n"), ("error", None))
+
+    def test_image_hex(self):
+        self.assertEqual(vsim.image_hex("test/subtract.hex")[:9], "e52db004 ")
+        with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+            f.write(bytes.fromhex("04b02de5 00b08de2"))
+            f.flush()
+            self.assertEqual(vsim.image_hex(f.name), "e52db004\ne28db000\n")
+
+    @unittest.skipUnless(shutil.which("iverilog"), "needs Icarus Verilog")
+    def test_arm_core(self):
+        with tempfile.TemporaryDirectory() as cache:
+            results = vsim.run("arm", ["test/subtract.hex"] * 2, cache=cache)
+            self.assertEqual(len(os.listdir(cache)), 1)
+        self.assertEqual(results[0][1:3], results[1][1:3])
+        self.assertIsNotNone(results[0].cycles)
+        self.assertEqual(results[0].status, "finished")
+
+    def test_exit_status(self):
+        for st, code in (("finished", 0), ("pass", 0), ("error", 1)):
+            res = [vsim.Result("test/subtract.hex", st, 50, 0.1, "")]
+            with (
+                mock.patch.object(vsim, "run", return_value=res),
+                mock.patch.object(sys, "argv", ["vsim.py", "arm", "test/subtract.hex"]),
+                contextlib.redirect_stdout(io.StringIO()),
+            ):
+                with self.assertRaises(SystemExit) as e:
+                    vsim.main()
+            self.assertEqual(e.exception.code, code, st)
+
+
+if __name__ == "__main__":
+    unittest.main()
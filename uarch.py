@@ -0,0 +1,279 @@
+"""Cache & Branch Predictor Simulator
+
+Watches the fetch, load & store addresses & the branches of a program run
+by riscv_cpu & reports the hit rates of set-associative caches & the
+mispredict rates of branch predictors. The trace arrives in batches of
+addresses, so any number of configurations are simulated side by side
+from a single run.
+
+    $ python uarch.py "modules/riscv-tests/isa/rv32ui-p-*" \\
+        --icache 4096:2:32:lru --dcache 4096:4:32:fifo --bp bimodal:10
+"""
+import argparse
+import glob
+
+import numpy as np
+
+import riscv_cpu
+from riscv import OPCODE
+
+
+class Cache:
+    """Set-associative cache with LRU or FIFO replacement.
+
+    Stores allocate like loads, a miss counts a line fill.
+
+    :param size: Capacity in bytes.
+    :param ways: Lines per set.
+    :param line: Line size in bytes, a power of 2.
+    :param policy: "lru" or "fifo".
+    """
+
+    def __init__(self, size: int = 4096, ways: int = 2, line: int = 32, policy="lru"):
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"Unknown replacement policy {policy}.")
+        nsets = size // (ways * line)
+        if nsets < 1 or nsets & (nsets - 1) or line & (line - 1):
+            raise ValueError("Cache sets & line size must be powers of 2.")
+        self.size, self.ways, self.line, self.policy = size, ways, line, policy
+        self.shift = line.bit_length() - 1
+        self.mask = nsets - 1
+        # Lines of each set, the next victim first.
+        self.sets = [[] for _ in range(nsets)]
+        self.hits = self.misses = 0
+
+    def __str__(self) -> str:
+        return "%dB %d-way %dB %s" % (self.size, self.ways, self.line, self.policy)
+
+    @property
+    def rate(self) -> float:
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.0
+
+    def access(self, addrs: np.ndarray):
+        """Looks up a batch of byte addresses in order."""
+        lines = np.asarray(addrs, np.int64) >> self.shift
+        if not len(lines):
+            return
+        # Repeated accesses to one line hit & leave the order of its set be.
+        new = np.empty(len(lines), bool)
+        new[0] = True
+        np.not_equal(lines[1:], lines[:-1], out=new[1:])
+        self.hits += len(lines) - int(new.sum())
+
+        sets, mask, ways, lru = self.sets, self.mask, self.ways, self.policy == "lru"
+        hits = misses = 0
+        for ln in lines[new].tolist():
+            s = sets[ln & mask]
+            if ln in s:
+                hits += 1
+                if lru and s[-1] != ln:
+                    s.remove(ln)
+                    s.append(ln)
+            else:
+                misses += 1
+                if len(s) == ways:
+                    del s[0]
+                s.append(ln)
+        self.hits += hits
+        self.misses += misses
+
+
+class Predictor:
+    """Static branch prediction, not taken or backward taken forward not.
+
+    :param kind: "nt" or "btfn".
+    """
+
+    def __init__(self, kind: str = "btfn"):
+        self.kind = kind
+        self.branches = self.mispredicts = 0
+
+    def __str__(self) -> str:
+        return f"static {self.kind}"
+
+    @property
+    def rate(self) -> float:
+        return self.mispredicts / self.branches if self.branches else 0.0
+
+    def feed(self, pcs: np.ndarray, taken: np.ndarray, backward: np.ndarray):
+        """Predicts a batch of conditional branches & learns their outcomes."""
+        guess = backward if self.kind == "btfn" else np.zeros(len(pcs), bool)
+        self.branches += len(pcs)
+        self.mispredicts += int((guess != taken).sum())
+
+
+class Bimodal(Predictor):
+    """A table of 2-bit saturating counters indexed by the PC.
+
+    :param bits: log2 of the number of counters.
+    """
+
+    def __init__(self, bits: int = 10):
+        super().__init__("bimodal")
+        self.bits = bits
+        # Weakly not taken.
+        self.table = bytearray([1]) * (1 << bits)
+
+    def __str__(self) -> str:
+        return f"bimodal {1 << self.bits}"
+
+    def index(self, pc: int) -> int:
+        return (pc >> 2) & ((1 << self.bits) - 1)
+
+    def update(self, pc: int, taken: bool) -> bool:
+        """Predicts a branch, trains the counter & returns whether it missed."""
+        i = self.index(pc)
+        c = self.table[i]
+        self.table[i] = min(c + 1, 3) if taken else max(c - 1, 0)
+        return (c >= 2) != taken
+
+    def feed(self, pcs: np.ndarray, taken: np.ndarray, backward: np.ndarray):
+        update = self.update
+        self.branches += len(pcs)
+        self.mispredicts += sum(map(update, pcs.tolist(), taken.tolist()))
+
+
+class Gshare(Bimodal):
+    """Counters indexed by the PC xor the global history of outcomes.
+
+    :param bits: log2 of the number of counters.
+    :param history: Number of outcomes in the history.
+    """
+
+    def __init__(self, bits: int = 10, history: int = 8):
+        super().__init__(bits)
+        self.kind, self.history, self.ghr = "gshare", history, 0
+
+    def __str__(self) -> str:
+        return f"gshare {1 << self.bits} h{self.history}"
+
+    def index(self, pc: int) -> int:
+        return ((pc >> 2) ^ self.ghr) & ((1 << self.bits) - 1)
+
+    def update(self, pc: int, taken: bool) -> bool:
+        miss = super().update(pc, taken)
+        self.ghr = ((self.ghr << 1) | taken) & ((1 << self.history) - 1)
+        return miss
+
+
+PREDICTORS = {"static": Predictor, "bimodal": Bimodal, "gshare": Gshare}
+
+
+class UArch:
+    """Feeds the trace of riscv_cpu to caches & predictors.
+
+    :param icaches: Caches looked up with the fetched PCs.
+    :param dcaches: Caches looked up with the load & store addresses.
+    :param predictors: Predictors of the conditional branches.
+    """
+
+    def __init__(self, icaches=(), dcaches=(), predictors=()):
+        self.icaches, self.dcaches = list(icaches), list(dcaches)
+        self.predictors = list(predictors)
+        self.instructions = self.loads = self.stores = 0
+        # The outcome of the last branch of a batch is in the next one.
+        self.last = None
+
+    def feed(self, pcs: list[int], mem: list[int] = ()):
+        """Simulates a batch of fetched PCs & data addresses."""
+        pcs = np.asarray(pcs, np.int64)
+        self.instructions += len(pcs)
+        for c in self.icaches:
+            c.access(pcs)
+        mem = np.asarray(mem, np.int64)
+        stores = int((mem >> 32).sum())
+        self.loads, self.stores = self.loads + len(mem) - stores, self.stores + stores
+        for c in self.dcaches:
+            c.access(mem & 0xFFFFFFFF)
+
+        if self.last is not None:
+            pcs = np.concatenate(([self.last], pcs))
+        self.last = int(pcs[-1])
+        pcs, nxt = pcs[:-1], pcs[1:]
+        # Fetch the instructions, outside of memory they are no branches.
+        code = np.frombuffer(riscv_cpu.memory, "<u4", len(riscv_cpu.memory) >> 2)
+        idx = (pcs - 0x80000000) >> 2
+        ok = (idx >= 0) & (idx < len(code))
+        words = np.zeros(len(pcs), np.int64)
+        words[ok] = code[idx[ok]]
+        br = (words & 0x7F) == OPCODE["BRANCH"]
+        taken = nxt[br] != pcs[br] + 4
+        backward = (words[br] >> 31).astype(bool)
+        for p in self.predictors:
+            p.feed(pcs[br], taken, backward)
+
+    def report(self) -> str:
+        lines = [
+            "  %d instructions, %d loads, %d stores"
+            % (self.instructions, self.loads, self.stores)
+        ]
+        for name, caches in (("I$", self.icaches), ("D$", self.dcaches)):
+            for c in caches:
+                lines.append(
+                    "  %s %-24s hit rate %6.2f%% (%d misses)"
+                    % (name, c, 100 * c.rate, c.misses)
+                )
+        for p in self.predictors:
+            lines.append(
+                "  BP %-24s mispredict rate %6.2f%% of %d branches"
+                % (p, 100 * p.rate, p.branches)
+            )
+        return "\n".join(lines)
+
+
+def simulate(file: str, uarch: UArch, limit: int = None) -> UArch:
+    """Runs an ELF file in riscv_cpu & feeds its trace to uarch."""
+    riscv_cpu.load_elf(file)
+    mem = []
+    try:
+        for pcs in riscv_cpu.trace(limit, mem=mem):
+            uarch.feed(pcs, mem)
+            mem.clear()
+    finally:
+        riscv_cpu.bus.flush()
+    return uarch
+
+
+def cache(spec: str) -> Cache:
+    """Parses size:ways:line:policy, e.g. 4096:2:32:lru."""
+    f = spec.split(":")
+    return Cache(*map(int, f[:3]), *f[3:])
+
+
+def predictor(spec: str) -> Predictor:
+    """Parses kind:args, e.g. static:btfn, bimodal:10 or gshare:12:8."""
+    kind, *args = spec.split(":")
+    if kind == "static":
+        return Predictor(*args)
+    return PREDICTORS[kind](*map(int, args))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("files", nargs="+", help="ELF files or glob patterns")
+    p.add_argument(
+        "--icache", action="append", default=[], help="size:ways:line:policy"
+    )
+    p.add_argument(
+        "--dcache", action="append", default=[], help="size:ways:line:policy"
+    )
+    p.add_argument("--bp", action="append", default=[], help="kind:args")
+    p.add_argument("--limit", type=int, default=None, help="instructions to run")
+    a = p.parse_args()
+
+    files = [x for f in a.files for x in sorted(glob.glob(f)) or [f]]
+    for x in files:
+        if x.endswith(".dump"):
+            continue
+        print(f"Execute : {x}")
+        u = UArch(map(cache, a.icache), map(cache, a.dcache), map(predictor, a.bp))
+        try:
+            simulate(x, u, a.limit)
+        except Exception as e:
+            print(f"  {e}")
+        print(u.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Cached Parallel Verilog Simulation
+
+Runs firmware images on the Verilog cores with iverilog. Each core is
+compiled once, the vvp output is cached keyed by a hash of its HDL sources &
+of the compile flags, so only changed cores are compiled again. The images
+run in parallel, each in its own temporary folder, & their pass/fail & cycle
+counts are gathered. The ARM core has no pass condition, its runs finish
+after the cycle limit & only fail to simulate.
+
+    $ python vsim.py arm test/subtract.hex test/prime.hex test/fib.hex
+    $ python vsim.py riscv firmware.bin --cycles 20000
+"""
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+# Testbench & HDL sources of each core.
+CORES = {
+    "arm": ["cpu_testbench.v", "cpu/ram.v", "cpu/arm_cpu.v"],
+    "riscv": ["riscv_testbench.sv", "cpu/riskv_cpu.v"],
+}
+FLAGS = ["-Wall", "-g2012"]
+
+# Outcome of a single image, status is pass, fail, finished, timeout or error.
+Result = namedtuple("Result", ["image", "status", "cycles", "seconds", "output"])
+
+
+def tool(name: str) -> str:
+    """Returns the path of an Icarus Verilog tool, raises if not installed."""
+    path = shutil.which(name)
+    if path is None:
+        raise FileNotFoundError(f"{name} not found, install Icarus Verilog.")
+    return path
+
+
+def hdl_hash(core: str) -> str:
+    """Returns a hash over the sources & flags, changes invalidate the cache."""
+    h = hashlib.sha256(" ".join(FLAGS).encode())
+    for fn in CORES[core]:
+        h.update(fn.encode() + b"\0" + (ROOT / fn).read_bytes())
+    return h.hexdigest()
+
+
+def compile_core(core: str, cache: str = ".vsimcache") -> str:
+    """Compiles a core unless it is cached & returns the path of its vvp file."""
+    path = os.path.join(cache, f"{core}-{hdl_hash(core)}.vvp")
+    if os.path.exists(path):
+        return path
+    os.makedirs(cache, exist_ok=True)
+    # Concurrent compiles each write their own file, the last one wins.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    srcs = [str(ROOT / fn) for fn in CORES[core]]
+    r = subprocess.run(
+        [tool("iverilog"), *FLAGS, "-o", tmp, *srcs], capture_output=True, text=True
+    )
+    if r.returncode:
+        raise RuntimeError(f"iverilog failed for {core}:\n{r.stderr}")
+    os.replace(tmp, path)
+    return path
+
+
+def image_hex(fn: str) -> str:
+    """Returns an image as the hex words $readmemh loads.
+
+    Hex images are taken as they are, binaries are converted like makehex.
+    """
+    data = Path(fn).read_bytes()
+    if re.fullmatch(rb"[\s0-9a-fA-F*x_/@]*", data):
+        return data.decode()
+    from makehex import makehex
+
+    return makehex(data) + "\n"
+
+
+def status(core: str, output: str) -> tuple:
+    """Parses the testbench output, returns the status & the cycle count."""
+    m = re.search(r"^cycles (\d+)", output, re.M)
+    cycles = int(m.group(1)) if m else None
+    if core == "riscv":
+        # riscv-tests end with gp 1 on success, others print OK to a0 - a3.
+        if m := re.search(r"^TRAP\s+(\d+)", output, re.M):
+            return ("pass" if m.group(1) == "1" else "fail"), cycles
+        if re.search(r"^RISC-V TEST Result: OK", output, re.M):
+            return "pass", cycles
+        return ("timeout" if cycles is not None else "error"), cycles
+    # The ARM core never drives trap, so its runs only end at the cycle limit.
+    if "TRAP. finished." in output:
+        return "pass", cycles
+    return ("finished" if cycles is not None else "error"), cycles
+
+
+def simulate(
+    vvp: str, core: str, image: str, cycles: int = None, trace: bool = False
+) -> Result:
+    """Runs one image on a compiled core in a temporary folder."""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="vsim-") as tmp:
+        fw = os.path.join(tmp, "firmware.hex")
+        try:
+            with open(fw, "w") as f:
+                f.write(image_hex(image))
+        except OSError as e:
+            return Result(image, "error", None, 0.0, str(e))
+        args = [tool("vvp"), "-n", os.path.abspath(vvp), f"+firmware={fw}"]
+        if cycles is not None:
+            args.append(f"+cycles={cycles}")
+        if trace:
+            args.append("+trace")
+        r = subprocess.run(args, cwd=tmp, capture_output=True, text=True)
+    output = r.stdout + r.stderr
+    st, n = status(core, output) if r.returncode == 0 else ("error", None)
+    return Result(image, st, n, time.perf_counter() - start, output)
+
+
+def run(
+    core: str,
+    images: list[str],
+    jobs: int = None,
+    cycles: int = None,
+    trace: bool = False,
+    cache: str = ".vsimcache",
+) -> list[Result]:
+    """Compiles the core once & runs all images on it in parallel.
+
+    :param core: "arm" or "riscv".
+    :param images: Hex images or binaries.
+    :param jobs: Number of simulations at once, defaults to the cpu count.
+    :param cycles: Clock cycles before a simulation times out, the testbench
+        default if None.
+    :param trace: Whether the testbench prints every cycle.
+    :param cache: Folder holding the compiled cores.
+    """
+    vvp = compile_core(core, cache)
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as ex:
+        return list(ex.map(lambda x: simulate(vvp, core, x, cycles, trace), images))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("core", choices=CORES)
+    p.add_argument("images", nargs="+", help="hex images or binaries")
+    p.add_argument("-j", "--jobs", type=int, default=None, help="parallel runs")
+    p.add_argument("--cycles", type=int, default=None, help="cycle limit")
+    p.add_argument("--trace", action="store_true", help="print every cycle")
+    p.add_argument("--cache", default=".vsimcache", help="cache folder")
+    a = p.parse_args()
+
+    start = time.perf_counter()
+    results = run(a.core, a.images, a.jobs, a.cycles, a.trace, a.cache)
+    for r in results:
+        if a.trace or r.status == "error":
+            print(r.output)
+        cycles = "-" if r.cycles is None else r.cycles
+        print(f"  {r.status:7} {cycles:>8} cycles {r.seconds:6.2f}s  {r.image}")
+    failed = sum(r.status not in ("pass", "finished") for r in results)
+    print(
+        f"{len(results) - failed} of {len(results)} images passed or finished "
+        f"in {time.perf_counter() - start:.2f}s."
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()